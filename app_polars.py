@@ -2122,11 +2122,12 @@ with tab5:
                         if not isinstance(indices, list) or len(indices) < 2:
                             return 0.0
                         
-                        # Extract scores, handling potential malformed data
+                        # Extract scores, handling potential malformed data (数値にできないスコアは数えない)
                         scores = []
                         for x in indices:
-                            try: scores.append(float(x.get('final_score', 0)))
-                            except: pass
+                            if isinstance(x, dict):
+                                s = logic_v2.coerce_score(x.get('final_score', 0), default=None)
+                                if s is not None: scores.append(s)
                         
                         if len(scores) < 2: return 0.0
                         
@@ -2521,8 +2522,7 @@ with tab5:
                     # Ensure properly parsed score
                     parsed = []
                     for item in ai_indices:
-                        try: s = float(item.get('final_score', 0))
-                        except: s = 0.0
+                        s = logic_v2.coerce_score(item.get('final_score', 0))
                         c = int(item.get('車番', 0))
                         parsed.append({'c': c, 's': s})
                     parsed.sort(key=lambda x: x['s'], reverse=True)
@@ -2587,8 +2587,7 @@ with tab5:
                 if ai_indices:
                     parsed = []
                     for item in ai_indices:
-                        try: s = float(item.get('final_score', 0))
-                        except: s = 0.0
+                        s = logic_v2.coerce_score(item.get('final_score', 0))
                         c = int(item.get('車番', 0))
                         parsed.append({'c': c, 's': s})
                     parsed.sort(key=lambda x: x['s'], reverse=True)
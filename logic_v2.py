@@ -2,22 +2,98 @@ import pandas as pd
 import sqlite3
 import os
 import re
-import io
+import ast
 import json
+import io
+import csv
+import copy
+import numbers
+import operator
+import functools
+import bisect
+import hashlib
+import threading
+import time
+from contextlib import closing
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import db_utils
 from datetime import datetime
 import google.generativeai as genai
+import lxml.html
+from lxml import etree
 from bs4 import BeautifulSoup
 
 # ==========================================
 # 1. Parsing Logic (parse_kdreams_simple)
 # ==========================================
 
+# Pre-compiled patterns (HTML / K-Dreams parsing)
+_PAT_DATE = re.compile(r'(\d{4}[年/-]\d{1,2}[月/-]\d{1,2}日?)')
+_PAT_RACE = re.compile(r'(\d{1,2})[Rレース]')
+_PAT_DEADLINE = re.compile(r'締切.*?(\d{1,2}:\d{2})')
+_PAT_START = re.compile(r'発走.*?(\d{1,2}:\d{2})')
+_PAT_P00 = re.compile(r'p00\d')
+_PAT_NROW = re.compile(r'^n\d')
+_PAT_ICON_T = re.compile(r'icon_t\d')
+_PAT_SPACES = re.compile(r'\s+')
+_PAT_DIGIT = re.compile(r'\d')
+_PAT_DECIMAL = re.compile(r'^\d+\.\d+$')
+_PAT_PARENS = re.compile(r'[()]')
+_PAT_LINE_SEQ = re.compile(r'^[\d()]+$')
+_PAT_KANJI = re.compile(r'[一-龥]')
+_PAT_GUIDE = re.compile(r'誘導|先頭')
+_STRIP_SYMBOLS = str.maketrans('', '', '◎○▲△×注')
+
+# read_html ヘッダーのクリーニング (User Cleaning Rules)
+_HDR_DOUBLED = {"枠 番枠 番": "枠番", "車 番車 番": "車番", "級 班級 班": "級班", "脚 質脚 質": "脚質"}
+_PAT_HDR_DOUBLED = re.compile("|".join(map(re.escape, _HDR_DOUBLED)))
+_DROP_UNDERSCORE = str.maketrans('', '', '_')
+_DROP_SPACE = str.maketrans('', '', ' ')
+_PAT_USER_NAME = re.compile(r'(?P<選手名>\S+\s*\S*)\s+(?P<府県>[^/]+)/(?P<年齢>\d+)/(?P<期別>\d+)')
+_PAT_BRACKETS = re.compile(r'【(.*?)】')
+_PAT_PERIOD = re.compile(r'(\d+)期')
+_PAT_AGE = re.compile(r'(\d+)歳')
+_PAT_CELL_WS = re.compile(r'[\r\n]+|\s{2,}') # pd.read_html のセル空白正規化
+
+PLACES = ["函館","青森","いわき平","弥彦","前橋","取手","宇都宮","大宮","西武園","京王閣","立川","松戸","千葉","川崎","平塚","小田原","伊東","静岡","名古屋","岐阜","大垣","豊橋","富山","松阪","四日市","福井","奈良","向日町","和歌山","岸和田","玉野","広島","防府","高松","小松島","高知","松山","小倉","久留米","武雄","佐世保","別府","熊本"]
+PREFS = ["北海道","青森","岩手","宮城","秋田","山形","福島","茨城","栃木","群馬","埼玉","千葉","東京","神奈川","新潟","富山","石川","福井","山梨","長野","岐阜","静岡","愛知","三重","滋賀","京都","大阪","兵庫","奈良","和歌山","鳥取","島根","岡山","広島","山口","徳島","香川","愛媛","高知","福岡","佐賀","長崎","熊本","大分","宮崎","鹿児島","沖縄"]
+
+# Single-pass alternations (one scan instead of one `in` per place / prefecture)
+# 競輪場は先読みで重なりも含めて全部拾い、PLACES で先に並ぶものを採る (旧ループと同じ優先順)
+_PLACES_VENUE_RE = re.compile("(?=(" + "|".join(re.escape(p) for p in PLACES) + ")(?:競輪| ))")
+_PLACES_TEXT_RE = re.compile("(?=(" + "|".join(re.escape(p) for p in PLACES) + "))")
+_PLACE_RANK = {p: i for i, p in enumerate(PLACES)}
+_PREFS_END_RE = re.compile("(" + "|".join(re.escape(p) for p in sorted(PREFS, key=len, reverse=True)) + r")\Z")
+
+def _first_place(pat, text):
+    """text 中で pat に一致した競輪場のうち PLACES の並びで最初のもの (なければ None)"""
+    return min((m.group(1) for m in pat.finditer(text)), key=_PLACE_RANK.__getitem__, default=None)
+
+def _strip_pref_tail(val, pref):
+    """val の末尾にある府県名 (文字間の空白は許容) を取り除く"""
+    i = len(val)
+    for ch in reversed(pref):
+        while i and val[i-1].isspace(): i -= 1
+        if not i or val[i-1] != ch: return val
+        i -= 1
+    return val[:i]
+
+def _head_text(soup, budget=2000):
+    """soup.get_text()[:budget] と同じ文字列を、先頭のテキストノードだけ走査して作る"""
+    buf = []
+    n = 0
+    for s in soup.strings:
+        buf.append(s)
+        n += len(s)
+        if n >= budget: break # 残りのDOMは触らない
+    return "".join(buf)[:budget]
+
 def extract_metadata_from_html(soup):
     """HTMLから日付と場所とレース番号を探す"""
     meta = {}
-    text = soup.get_text()[:2000] # Extend search range
+    text = _head_text(soup, 2000) # Extend search range
     
     # 日付 (2025年12月13日 or 2025/12/13) - Look in specific headers first
     
@@ -28,47 +104,38 @@ def extract_metadata_from_html(soup):
     for h in h1s: title_text += " " + h.get_text()
     
     # Date in Title
-    m = re.search(r'(\d{4}[年/-]\d{1,2}[月/-]\d{1,2}日?)', title_text)
+    m = _PAT_DATE.search(title_text)
     if m: 
         meta['date'] = m.group(1)
     else:
         # Fallback to general text
-        m = re.search(r'(\d{4}[年/-]\d{1,2}[月/-]\d{1,2}日?)', text)
+        m = _PAT_DATE.search(text)
         if m: meta['date'] = m.group(1)
     
     # レース番号
-    m_r = re.search(r'(\d{1,2})[Rレース]', title_text) # Try title first
+    m_r = _PAT_RACE.search(title_text) # Try title first
     if m_r: 
         meta['race_num'] = m_r.group(1)
     else:
-        m_r = re.search(r'(\d{1,2})[Rレース]', text)
+        m_r = _PAT_RACE.search(text)
         if m_r: meta['race_num'] = m_r.group(1)
     
     # 競輪場 - Strictly look for "Place" + "競輪" or "Place" + "レース" in Title
-    places = ["函館","青森","いわき平","弥彦","前橋","取手","宇都宮","大宮","西武園","京王閣","立川","松戸","千葉","川崎","平塚","小田原","伊東","静岡","名古屋","岐阜","大垣","豊橋","富山","松阪","四日市","福井","奈良","向日町","和歌山","岸和田","玉野","広島","防府","高松","小松島","高知","松山","小倉","久留米","武雄","佐世保","別府","熊本"]
-    
     # 1. Strong Check: "Place" + "競輪" in Title
-    found_place = None
-    for p in places:
-        if f"{p}競輪" in title_text or f"{p} " in title_text:
-            found_place = p
-            break
+    found_place = _first_place(_PLACES_VENUE_RE, title_text)
             
     # 2. Fallback: specific ID parsing or just found in text (Risky)
     if not found_place:
-        for p in places:
-             # Avoid "Next Race: Wakayama" type false positives by checking nearby characters if possible
-             # For now, just check text but prioritising beginning
-             if p in text[:500]: # Check only header area
-                 found_place = p
-                 break
+        # Avoid "Next Race: Wakayama" type false positives by checking nearby characters if possible
+        # For now, just check text but prioritising beginning
+        found_place = _first_place(_PLACES_TEXT_RE, text[:500]) # Check only header area
                  
     # Start Time & Deadline
     # Search patterns: "投票締切 10:45" "発走 10:50"
-    m_deadline = re.search(r'締切.*?(\d{1,2}:\d{2})', text)
+    m_deadline = _PAT_DEADLINE.search(text)
     if m_deadline: meta['deadline'] = m_deadline.group(1)
     
-    m_start = re.search(r'発走.*?(\d{1,2}:\d{2})', text)
+    m_start = _PAT_START.search(text)
     if m_start: meta['start_time'] = m_start.group(1)
 
     if found_place:
@@ -114,7 +181,7 @@ def parse_line_position_html(soup):
         # But also check for simple text if nested span missing?
         
         # Regex for car num class p001-p009
-        car_span = sp.find('span', class_=re.compile(r'p00\d'))
+        car_span = sp.find('span', class_=_PAT_P00)
         if car_span:
             try:
                 car_num = int(car_span.get_text().strip())
@@ -140,13 +207,250 @@ def lines_to_str(lines):
     # "123 456 789"
     return " ".join(["".join(map(str, l)) for l in lines])
 
-def parse_kdreams_direct(html_content):
+def _line_str_by_car(lines, cars, missing=None):
+    """車番配列 -> ライン文字列 ("123") 配列。車番で直接引く小さな表を使う (該当なしは missing)"""
+    size = max([10, int(cars.max(initial=0)) + 1] + [c + 1 for grp in lines for c in grp])
+    table = np.full(size, missing, dtype=object)
+    for grp in lines:
+        table[list(grp)] = "".join(map(str, grp))
+    return table[cars]
+
+# --- lxml helpers (parse_kdreams_direct) ---
+_LX_UTF8_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+def _lx_root(html_content):
+    """lxml でパース (str は UTF-8 固定で渡し meta charset による再デコードを防ぐ)"""
+    try:
+        return lxml.html.document_fromstring(html_content.encode('utf-8'), parser=_LX_UTF8_PARSER)
+    except (etree.ParserError, ValueError):
+        return None # 空文書など
+
+def _lx_classes(el):
+    return (el.get('class') or '').split()
+
+def _lx_text(el, sep=''):
+    """bs4 の get_text(sep, strip=True) 相当"""
+    return sep.join(filter(None, (t.strip() for t in el.itertext())))
+
+def _lx_find_span(el, pred):
+    """class リストが pred を満たす最初の子孫 span"""
+    for sp in el.iter('span'):
+        if pred(_lx_classes(sp)):
+            return sp
+    return None
+
+def _is_plain_span(cls): return any(c != 'best' for c in cls)
+def _is_best_span(cls): return 'best' in cls
+def _is_icon_t_span(cls): return any(_PAT_ICON_T.search(c) for c in cls)
+def _is_home_span(cls): return 'home' in cls
+
+def _lx_is_player_row(tr):
+    return any(_PAT_NROW.search(c) for c in _lx_classes(tr))
+
+def _lx_cell_text(td):
+    # Get direct text or span text
+    span = _lx_find_span(td, _is_plain_span)
+    if span is not None:
+        return _lx_text(span)
+    best_span = _lx_find_span(td, _is_best_span)
+    if best_span is not None:
+        return _lx_text(best_span)
+    return _lx_text(td)
+
+def _lx_expand_rows(trs, remainder=None, overflow=True):
+    """<tr> 群をテキスト行に展開 (colspan/rowspan は pd.read_html と同じくコピー)"""
+    out = []
+    remainder = remainder or []
+    for tr in trs:
+        texts, next_rem, index = [], [], 0
+        for td in tr.xpath('./td|./th'):
+            while remainder and remainder[0][0] <= index:
+                p_i, p_text, p_span = remainder.pop(0)
+                texts.append(p_text)
+                if p_span > 1: next_rem.append((p_i, p_text, p_span - 1))
+                index += 1
+            text = _PAT_CELL_WS.sub(' ', td.text_content().strip())
+            rowspan = int(td.get('rowspan') or 1)
+            colspan = int(td.get('colspan') or 1)
+            for _ in range(colspan):
+                texts.append(text)
+                if rowspan > 1: next_rem.append((index, text, rowspan - 1))
+                index += 1
+        for p_i, p_text, p_span in remainder:
+            texts.append(p_text)
+            if p_span > 1: next_rem.append((p_i, p_text, p_span - 1))
+        out.append(texts)
+        remainder = next_rem
+    if not overflow:
+        while remainder:
+            out.append([p_text for _, p_text, _ in remainder])
+            remainder = [(p_i, p_text, p_span - 1) for p_i, p_text, p_span in remainder if p_span > 1]
+    return out, remainder
+
+def _table_to_frame(table):
+    """
+    lxml の <table> を pd.read_html(header=None) と同じ規則で DataFrame 化する。
+    パース済みツリーから直接行を取り出すので、str(table) の再シリアライズ・再パースが不要。
+    (非表示要素の除去 / <br> の改行化はコピーに対して行い、渡された table は書き換えない)
+    """
+    if 'display:none' in (table.get('style') or '').replace(' ', ''):
+        return None
+    table = copy.deepcopy(table)
+    for el in table.xpath('.//style'):
+        el.drop_tree()
+    for el in table.xpath('.//*[@style]'):
+        if 'display:none' in el.get('style', '').replace(' ', ''):
+            el.drop_tree()
+    for br in table.iter('br'):
+        br.tail = '\n' + (br.tail or '')
+    
+    # Header / Body / Footer (thead が無ければ先頭の th だけの行をヘッダー扱い)
+    head_trs = []
+    for thead in table.xpath('.//thead'):
+        head_trs.extend(thead.xpath('./tr'))
+        if thead.xpath('./td|./th'): head_trs.append(thead)
+    body_trs = table.xpath('.//tbody//tr') + table.xpath('./tr')
+    foot_trs = table.xpath('.//tfoot//tr')
+    if not head_trs:
+        while body_trs and all(c.tag == 'th' for c in body_trs[0].xpath('./td|./th')):
+            head_trs.append(body_trs.pop(0))
+    
+    head, rem = _lx_expand_rows(head_trs)
+    body, rem = _lx_expand_rows(body_trs, rem, overflow=bool(foot_trs))
+    foot, _ = _lx_expand_rows(foot_trs, rem, overflow=False)
+    
+    header = None
+    if head:
+        header = 0 if len(head) == 1 else [i for i, row in enumerate(head) if any(row)]
+    data = head + body + foot
+    if not data: return None
+    width = max(len(r) for r in data)
+    data = [r + [''] * (width - len(r)) for r in data]
+    # 型推定・ヘッダー・桁区切りは read_html と同じ python パーサーに任せる (全セルをクォートして渡す)
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator='\n', quoting=csv.QUOTE_ALL).writerows(data)
+    buf.seek(0)
+    try:
+        return pd.read_csv(buf, header=header, thousands=',', engine='python')
+    except pd.errors.EmptyDataError:
+        return None
+
+@functools.lru_cache(maxsize=16384)
+def extract_kdreams_info(val):
+    """選手名セルを (選手名, 府県, 年齢, 期別) に分解 (同じ文字列はキャッシュから返す)"""
+    val = str(val).strip()
+    name = val
+    pref = ""
+    age = ""
+    period = ""
+    
+    # Pattern 0: User Specified Regex
+    match_user = _PAT_USER_NAME.search(val)
+    if match_user:
+        name = match_user.group('選手名').strip()
+        pref = match_user.group('府県').strip()
+        age = match_user.group('年齢').strip()
+        period = match_user.group('期別').strip()
+        return name, pref, age, period
+
+    # Pattern 1: Name【Prefecture Period】
+    match_brackets = _PAT_BRACKETS.search(val)
+    if match_brackets:
+        info = match_brackets.group(1)
+        name = val.split('【')[0].strip()
+        
+        info = info.replace('　', '').replace(' ', '')
+        m_period = _PAT_PERIOD.search(info)
+        if m_period:
+            period = m_period.group(1)
+            info = info.replace(m_period.group(0), '')
+        
+        m_age = _PAT_AGE.search(info)
+        if m_age:
+            age = m_age.group(1)
+            info = info.replace(m_age.group(0), '')
+            
+        pref = info
+        return name, pref, age, period
+
+    # Pattern 2: Fallback
+    m_period = _PAT_PERIOD.search(val)
+    if m_period:
+        period = m_period.group(1)
+        val = val.replace(m_period.group(0), ' ')
+        
+    m_age = _PAT_AGE.search(val)
+    if m_age:
+        age = m_age.group(1)
+        val = val.replace(m_age.group(0), ' ')
+    
+    val = val.replace('/', ' ').replace('　', ' ')
+    
+    val_norm = val.replace(' ', '')
+    m_pref = _PREFS_END_RE.search(val_norm)
+    
+    if m_pref:
+        pref = m_pref.group(1)
+        val = _strip_pref_tail(val, pref)
+    
+    name = val.strip()
+    return name, pref, age, period
+
+# 数値列プロファイルのビット (parse_kdreams_simple の列役割判定)
+_COL_SCORE_LIKE = 1   # 平均 60〜130 (競走得点)
+_COL_CAR_RANGE = 2    # 1〜9 の範囲で 5種類以上 (車番候補)
+_COL_CAR_UNIQUE = 4   # 上記かつ重複なし
+_COL_TACTIC_LIKE = 8  # 0〜100 の整数値 (S/B/逃/捲/差/マ)
+
+def _numeric_column_profile(vals):
+    """to_numeric 済みの列を1回の配列処理で判定し、_COL_* のビットマスクを返す"""
+    arr = vals.to_numpy(dtype=float, na_value=np.nan)
+    valid = arr[~np.isnan(arr)]
+    if valid.size == 0: return 0
+    
+    bits = 0
+    v_min, v_max = valid.min(), valid.max()
+    if 60 <= valid.mean() <= 130: bits |= _COL_SCORE_LIKE
+    if v_min >= 1 and v_max <= 9:
+        n_unique = np.unique(valid).size
+        if n_unique >= 5:
+            bits |= _COL_CAR_RANGE
+            if n_unique == valid.size: bits |= _COL_CAR_UNIQUE
+    if v_min >= 0 and v_max <= 100 and not (np.abs(valid - np.round(valid)) > 0.001).any():
+        bits |= _COL_TACTIC_LIKE
+    return bits
+
+# parse_kdreams_simple の列順 (ユーザー指定)
+_COLUMNS_ORDER = [
+    '競輪場', 'グレード', '日付', '開催日', 'レースの種類', 'レース番号', 'ライン', 
+    '選手名', '府県', '年齢', '期別', '脚質', '競走得点', 
+    'S', 'B', '逃', '捲', '差', 'マ', 'BK',
+    '決まり手', '着順', '車番', 'S／B',
+    '2連複', '3連複', 'ワイド1', 'ワイド2', 'ワイド3', '2連単', '3連単'
+]
+_COLUMNS_ORDER_SET = frozenset(_COLUMNS_ORDER)
+
+# parse_kdreams_direct の出力列 (セル順)
+_DIRECT_COLS = ['予想', '好気合', '評価', '枠番', '車番', '選手名', '府県', '年齢', '期別',
+                '級班', '脚質', 'ギヤ倍数', '競走得点', 'S', 'B', '逃', '捲', '差', 'マ']
+_DIRECT_NUMERIC_COLS = ['車番', '競走得点', 'S', 'B', '逃', '捲', '差', 'マ', '年齢', '期別']
+
+def parse_html_docs(html_content):
+    """
+    HTMLを一度だけパースして (soup, root) を返す。
+    parse_kdreams_direct / parse_kdreams_simple の両方を試す場合に渡して再パースを省く (呼ぶ順序は自由)。
+    """
+    return BeautifulSoup(html_content, 'lxml'), _lx_root(html_content)
+
+def parse_kdreams_direct(html_content=None, soup=None, root=None):
     """
     【Kドリームス 直接セル解析版】
     HTMLの<tr>構造を直接解析し、確実にセル順序を取得する。
     テーブルヘッダーのずれ問題を回避。
+    soup / root を渡した場合は再パースしない (parse_html_docs 参照)。
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
+    if soup is None:
+        soup = BeautifulSoup(html_content, 'lxml')
     meta = extract_metadata_from_html(soup)
     meta['site'] = 'K-Dreams'
     
@@ -158,50 +462,46 @@ def parse_kdreams_direct(html_content):
     
     # Find all player rows: <tr class="n1">, <tr class="n2">, etc.
     # IMPORTANT: Only use the FIRST table containing these rows to avoid duplicates
-    rows = []
+    # Accepted rows go straight into per-column lists (SoA) for a single DataFrame build
+    cols = {k: [] for k in _DIRECT_COLS}
+    present = set()  # Columns seen in at least one row
+    n_rows = 0
     seen_car_nums = set()  # Track seen car numbers to avoid duplicates
     
     # Find the main entry table (usually table.entry or first table with n1 class rows)
-    target_table = None
-    for table in soup.find_all('table'):
-        if table.find('tr', class_=re.compile(r'^n\d')):
-            target_table = table
-            break  # Use FIRST table found
-    
-    if target_table:
-        all_trs = target_table.find_all('tr', class_=re.compile(r'^n\d'))
-    else:
-        all_trs = []
+    # Row/cell extraction runs on lxml (C-level tree walk) instead of bs4 finds
+    if root is None:
+        root = _lx_root(html_content if html_content is not None else str(soup))
+    all_trs = []
+    if root is not None:
+        for table in root.iter('table'):
+            trs = [tr for tr in table.iter('tr') if _lx_is_player_row(tr)]
+            if trs:
+                all_trs = trs
+                break  # Use FIRST table found
+    
+    get_cell_text = _lx_cell_text
     
     for tr in all_trs:
-        tds = tr.find_all('td')
+        tds = list(tr.iter('td'))
         if len(tds) < 15: continue  # Not a valid player row
         
         row_data = {}
         
-        # Extract text from each cell, handling nested spans
-        def get_cell_text(td):
-            # Get direct text or span text
-            span = td.find('span', class_=lambda x: x and 'best' not in (x if isinstance(x, list) else [x]))
-            if span:
-                return span.get_text(strip=True)
-            best_span = td.find('span', class_='best')
-            if best_span:
-                return best_span.get_text(strip=True)
-            return td.get_text(strip=True)
-        
         try:
             # Parse based on class names and position
-            idx = 0
-            for td in tds:
-                classes = td.get('class', [])
-                class_str = ' '.join(classes) if classes else ''
+            # (class 属性は lxml では生の文字列なので join 不要。rider 位置も同じループで記録)
+            rider_idx = -1
+            for i, td in enumerate(tds):
+                class_str = td.get('class') or ''
+                if rider_idx < 0 and 'rider' in class_str:
+                    rider_idx = i
                 
                 if 'tip' in class_str:
                     # 予想印
-                    icon_span = td.find('span', class_=re.compile(r'icon_t\d'))
-                    if icon_span:
-                        row_data['予想'] = icon_span.get_text(strip=True)
+                    icon_span = _lx_find_span(td, _is_icon_t_span)
+                    if icon_span is not None:
+                        row_data['予想'] = _lx_text(icon_span)
                 elif 'kiai' in class_str:
                     row_data['好気合'] = get_cell_text(td)
                 elif 'evaluation' in class_str:
@@ -212,11 +512,11 @@ def parse_kdreams_direct(html_content):
                     row_data['車番'] = get_cell_text(td)
                 elif 'rider' in class_str:
                     # 選手名 + 府県/年齢/期別
-                    full_text = td.get_text(' ', strip=True)
+                    full_text = _lx_text(td, ' ')
                     # Split by home span
-                    home_span = td.find('span', class_='home')
-                    if home_span:
-                        home_text = home_span.get_text(strip=True)
+                    home_span = _lx_find_span(td, _is_home_span)
+                    if home_span is not None:
+                        home_text = _lx_text(home_span)
                         # Name is before home span
                         name_part = full_text.replace(home_text, '').strip()
                         row_data['選手名'] = name_part
@@ -231,16 +531,8 @@ def parse_kdreams_direct(html_content):
                             row_data['期別'] = parts[2].strip()
                     else:
                         row_data['選手名'] = full_text
-                else:
-                    idx += 1
             
             # Now parse remaining columns by position after rider
-            # Find rider index
-            rider_idx = -1
-            for i, td in enumerate(tds):
-                if 'rider' in ' '.join(td.get('class', [])):
-                    rider_idx = i
-                    break
             
             if rider_idx >= 0 and len(tds) > rider_idx + 10:
                 # Columns after rider: 級班, 脚質, ギヤ, 得点, S, B, 逃, 捲, 差, マ, ...
@@ -261,39 +553,38 @@ def parse_kdreams_direct(html_content):
                 car_num = str(row_data['車番']).strip()
                 if car_num not in seen_car_nums:
                     seen_car_nums.add(car_num)
-                    rows.append(row_data)
+                    for k, buf in cols.items():
+                        buf.append(row_data.get(k, np.nan))
+                    present.update(row_data)
+                    n_rows += 1
                 
         except Exception as e:
             continue
     
-    if not rows:
+    if not n_rows:
         return pd.DataFrame(), meta
     
-    df = pd.DataFrame(rows)
+    df = pd.DataFrame({k: cols[k] for k in _DIRECT_COLS if k in present})
     
-    # Convert numeric columns
-    for col in ['車番', '競走得点', 'S', 'B', '逃', '捲', '差', 'マ', '年齢', '期別']:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+    # Convert numeric columns (one block conversion)
+    num_cols = [c for c in _DIRECT_NUMERIC_COLS if c in df.columns]
+    df[num_cols] = df[num_cols].apply(pd.to_numeric, errors='coerce').fillna(0)
     
     # Apply line info if available
     if 'lines_list' in meta and '車番' in df.columns:
-        car_line_map = {}
-        for idx, grp in enumerate(meta['lines_list']):
-            line_s = "".join(map(str, grp))
-            for car in grp:
-                car_line_map[car] = line_s
-        df['ライン'] = df['車番'].astype(int).map(car_line_map).fillna('')
+        df['ライン'] = _line_str_by_car(meta['lines_list'], df['車番'].astype(int).to_numpy(), '')
     
     return df, meta
 
-def parse_kdreams_simple(html_content):
+def parse_kdreams_simple(html_content=None, soup=None, root=None):
     """
     【楽天Kドリームス シンプル版 (改善v3)】
     列ごとの特徴量だけで「車番」「選手名」「競走得点」を特定する。
     予想印(◎○等)の混入を防ぎ、誘導員を除外する。
+    soup / root を渡した場合は再パースしない (parse_html_docs 参照)。
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
+    if soup is None:
+        soup = BeautifulSoup(html_content, 'lxml')
     meta = extract_metadata_from_html(soup)
     meta['site'] = 'K-Dreams'
     
@@ -304,21 +595,22 @@ def parse_kdreams_simple(html_content):
         meta['lines_list'] = line_groups
         # print(f"DEBUG: Parsed Lines: {meta['lines_parsed']}")
 
-    # BeautifulSoupで確実にテーブルを特定する
+    # テーブル候補は lxml ツリーのテキストで絞り込み、read_html には候補だけを渡す
     target_table = None
     best_df = pd.DataFrame()
-    tables = soup.find_all('table')
+    if root is None:
+        root = _lx_root(html_content if html_content is not None else str(soup))
+    tables = list(root.iter('table')) if root is not None else []
     
     for table in tables:
         # text check is fast
-        txt = table.get_text()
+        txt = table.text_content()
         if '車番' in txt and '選手' in txt:
              # Convert to DF to check structure
              try:
-                 # Use str(table) to parse only this table
-                 _dfs = pd.read_html(io.StringIO(str(table)), header=None)
-                 if not _dfs: continue
-                 _df = _dfs[0]
+                 # Build the frame straight from the parsed tree (no read_html re-parse)
+                 _df = _table_to_frame(table)
+                 if _df is None: continue
                  
                  if _df.shape[1] < 10: continue 
                  
@@ -330,7 +622,7 @@ def parse_kdreams_simple(html_content):
                          # Found the header row!
                          target_table = _df.iloc[i+1:].copy()
                          # Clean header
-                         header_row = _df.iloc[i].astype(str).str.replace(r'\s+','', regex=True)
+                         header_row = _df.iloc[i].astype(str).str.replace(_PAT_SPACES, '', regex=True)
                          target_table.columns = header_row
                          best_df = target_table
                          found_key_in_row = True
@@ -356,10 +648,9 @@ def parse_kdreams_simple(html_content):
                                  base_name = str(col)
                              
                              # User Cleaning Rules
-                             base_name = base_name.replace("直近4ヶ月の成績_", "").replace("_", "")
-                             base_name = base_name.replace("枠 番枠 番", "枠番").replace("車 番車 番", "車番")
-                             base_name = base_name.replace("級 班級 班", "級班").replace("脚 質脚 質", "脚質")
-                             base_name = base_name.replace(" ", "") # Aggressively remove spaces
+                             base_name = base_name.replace("直近4ヶ月の成績_", "").translate(_DROP_UNDERSCORE)
+                             base_name = _PAT_HDR_DOUBLED.sub(lambda m: _HDR_DOUBLED[m.group(0)], base_name)
+                             base_name = base_name.translate(_DROP_SPACE) # Aggressively remove spaces
                              
                              if base_name not in counts:
                                  counts[base_name] = 0
@@ -369,12 +660,17 @@ def parse_kdreams_simple(html_content):
                                  new_cols_cleaned.append(f"{base_name}#{counts[base_name]}")
                          
                          best_df.columns = new_cols_cleaned
+                         
+                         # Early exit: the parsed header itself names 車番 and 選手 and the
+                         # table has rider-sized rows -> no need to parse the remaining tables
+                         if len(best_df) >= 5 and '車番' in new_cols_cleaned and any('選手' in c for c in new_cols_cleaned):
+                             break
                      
              except: continue
 
     if best_df.empty: 
         try:
-             dfs = pd.read_html(io.StringIO(html_content), header=None)
+             dfs = [f for f in map(_table_to_frame, tables) if f is not None]
              for df in dfs:
                 if len(df) < 5: continue
                 if df.shape[1] < 8: continue # Main table is wide
@@ -384,7 +680,7 @@ def parse_kdreams_simple(html_content):
                     row_str = df.iloc[i].astype(str).str.cat()
                     if '車番' in row_str and ('選手' in row_str or '名' in row_str):
                         best_df = df.iloc[i+1:].copy()
-                        best_df.columns = df.iloc[i].astype(str).str.replace(r'\s+','', regex=True)
+                        best_df.columns = df.iloc[i].astype(str).str.replace(_PAT_SPACES, '', regex=True)
                         break
                 if not best_df.empty: break
         except: pass
@@ -394,15 +690,6 @@ def parse_kdreams_simple(html_content):
     # --- 列の役割判定 (Header Text & Content) ---
     best_df.columns = [str(c) for c in best_df.columns]
     
-    # User specified columns order
-    columns_order = [
-        '競輪場', 'グレード', '日付', '開催日', 'レースの種類', 'レース番号', 'ライン', 
-        '選手名', '府県', '年齢', '期別', '脚質', '競走得点', 
-        'S', 'B', '逃', '捲', '差', 'マ', 'BK',
-        '決まり手', '着順', '車番', 'S／B',
-        '2連複', '3連複', 'ワイド1', 'ワイド2', 'ワイド3', '2連単', '3連単'
-    ]
-    
     rename_map = {}
     used_cols = set()
     mapped_targets = set()
@@ -413,24 +700,21 @@ def parse_kdreams_simple(html_content):
             used_cols.add(col)
             mapped_targets.add(target)
     
-    for col in best_df.columns:
-        c = str(col)
+    for c in best_df.columns:
         # Exact matches first
-        if c in columns_order:
-            pass
+        if c in _COLUMNS_ORDER_SET: continue
         # Fuzzy Fallbacks
-        elif '競走得点' in c: safe_map(c, '競走得点')
+        short = len(c) < 5
+        if '競走得点' in c: safe_map(c, '競走得点')
         elif '選手名' in c: safe_map(c, '選手名')
         elif '車番' in c and '車番' not in best_df.columns: safe_map(c, '車番')
         elif 'S' == c or 'S#' in c: safe_map(c, 'S')
         elif 'B' == c or 'B#' in c: safe_map(c, 'B')
-        elif '逃' in c and len(c) < 5: safe_map(c, '逃')
-        elif '捲' in c and len(c) < 5: safe_map(c, '捲')
-        elif '差' in c and len(c) < 5: safe_map(c, '差')
-        elif '差' in c and len(c) < 5: safe_map(c, '差')
-        elif 'マ' in c and len(c) < 5: safe_map(c, 'マ')
-        elif 'ライン' in c: safe_map(c, 'ライン')
-        elif '並び' in c: safe_map(c, 'ライン')
+        elif '逃' in c and short: safe_map(c, '逃')
+        elif '捲' in c and short: safe_map(c, '捲')
+        elif '差' in c and short: safe_map(c, '差')
+        elif 'マ' in c and short: safe_map(c, 'マ')
+        elif 'ライン' in c or '並び' in c: safe_map(c, 'ライン')
 
     # Content-based Line Detection (if not found by header)
     if 'ライン' not in rename_map.values():
@@ -442,26 +726,32 @@ def parse_kdreams_simple(html_content):
             s_vals = best_df[col].astype(str).str.strip()
             
             # Filter out empty
-            s_valid = s_vals[s_vals != 'nan']
-            if s_valid.empty: continue
+            s_valid = [s for s in s_vals.tolist() if isinstance(s, str) and s != 'nan']
+            if not s_valid: continue
+            n_valid = len(s_valid)
             
             # Avg length should be small (1-5 chars usually)
-            avg_len = s_valid.str.len().mean()
+            avg_len = sum(map(len, s_valid)) / n_valid
             if not (0.8 <= avg_len <= 8.0): continue
             
+            # digits / loose decimals / parens / digit sequences in one pass
+            n_digits = n_float = n_seq = 0
+            has_parens = False
+            for s in s_valid:
+                if _PAT_DIGIT.search(s): n_digits += 1
+                if _PAT_DECIMAL.match(s): n_float += 1
+                if _PAT_LINE_SEQ.match(s): n_seq += 1
+                if not has_parens and _PAT_PARENS.search(s): has_parens = True
+            
             # Should have digits
-            has_digits = s_valid.str.contains(r'\d').mean()
-            if has_digits < 0.8: continue
+            if n_digits / n_valid < 0.8: continue
             
             # Should NOT be loose decimals
-            is_float = s_valid.str.match(r'^\d+\.\d+$').mean()
-            if is_float > 0.1: continue
+            if n_float / n_valid > 0.1: continue
             
             # If it contains typical line chars like parens
-            has_parens = s_valid.str.contains(r'[()]').any()
-            
             # Or if it matches simple digit sequences 123
-            is_digit_seq = s_valid.str.match(r'^[\d()]+$').mean()
+            is_digit_seq = n_seq / n_valid
             
             if is_digit_seq > 0.8 or has_parens:
                 rename_map[col] = 'ライン'
@@ -471,17 +761,23 @@ def parse_kdreams_simple(html_content):
     best_df.rename(columns=rename_map, inplace=True)
     
     # Reorder (keep others at end)
-    final_cols = [c for c in columns_order if c in best_df.columns]
+    final_cols = [c for c in _COLUMNS_ORDER if c in best_df.columns]
     other_cols = [c for c in best_df.columns if c not in final_cols]  
     best_df = best_df[final_cols + other_cols]
     
+    # 数値判定は列ごとに一度だけ (競走得点 / 車番 / 戦法の判定で共有)
+    profile_cache = {}
+    def col_profile(col):
+        if col not in profile_cache:
+            profile_cache[col] = _numeric_column_profile(pd.to_numeric(best_df[col], errors='coerce'))
+        return profile_cache[col]
+    
     # 1. 競走得点 (Content Based - if not found by header)
     score_col = None
     if '競走得点' not in rename_map.values():
         for col in best_df.columns:
             if col in used_cols: continue
-            vals = pd.to_numeric(best_df[col], errors='coerce')
-            if 60 <= vals.mean() <= 130:
+            if col_profile(col) & _COL_SCORE_LIKE:
                 rename_map[col] = '競走得点'
                 score_col = col
                 used_cols.add(col)
@@ -491,16 +787,14 @@ def parse_kdreams_simple(html_content):
     if '車番' not in rename_map.values():
         for col in best_df.columns:
             if col in used_cols: continue
-            vals = pd.to_numeric(best_df[col], errors='coerce')
-            vals_valid = vals.dropna()
-            if vals_valid.min() >= 1 and vals_valid.max() <= 9:
-                if vals_valid.nunique() >= 5:
-                    if not vals_valid.duplicated().any():
-                        rename_map[col] = '車番'
-                        used_cols.add(col)
-                        break
+            bits = col_profile(col)
+            if bits & _COL_CAR_RANGE:
+                if bits & _COL_CAR_UNIQUE:
+                    rename_map[col] = '車番'
                     used_cols.add(col)
                     break
+                used_cols.add(col)
+                break
             
     # 3. 選手名 (If strict header match failed)
     if '選手名' not in rename_map.values():
@@ -509,7 +803,7 @@ def parse_kdreams_simple(html_content):
             if col in used_cols: continue
             s_vals = best_df[col].astype(str)
             # Must have Kanji
-            has_kanji = s_vals.str.contains(r'[一-龥]').any()
+            has_kanji = s_vals.str.contains(_PAT_KANJI).any()
             
             if has_kanji and not s_vals.str.isnumeric().all():
                 if s_vals.str.contains('コメント|連対').any(): continue
@@ -563,18 +857,8 @@ def parse_kdreams_simple(html_content):
                 if 'ギヤ' in c or 'ギア' in c or 'gear' in col_name_lower: continue
                 if '予想' in c or '好気' in c: continue
                 
-                vals = pd.to_numeric(best_df[c], errors='coerce')
-                if vals.isna().all(): continue
-                
-                vals_clean = vals.dropna()
-                if len(vals_clean) == 0: continue
-                
-                has_decimal = any(abs(v - round(v)) > 0.001 for v in vals_clean)
-                if has_decimal: continue
-                
-                v_max = vals.max()
-                v_min = vals.min()
-                if v_max > 100 or v_min < 0: continue
+                # 全NaN / 小数あり / 0〜100 の範囲外は除外
+                if not (col_profile(c) & _COL_TACTIC_LIKE): continue
                 
                 if param_names[p_ptr] not in rename_map.values():
                     rename_map[c] = param_names[p_ptr]
@@ -591,115 +875,28 @@ def parse_kdreams_simple(html_content):
     
     if '選手名' in best_df.columns:
         # 誘導員削除
-        best_df = best_df[~best_df['選手名'].astype(str).str.contains('誘導|先頭')]
+        names = best_df['選手名'].to_numpy(dtype=object)
+        best_df = best_df[np.fromiter((_PAT_GUIDE.search(str(s)) is None for s in names), dtype=bool, count=len(names))]
         # 記号削除
-        best_df['選手名'] = best_df['選手名'].astype(str).str.replace(r'[◎○▲△×注]', '', regex=True)
-        
-        prefs = ["北海道","青森","岩手","宮城","秋田","山形","福島","茨城","栃木","群馬","埼玉","千葉","東京","神奈川","新潟","富山","石川","福井","山梨","長野","岐阜","静岡","愛知","三重","滋賀","京都","大阪","兵庫","奈良","和歌山","鳥取","島根","岡山","広島","山口","徳島","香川","愛媛","高知","福岡","佐賀","長崎","熊本","大分","宮崎","鹿児島","沖縄"]
-        prefs.sort(key=len, reverse=True)
-
-        def extract_kdreams_info(val):
-            val = str(val).strip()
-            name = val
-            pref = ""
-            age = ""
-            period = ""
-            
-            # Pattern 0: User Specified Regex
-            user_regex = r'(?P<選手名>\S+\s*\S*)\s+(?P<府県>[^/]+)/(?P<年齢>\d+)/(?P<期別>\d+)'
-            match_user = re.search(user_regex, val)
-            if match_user:
-                name = match_user.group('選手名').strip()
-                pref = match_user.group('府県').strip()
-                age = match_user.group('年齢').strip()
-                period = match_user.group('期別').strip()
-                return name, pref, age, period
-
-            # Pattern 1: Name【Prefecture Period】
-            match_brackets = re.search(r'【(.*?)】', val)
-            if match_brackets:
-                info = match_brackets.group(1)
-                name = val.split('【')[0].strip()
-                
-                info = info.replace('　', '').replace(' ', '')
-                m_period = re.search(r'(\d+)期', info)
-                if m_period:
-                    period = m_period.group(1)
-                    info = info.replace(m_period.group(0), '')
-                
-                m_age = re.search(r'(\d+)歳', info)
-                if m_age:
-                    age = m_age.group(1)
-                    info = info.replace(m_age.group(0), '')
-                    
-                pref = info
-                return name, pref, age, period
-
-            # Pattern 2: Fallback
-            m_period = re.search(r'(\d+)期', val)
-            if m_period:
-                period = m_period.group(1)
-                val = val.replace(m_period.group(0), ' ')
-                
-            m_age = re.search(r'(\d+)歳', val)
-            if m_age:
-                age = m_age.group(1)
-                val = val.replace(m_age.group(0), ' ')
-            
-            val = val.replace('/', ' ').replace('　', ' ')
-            
-            val_norm = val.replace(' ', '')
-            found_pref = None
-            for p in prefs:
-                if val_norm.endswith(p):
-                    found_pref = p
-                    break
-            
-            if found_pref:
-                pref = found_pref
-                p_regex = r"\s*".join(list(found_pref)) + r"\s*$"
-                if re.search(p_regex, val):
-                     val = re.sub(p_regex, '', val)
-            
-            name = val.strip()
-            return name, pref, age, period
+        best_df['選手名'] = best_df['選手名'].astype(str).str.translate(_STRIP_SYMBOLS)
 
         # Apply extraction
-        extracted = best_df['選手名'].apply(extract_kdreams_info)
+        extracted = best_df['選手名'].map(extract_kdreams_info)
         
-        # Assign back to columns
-        best_df['選手名'] = extracted.apply(lambda x: x[0])
-        best_df['府県'] = extracted.apply(lambda x: x[1])
-        best_df['年齢'] = extracted.apply(lambda x: x[2])
-        best_df['期別'] = extracted.apply(lambda x: x[3])
+        # Assign back to columns (one DataFrame build instead of 4 lambda passes)
+        info_cols = ['選手名', '府県', '年齢', '期別']
+        best_df[info_cols] = pd.DataFrame(extracted.tolist(), index=best_df.index, columns=info_cols)
 
     # 5. Overwrite Line Column if Parsed from HTML Div (More Accurate)
     if 'lines_list' in meta and '車番' in best_df.columns:
-        # Create map: CarNum -> LineID (str 1,2,3)
-        # lines_list = [[1,2,3], [4,5], [6]]
-        car_line_map = {}
-        line_str_map = {} # Line String "123"
-        
-        for idx, grp in enumerate(meta['lines_list']):
-            line_id = str(idx + 1)
-            line_s = "".join(map(str, grp))
-            for car in grp:
-                car_line_map[car] = line_id
-                line_str_map[car] = line_s
-                
-        # Update DF
-        # best_df['ライン'] = ...
+        # CarNum -> Line String "123" (lines_list = [[1,2,3], [4,5], [6]])
         # Ensure CarNum is int
         try:
-            best_df['temp_car'] = best_df['車番'].astype(int)
-            best_df['ライン'] = best_df['temp_car'].map(line_str_map).fillna(best_df.get('ライン', ''))
-            # Also maybe we want LineID column? Logic usually uses 'ライン' as ID or String?
+            line_s = pd.Series(_line_str_by_car(meta['lines_list'], best_df['車番'].astype(int).to_numpy()), index=best_df.index)
+            best_df['ライン'] = line_s.fillna(best_df.get('ライン', ''))
             # logic_v2.calculate_ai_score uses "line_id = row['ライン']" or "line_str".
             # Actually db_utils.run_global_features parses 'ライン' column content (e.g. "123") to find length/pos.
             # So setting 'ライン' to the full string ie "123" is correct for `run_global_features`.
-            
-            del best_df['temp_car']
-            # print(f"DEBUG: Applied HTML Lines to DF: {line_str_map}")
         except: pass
 
     return best_df, meta
@@ -709,22 +906,197 @@ def parse_kdreams_simple(html_content):
 # 2. Betting Strategy Logic
 # ==========================================
 
+# Pseudo-EV: Assumed Payout based on experience: Teppan ~3x, Two Strong ~5x, Standard ~10x, Chaos ~20x
+_PAYOUT_MAP = {
+    "teppan": 3.0, "two_strong": 5.0, "standard": 10.0, "chaos": 20.0, "snipe": 30.0, "skip": 1.0,
+    "suji_fix": 2.5, "suji_lead": 6.0, "line_breaker": 25.0
+}
+_EV_THRESH = (0.5, 0.0) # 期待値◎ / 期待値○ の下限
+
+
+def _is_strict(race_class, line_counts, bank_len, bank_angle, partner_gap):
+    """
+    Strict Check for Geki-Atsu (ORIGINAL STRICT CONDITIONS).
+    Reverting to the exact logic that produced 80% hit rate.
+    """
+    # 1. S-Class: Strict (33 Bank + 3 lines + Small Gap)
+    if race_class == "S":
+        return len(line_counts) == 3 and bank_len in (333, 335) and partner_gap <= 5.0
+    # 2. A-Class: Strict (Long Straight + 3 lines + Small Gap)
+    if race_class == "A":
+        return len(line_counts) == 3 and bank_angle >= 50.0 and partner_gap <= 10.0
+    # 3. Challenge (A3): Just Gap
+    if race_class == "A3":
+        return partner_gap <= 10.0
+    return False
+
+# race_type -> (strategy_title, reason, confidence_level, recommended_points)
+_RACE_TYPE_LABELS = {
+    "star_makuri": ("🌟 圧倒的捲り (SS)", "圧倒的捲り選手による実力決着濃厚", "SS", {"3連単": 4, "2車単": 2}),
+    "star_nige_short": ("🏃 圧倒的逃げ [短] (S)", "短走路での圧倒的逃げ (押し切り濃厚)", "S", {"3連単": 3, "2車単": 1}),
+    "star_btop_short": ("🚀 B-Top [短] (A)", "短走路×Bトップ (ライン決着濃厚)", "A", {"3連単": 6, "2車単": 2}),
+    "teppan": ("🏰 鉄板銀行レース", "圧倒的本命 (1強) - 信頼度高", "高", {"3連単": 6, "2車単": 3}),  # Tight points
+    "two_strong": ("⚔️ 2強対決", "2強対決 (順当・折り返し推奨)", "高", {"3連単": 8, "2車単": 4}),
+    "chaos": ("💣 穴狙い・高配当", "大混戦 (オッズ割れ・穴狙い推奨)", "低", {"3連単": 18, "2車単": 9}),  # Wide points for chaos
+    "standard": ("⚖️ 標準", "中混戦 (軸選定が鍵)", "中", {"3連単": 12, "2車単": 6}),
+}
+
+
+# (race_type, is_strict) -> (strategy_title, reason format, confidence_level, recommended_points)
+# reason format: {0} = ライン構成, {1} = Gap
+_SUJI_TABLE = {
+    # Ensure 4 points for 3-Rentan
+    ("suji_fix", True): ("🔒 スジ一点勝負 🔥(激熱)", "鉄板スジ (構成:{0}, Gap:{1:.1f})", "極", {"3連単": 4, "2車単": 1}),
+    ("suji_fix", False): ("🔒 スジ一点勝負", "鉄板スジ (構成:{0}, Gap:{1:.1f})", "極", {"3連単": 4, "2車単": 1}),
+    ("suji_lead", True): ("🎯 スジ本線・堅実 🔥(激熱)", "有力スジ (構成:{0}, Gap:{1:.1f})", "高", {"3連単": 8, "2車単": 3}),
+    ("suji_lead", False): ("🎯 スジ本線・堅実", "有力スジ (構成:{0}, Gap:{1:.1f})", "高", {"3連単": 8, "2車単": 3}),
+    ("line_breaker", False): ("⚡ ラインブレイカー (別線狙い)", "スジ崩れ警戒 (構成:{0})", "低", {"3連単": 16, "2車単": 6}), # Wide net
+}
+_SUJI_RACE_TYPES = frozenset(k[0] for k in _SUJI_TABLE)
+
+
+def _classify_race(w1, w2, w3, bank_straight, race_class, line_counts, partner_gap,
+                   p1_is_dom_makuri, p1_is_dom_nige, p1_is_b_top, is_high_return_mode):
+    """
+    Race type classifier for generate_betting_strategy (スカラー値のみで判定).
+    """
+    # High Return Candidate (AI Rules)
+    if is_high_return_mode:
+        return "snipe"
+
+    # --- Logic V3: Star Bet (Focused Strategy) ---
+    # 1. Dominant Makuri (SS Grade)
+    if p1_is_dom_makuri:
+        return "star_makuri"
+    # 2. Dominant Nige (Short Bank) -> S Grade
+    if p1_is_dom_nige and bank_straight < 50.0:
+        return "star_nige_short"
+    # 3. B-Top (Short Bank) -> A Grade
+    if p1_is_b_top and bank_straight < 50.0:
+        return "star_btop_short"
+
+    # --- Suji Conditions ---
+    # [A] Teppan Suji (70%+)
+    # Cond: (A3 & 4-car-line) OR (A & 2-bunsen & Short)
+    # Safety: Gap <= 10
+    suji_mode = None # A, B, C or None
+    cond_a_1 = (race_class == "A3" and max(line_counts) >= 4) if line_counts else False
+    cond_a_2 = (race_class == "A" and len(line_counts) == 2 and bank_straight < 50.0)
+    
+    if (cond_a_1 or cond_a_2) and partner_gap <= 10.0:
+        suji_mode = "A"
+    else:
+        # [B] Suji Lead (60%+)
+        # SIMPLIFIED: Default to B if line exists and not Hosogire S-class
+        # Safety Valve Logic (S<=10, A<=15) applied here
+        if race_class == "S": is_valid_b = (partner_gap <= 10.0)
+        else: is_valid_b = (partner_gap <= 15.0)
+        if is_valid_b:
+            suji_mode = "B"
+            
+    # [C] Dangerous Suji (40%-)
+    # Cond: (S & 4-bunsen/Hosogire)
+    is_hosogire = (len(line_counts) >= 4)
+    if race_class == "S" and is_hosogire:
+        suji_mode = "C"
+    elif partner_gap > 20.0 and race_class == "S": # Safety Valve fail -> Chaos/C (Tightened from 25.0)
+        suji_mode = "C" # Gap too wide in S class often breaks line history
+
+    if suji_mode == "A":
+        return "suji_fix"
+    if suji_mode == "B":
+        return "suji_lead"
+    if suji_mode == "C":
+        return "line_breaker"
+
+    # --- Thresholds adjusted for normalized win rate scale ---
+    if w1 < 12.0:  # Below average = no clear favorite
+        return "skip"
+    # Stricter "Teppan" Definition (Fallback if no Suji Mode caught or Standard)
+    if w1 >= 30.0 and (w1 - w2) >= 10.0:
+        return "teppan"
+    if w1 >= 25.0 and w2 >= 20.0:
+        return "two_strong"
+    if (w1 - w3) < 5.0:
+        return "chaos"
+    return "standard"
+
+def _score_array(s):
+    # スコア列を float 配列に (None / NaN / 不正値は 0.0)
+    try:
+        return s.to_numpy(dtype=float, na_value=0.0)
+    except (TypeError, ValueError):
+        return pd.to_numeric(s, errors='coerce').to_numpy(dtype=float, na_value=0.0)
+
+def _resolve_score_col(pred_df, score_col):
+    # If score_col not in columns, fallback to 'final_score' -> 'ai_score' -> '予測勝率'
+    cols = set(pred_df.columns)
+    for cand in (score_col, 'final_score', 'ai_score', '予測勝率'):
+        if cand in cols:
+            return cand
+    return score_col
+
 def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝率'):
     """
     Generates betting strategy and tickets based on prediction dataframe.
     """
+    # Use data sorted by Win Rate (or score_col) for logic base
+    score_col = _resolve_score_col(pred_df, score_col)
+    # 使うのは上位5名のみ。同点は pred_df で先にある行を上位にする (batch 版と同じ)。
+    # 以前の既定 quicksort は不安定で、同点の並びが numpy のソート実装次第で変わっていた
+    col = pred_df[score_col]
+    if col.dtype.kind in 'iuf' and not col.hasnans:
+        df_logic = pred_df.nlargest(5, score_col).reset_index(drop=True)
+    else:
+        # nlargest は NaN 行を落とし、object 列は扱えないのでソートで代用
+        df_logic = pred_df.sort_values(score_col, ascending=False, kind='mergesort').head(5).reset_index(drop=True)
+    return _betting_strategy_sorted(pred_df, df_logic, ai_match_cars, score_col)
+
+def generate_betting_strategy_batch(pred_dfs, ai_match_cars_list=None, score_col='予測勝率'):
+    """
+    Batch version of generate_betting_strategy (複数レースを一括処理).
+    全レースのスコアを1本の長い frame にまとめて1回でソートし、
+    各レースの並び順を得てから買い目を作る。結果は pred_dfs と同じ順のリスト。
+    """
+    n = len(pred_dfs)
+    if n == 0:
+        return []
+    if ai_match_cars_list is None:
+        ai_match_cars_list = [None] * n
+    
+    cols = [_resolve_score_col(df, score_col) for df in pred_dfs]
+    lens = [len(df) for df in pred_dfs]
+    
+    # スコア列だけを連結する (車番などの dtype がレース間で混ざらないように)
+    order_df = pd.DataFrame({
+        '_race_id': np.repeat(np.arange(n), lens),
+        '_pos': np.concatenate([np.arange(k) for k in lens]),
+        '_score': pd.concat([df[c] for df, c in zip(pred_dfs, cols)], ignore_index=True),
+    })
+    try:
+        # 複数キーのソートは安定なので、同点は元の行順 (generate_betting_strategy と同じ)
+        order_df = order_df.sort_values(['_race_id', '_score'], ascending=[True, False])
+        orders = np.split(order_df['_pos'].to_numpy(), np.cumsum(lens)[:-1])
+    except TypeError:
+        # レースごとに型の違うスコア列 (文字列混在など) は個別にソート
+        orders = [None] * n
+    
+    results = []
+    for df, c, order, amc in zip(pred_dfs, cols, orders, ai_match_cars_list):
+        if order is None:
+            df_logic = df.sort_values(c, ascending=False, kind='mergesort').head(5).reset_index(drop=True)
+        else:
+            df_logic = df.iloc[order[:5]].reset_index(drop=True)
+        results.append(_betting_strategy_sorted(df, df_logic, amc, c))
+    return results
+
+def _betting_strategy_sorted(pred_df, df_logic, ai_match_cars, score_col):
+    """
+    generate_betting_strategy の本体。df_logic は score_col 降順の上位5名 (ソート済み)。
+    """
     if ai_match_cars is None:
         ai_match_cars = []
 
-    # Use data sorted by Win Rate (or score_col) for logic base
-    # If score_col not in columns, fallback to '予測勝率' or 'ai_score'
-    if score_col not in pred_df.columns:
-        if 'final_score' in pred_df.columns: score_col = 'final_score'
-        elif 'ai_score' in pred_df.columns: score_col = 'ai_score'
-        elif '予測勝率' in pred_df.columns: score_col = '予測勝率'
-        
-    df_logic = pred_df.sort_values(score_col, ascending=False).reset_index(drop=True)
-    
     if len(df_logic) < 3:
         return {
             "type": "error",
@@ -733,10 +1105,9 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
             "tickets": []
         }
 
-    # Top players
-    p1 = df_logic.iloc[0]
-    p2 = df_logic.iloc[1]
-    p3 = df_logic.iloc[2]
+    # Top players (上位5名は dict で一括取得し、以降は Series を介さない)
+    top_recs = df_logic.head(5).to_dict('records')
+    p1, p2, p3, p4, p5 = top_recs + [None] * (5 - len(top_recs))
     
     # Normalize score to 0-100 scale roughly if it's raw score
     # But usually this logic expects Win Rate %.
@@ -751,27 +1122,12 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
     # w1 >= 45.0 is True. -> Teppan.
     # This might be acceptable for now as Antigravity Score is high.
     
-    w1_raw = p1.get(score_col)
-    w2_raw = p2.get(score_col)
-    w3_raw = p3.get(score_col)
-    
-    # Safe conversion to float (handle None, NaN, and string values)
-    def safe_float(v):
-        if v is None:
-            return 0.0
-        try:
-            return float(v)
-        except (ValueError, TypeError):
-            return 0.0
-    
-    w1_raw = safe_float(w1_raw)
-    w2_raw = safe_float(w2_raw)
-    w3_raw = safe_float(w3_raw)
+    scores = _score_array(df_logic[score_col])
+    w1_raw, w2_raw, w3_raw = float(scores[0]), float(scores[1]), float(scores[2])
     
     # Normalize to percentage if scores are not already percentages (e.g., raw scores > 50)
-    total_score = df_logic[score_col].sum()
-    if total_score is None or pd.isna(total_score):
-        total_score = 0
+    # (df_logic は上位5名のみなので、合計は全選手から取る)
+    total_score = float(_score_array(pred_df[score_col]).sum())
     if total_score > 0 and w1_raw > 50:  # Likely raw scores, not percentages
         w1 = (w1_raw / total_score) * 100
         w2 = (w2_raw / total_score) * 100
@@ -779,77 +1135,28 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
     else:
         w1, w2, w3 = w1_raw, w2_raw, w3_raw
     
-    c1 = p1['車番']
-    c2 = p2['車番']
-    c3 = p3['車番']
+    # 車番はここで1回だけ int 化し、以降は int のまま比較・出力する
+    c1 = int(p1['車番'])
+    c2 = int(p2['車番'])
+    c3 = int(p3['車番'])
     
     # Others
-    c4 = df_logic.iloc[3]['車番'] if len(df_logic) > 3 else None
-    c5 = df_logic.iloc[4]['車番'] if len(df_logic) > 4 else None
+    c4 = int(p4['車番']) if p4 is not None else None
+    c5 = int(p5['車番']) if p5 is not None else None
     
     # --- Classification Logic ---
-    race_type = "standard"
-    reason = ""
-    strategy_title = "バランス型"
-    
     # Check High Return Candidate (AI Rules)
-    is_high_return_mode = False
-    target_hole_cars = sorted(list(set(ai_match_cars))) if ai_match_cars else []
-    
-    if target_hole_cars:
-        top_car = int(c1)
-        if any(int(tc) != top_car for tc in target_hole_cars):
-            is_high_return_mode = True
-            race_type = "snipe"
-            reason = f"高回収率パターン該当車あり ({','.join(map(str, target_hole_cars))})"
-            strategy_title = "💰 一撃回収狙い"
-
-    place_name = pred_df['競輪場'].iloc[0] if '競輪場' in pred_df.columns else ""
-    bank_specs = db_utils.VELODROME_SPECS.get(place_name, (400, 30, 400)) # Default 400
-    bank_len = bank_specs[2]
-    bank_straight = bank_specs[0]
+    target_hole_cars = sorted({int(x) for x in ai_match_cars}) if ai_match_cars else []
+    is_high_return_mode = any(tc != c1 for tc in target_hole_cars)
 
-    # --- Logic V3: Star Bet (Focused Strategy) ---
-    is_star_bet = False
-    
-    # Check Flags on P1
-    p1_is_dom_makuri = p1.get('is_dom_makuri', False)
-    p1_is_dom_nige = p1.get('is_dom_nige', False)
-    p1_is_b_top = p1.get('is_b_top', False)
-    
-    if not is_high_return_mode:
-        # 1. Dominant Makuri (SS Grade)
-        if p1_is_dom_makuri:
-            is_star_bet = True
-            race_type = "star_makuri"
-            strategy_title = "🌟 圧倒的捲り (SS)"
-            reason = "圧倒的捲り選手による実力決着濃厚"
-            confidence_level = "SS"
-            recommended_points = {"3連単": 4, "2車単": 2}
-            
-        # 2. Dominant Nige (Short Bank) -> S Grade
-        elif p1_is_dom_nige and bank_straight < 50.0:
-            is_star_bet = True
-            race_type = "star_nige_short"
-            strategy_title = "🏃 圧倒的逃げ [短] (S)"
-            reason = "短走路での圧倒的逃げ (押し切り濃厚)"
-            confidence_level = "S"
-            recommended_points = {"3連単": 3, "2車単": 1}
-            
-        # 3. B-Top (Short Bank) -> A Grade
-        elif p1_is_b_top and bank_straight < 50.0:
-            is_star_bet = True
-            race_type = "star_btop_short"
-            strategy_title = "🚀 B-Top [短] (A)"
-            reason = "短走路×Bトップ (ライン決着濃厚)"
-            confidence_level = "A"
-            recommended_points = {"3連単": 6, "2車単": 2}
+    place_name = pred_df['競輪場'].iat[0] if '競輪場' in pred_df.columns else ""
+    bank_specs = db_utils.VELODROME_SPECS.get(place_name, (400, 30, 400)) # Default 400
+    try:
+        bank_straight, bank_angle, bank_len = bank_specs
+    except (TypeError, ValueError):
+        bank_straight, bank_angle, bank_len = 400, 30, 400
 
-    diff_1_2 = w1 - w2
-    
     # --- NEW LOGIC: Suji & Line Analysis ---
-    suji_mode = None # A, B, C or None
-    
     # 1. Parse Line Config (e.g. "3-3-1")
     line_counts = []
     line_config_str = "不明"
@@ -857,20 +1164,19 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
         # Group by Line Content/ID
         # 'ライン' col contains "123" or similar
         # Get unique line strings (careful of empty or default)
-        valid_lines = pred_df[pred_df['ライン'].astype(str).str.len() > 0]['ライン'].unique()
-        # Filter out lines that seem to be just single "0" or empty
-        valid_lines = [l for l in valid_lines if l not in ["0", ""] and len(str(l)) > 0]
+        # Filter out lines that seem to be just single "0" or empty / NaN
+        valid_lines = {l for l in pred_df['ライン'].to_numpy()
+                       if l is not None and l == l and l not in ["0", ""]}
         
         # Calculate lengths
-        lengths = [len(str(l)) for l in valid_lines]
-        lengths.sort(reverse=True)
+        lengths = sorted((len(str(l)) for l in valid_lines), reverse=True)
         line_counts = lengths
         line_config_str = "-".join(map(str, lengths))
     
     # 2. Get Race Class & Specs
     race_class = "A" # Default
     if '級班' in pred_df.columns:
-        classes = pred_df['級班'].astype(str).unique()
+        classes = {str(c) for c in pred_df['級班'].to_numpy()}
         if any('S' in c for c in classes): race_class = "S"
         elif any('A3' in c for c in classes): race_class = "A3"
     
@@ -880,191 +1186,96 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
     p1_base_score = p1.get('base_score', 80.0)
     
     partner_gap = 999.0
-    p1_partner = None
+    partner_car = c2 # 同ラインの相方 (不在なら2番手)
+    
+    # ライン値 -> 選手行 (1回の走査でグループ化、NaN は除外)
+    line_to_rows = {}
+    for r in pred_df.to_dict('records'):
+        lv = r.get('ライン')
+        if lv is None or lv != lv:
+            continue
+        line_to_rows.setdefault(lv, []).append(r)
     
     if p1_line_val and str(p1_line_val) not in ["0", ""]:
-        # Find others in same line
-        same_line_df = pred_df[pred_df['ライン'] == p1_line_val]
-        others = same_line_df[same_line_df['車番'] != c1]
+        # Find others in same line (c1 は int 化済みなので、元の値同士で比べる: 車番 が str でも一致する)
+        p1_car_raw = p1['車番']
+        others = [r for r in line_to_rows.get(p1_line_val, []) if r['車番'] != p1_car_raw]
         
-        if not others.empty:
+        if others:
             # Assume strongest partner is the "Suji" target
-            # Sort by score
-            others_sorted = others.sort_values(by='base_score', ascending=False)
-            best_partner = others_sorted.iloc[0]
-            p1_partner = best_partner
+            # Highest base_score (同点は元の並び順で先の選手、NaN は sort_values と同じく最下位)
+            best_partner = max(others, key=lambda r: -np.inf if pd.isna(v := r.get('base_score', 80.0)) else v)
+            partner_car = int(best_partner['車番'])
             p_score = best_partner.get('base_score', 80.0)
             partner_gap = abs(p1_base_score - p_score)
     
-    # 4. Evaluate Suji Conditions
-    # Only if not High Return Mode
-    if not is_high_return_mode:
+    # 4. Classify (Star Bet / Suji / Win-rate thresholds)
+    race_type = _classify_race(
+        w1, w2, w3, bank_straight, race_class, line_counts, partner_gap,
+        p1.get('is_dom_makuri', False), p1.get('is_dom_nige', False), p1.get('is_b_top', False),
+        is_high_return_mode)
+
+    if race_type == "snipe":
+        reason = f"高回収率パターン該当車あり ({','.join(map(str, target_hole_cars))})"
+        strategy_title = "💰 一撃回収狙い"
+        confidence_level = "低"
+        # 3連単は 穴1頭固定 → 上位2名 → 上位3名 のフォーメーション、2車単は共通の本命 → 2〜4位
+        recommended_points = {"3連単": 4, "2車単": 3}
+        
+    elif race_type == "skip":
+        # 見送りは買い目を作らないので、ここで返す
+        return {
+            "type": "skip",
+            "title": "🛑 見送り",
+            "reason": "絶対的本命不在 (見送り推奨)",
+            "tickets": [],
+            "structured_bets": [],
+            "top_win_rate": w1,
+            "top_name": p1['選手名'],
+            "confidence_level": "-",
+            "recommended_points": {},
+            "pseudo_ev": -1.0,
+            "ev_comment": "見送り"
+        }
         
-        # [A] Teppan Suji (70%+)
-        # Cond: (A3 & 4-car-line) OR (A & 2-bunsen & Short)
-        # Safety: Gap <= 10
-        cond_a_1 = (race_class == "A3" and max(line_counts) >= 4) if line_counts else False
-        cond_a_2 = (race_class == "A" and len(line_counts) == 2 and bank_straight < 50.0)
+    elif race_type in _SUJI_RACE_TYPES:
+        is_strict = race_type != "line_breaker" and _is_strict(race_class, line_counts, bank_len, bank_angle, partner_gap)
+        strategy_title, reason_fmt, confidence_level, points = _SUJI_TABLE[(race_type, is_strict)]
+        reason = reason_fmt.format(line_config_str, partner_gap)
+        recommended_points = dict(points)
         
-        if (cond_a_1 or cond_a_2) and partner_gap <= 10.0:
-            suji_mode = "A"
-            
-        # [B] High Prob Suji (60%+)
-        # Cond: (A3) OR (A & 3-bunsen & Long) OR (S & 3-bunsen & 33Bank)
-        # [B] Suji Lead (60%+)
-        # SIMPLIFIED: Default to B if line exists and not Hosogire S-class
-        if not suji_mode: # Only check B if A wasn't triggered
-            cond_b_1 = True # Default
-            
-            is_valid_b = False
-            if cond_b_1:
-                 # Safety Valve Logic (S<=10, A<=15) applied here
-                 if race_class == "S": is_valid_b = (partner_gap <= 10.0)
-                 else: is_valid_b = (partner_gap <= 15.0)
-                 
-            if is_valid_b:
-                suji_mode = "B"
-                
-        # [C] Dangerous Suji (40%-)
-        # Cond: (S & 4-bunsen/Hosogire)
-        is_hosogire = (len(line_counts) >= 4)
-        cond_c_1 = (race_class == "S" and is_hosogire)
-        
-        if cond_c_1:
-            suji_mode = "C"
-        elif partner_gap > 20.0 and race_class == "S": # Safety Valve fail -> Chaos/C (Tightened from 25.0)
-             suji_mode = "C" # Gap too wide in S class often breaks line history
-             
-    # --- Thresholds adjusted for normalized win rate scale ---
-    if not is_high_return_mode and not is_star_bet:
-        if suji_mode == "A":
-            race_type = "suji_fix"
-            reason = f"鉄板スジ (構成:{line_config_str}, Gap:{partner_gap:.1f})"
-            # Strict Check for Geki-Atsu (ORIGINAL STRICT CONDITIONS)
-            # Reverting to the exact logic that produced 80% hit rate.
-            is_strict = False
-            
-            # 1. S-Class: Strict (33 Bank + 3 lines + Small Gap)
-            if race_class == "S":
-                if len(line_counts) == 3 and bank_len in [333, 335] and partner_gap <= 5.0:
-                    is_strict = True
-                    
-            # 2. A-Class: Strict (Long Straight + 3 lines + Small Gap)
-            elif race_class == "A":
-                bs = bank_specs[1] if isinstance(bank_specs, (list, tuple)) and len(bank_specs) > 1 else 30.0
-                if len(line_counts) == 3 and bs >= 50.0 and partner_gap <= 10.0:
-                    is_strict = True
-                    
-            # 3. Challenge (A3): Just Gap
-            elif race_class == "A3":
-                if partner_gap <= 10.0:
-                    is_strict = True
-            
-            suffix = " 🔥(激熱)" if is_strict else ""
-            
-            strategy_title = f"🔒 スジ一点勝負{suffix}"
-            confidence_level = "極"
-            # Ensure 4 points for 3-Rentan
-            recommended_points = {"3連単": 4, "2車単": 1}
-            
-        elif suji_mode == "B":
-            race_type = "suji_lead"
-            reason = f"有力スジ (構成:{line_config_str}, Gap:{partner_gap:.1f})"
-            
-            # Strict Check for Geki-Atsu (ORIGINAL STRICT CONDITIONS)
-            is_strict = False
-            
-            if race_class == "S":
-                if len(line_counts) == 3 and bank_len in [333, 335] and partner_gap <= 5.0:
-                    is_strict = True
-            elif race_class == "A":
-                bs = bank_specs[1] if isinstance(bank_specs, (list, tuple)) and len(bank_specs) > 1 else 30.0
-                if len(line_counts) == 3 and bs >= 50.0 and partner_gap <= 10.0:
-                    is_strict = True
-            elif race_class == "A3":
-                if partner_gap <= 10.0:
-                    is_strict = True
-            
-            suffix = " 🔥(激熱)" if is_strict else ""
-            
-            strategy_title = f"🎯 スジ本線・堅実{suffix}"
-            confidence_level = "高"
-            recommended_points = {"3連単": 8, "2車単": 3}
-            
-        elif suji_mode == "C":
-            race_type = "line_breaker"
-            reason = f"スジ崩れ警戒 (構成:{line_config_str})"
-            strategy_title = "⚡ ラインブレイカー (別線狙い)"
-            confidence_level = "低"
-            recommended_points = {"3連単": 16, "2車単": 6} # Wide net
-            
-        elif w1 < 12.0:  # Below average = no clear favorite
-            race_type = "skip"
-            reason = "絶対的本命不在 (見送り推奨)"
-            strategy_title = "🛑 見送り"
-            
-        # 1. Stricter "Teppan" Definition (Fallback if no Suji Mode caught or Standard)
-        elif w1 >= 30.0 and diff_1_2 >= 10.0:
-            is_teppan = True
-            race_type = "teppan"
-            reason = "圧倒的本命 (1強) - 信頼度高"
-            strategy_title = "🏰 鉄板銀行レース"
-            confidence_level = "高"
-            recommended_points = {"3連単": 6, "2車単": 3}  # Tight points
-        elif w1 >= 25.0 and w2 >= 20.0:
-            race_type = "two_strong"
-            reason = "2強対決 (順当・折り返し推奨)"
-            strategy_title = "⚔️ 2強対決"
-            confidence_level = "高"
-            recommended_points = {"3連単": 8, "2車単": 4}
-        elif (w1 - w3) < 5.0:
-            race_type = "chaos"
-            reason = "大混戦 (オッズ割れ・穴狙い推奨)"
-            strategy_title = "💣 穴狙い・高配当"
-            confidence_level = "低"
-            recommended_points = {"3連単": 18, "2車単": 9}  # Wide points for chaos
-        else:
-            race_type = "standard"
-            reason = "中混戦 (軸選定が鍵)"
-            strategy_title = "⚖️ 標準"
-            confidence_level = "中"
-            recommended_points = {"3連単": 12, "2車単": 6}
+    else:
+        strategy_title, reason, confidence_level, points = _RACE_TYPE_LABELS[race_type]
+        recommended_points = dict(points)
 
     # --- Pseudo-EV Calculation ---
     # Without live odds, use AI win rate as probability proxy
     # EV = (Win Rate / 100) * Assumed_Payout - 1
-    # Assumed Payout based on experience: Teppan ~3x, Two Strong ~5x, Standard ~10x, Chaos ~20x
-    payout_map = {
-        "teppan": 3.0, "two_strong": 5.0, "standard": 10.0, "chaos": 20.0, "snipe": 30.0, "skip": 1.0,
-        "suji_fix": 2.5, "suji_lead": 6.0, "line_breaker": 25.0 
-    }
-    assumed_payout = payout_map.get(race_type, 10.0)
+    assumed_payout = _PAYOUT_MAP.get(race_type, 10.0)
     pseudo_ev = (w1 / 100.0) * assumed_payout - 1.0
     
     # EV-based recommendation
     ev_comment = ""
-    if pseudo_ev >= 0.5:
+    if pseudo_ev >= _EV_THRESH[0]:
         ev_comment = "期待値◎ (積極的に買える)"
-    elif pseudo_ev >= 0.0:
+    elif pseudo_ev >= _EV_THRESH[1]:
         ev_comment = "期待値○ (標準)"
     else:
         ev_comment = "期待値△ (点数を絞るか見送り推奨)"
 
-    # --- Ticket Generation ---
     # --- Ticket Generation ---
     rec_tickets = []
     structured_bets = []
+    # 買い目文字列用に車番を1回だけ文字列化
+    sc1, sc2, sc3, sc4 = str(c1), str(c2), str(c3), str(c4)
     
     # 2車単: Logic Moved to End to allow deduplication
 
-    if race_type == "skip":
-        pass 
-        
-    elif race_type == "star_makuri":
+    if race_type == "star_makuri":
         # Strategy: p1 (Makuri) -> p2, p3 (Formation)
         # Trust p1 completely for 1st.
-        rec_tickets.append(f"3連単: {c1} → {c2},{c3} → {c2},{c3},{c4}")
-        rec_tickets.append(f"2車単: {c1} → {c2},{c3}")
+        rec_tickets.append(f"3連単: {sc1} → {sc2},{sc3} → {sc2},{sc3},{sc4}")
+        rec_tickets.append(f"2車単: {sc1} → {sc2},{sc3}")
         # rec_tickets.append(f"3連複: {c1} - {c2} - {c3},{c4}") # Removed for Focus
         
         # Structure
@@ -1073,14 +1284,14 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
         
     elif race_type == "star_nige_short":
         # Strategy: p1 (Nige) -> Partner (One-Two)
-        pt = int(p1_partner['車番']) if p1_partner is not None else int(c2)
+        pt = partner_car
         
         # Clean list candidates
-        th_cands = [x for x in [c2,c3,c4] if int(x) != int(c1) and int(x) != pt]
+        th_cands = [x for x in [c2,c3,c4] if x is not None and x != c1 and x != pt]
         th_str = ",".join(map(str, th_cands)) if th_cands else "全"
         
-        rec_tickets.append(f"3連単: {c1} → {pt} → {th_str}")
-        rec_tickets.append(f"2車単: {c1} → {pt} (1点)")
+        rec_tickets.append(f"3連単: {sc1} → {pt} → {th_str}")
+        rec_tickets.append(f"2車単: {sc1} → {pt} (1点)")
         
         # Structure
         structured_bets.append({'type': '3連単', '1': [c1], '2': [pt], '3': th_cands})
@@ -1088,12 +1299,12 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
         
     elif race_type == "star_btop_short":
         # Strategy: p1 (B-Top) = Partner (Folding/Zubuzubu cover)
-        pt = int(p1_partner['車番']) if p1_partner is not None else int(c2)
-        th_cands = [x for x in [c2,c3,c4] if int(x) != int(c1) and int(x) != int(pt)]
+        pt = partner_car
+        th_cands = [x for x in [c2,c3,c4] if x is not None and x != c1 and x != pt]
         th_str = ",".join(map(str, th_cands))
         
-        rec_tickets.append(f"3連単: {c1} ↔ {pt} → {th_str}")
-        rec_tickets.append(f"2車単: {c1} ↔ {pt}")
+        rec_tickets.append(f"3連単: {sc1} ↔ {pt} → {th_str}")
+        rec_tickets.append(f"2車単: {sc1} ↔ {pt}")
         
         # Structure
         structured_bets.append({'type': '3連単', '1': [c1, pt], '2': [c1, pt], '3': th_cands})
@@ -1102,7 +1313,7 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
     elif race_type == "snipe":
         # High Return / Specific Hole cars
         tc = target_hole_cars[0] if target_hole_cars else c3
-        rec_tickets.append(f"3連単 (フォーメーション): {tc} - {c1},{c2} - {c1},{c2},{c3}")
+        rec_tickets.append(f"3連単 (フォーメーション): {tc} - {sc1},{sc2} - {sc1},{sc2},{sc3}")
         # rec_tickets.append(f"3連複: {tc} - {c1} - {c2},{c3}") # Removed
         
         if len(target_hole_cars) == 1:
@@ -1117,32 +1328,32 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
 
     elif race_type == "suji_fix":
         # A: Suji Fix
-        pt = int(p1_partner['車番']) if p1_partner is not None else int(c2)
+        pt = partner_car
         
         # 3rd candidates: c2, c3, c4 (excluding c1, pt)
-        others = [x for x in [c2, c3, c4] if int(x) != int(c1) and int(x) != pt]
+        others = [x for x in [c2, c3, c4] if x is not None and x != c1 and x != pt]
         s_3rd_real = ",".join(map(str, others))
         
         if s_3rd_real:
-            rec_tickets.append(f"3連単: {c1} → {pt} → {s_3rd_real}")
+            rec_tickets.append(f"3連単: {sc1} → {pt} → {s_3rd_real}")
         else:
-            rec_tickets.append(f"3連単: {c1} → {pt} → 全") # Fallback
+            rec_tickets.append(f"3連単: {sc1} → {pt} → 全") # Fallback
             
         # rec_tickets.append(f"3連複: {c1} - {pt} - {s_3rd_real}") # Removed
         # Standardized 2T is added at end? No, logic moved
 
     elif race_type == "suji_lead":
         # B: Suji Lead
-        pt = int(p1_partner['車番']) if p1_partner is not None else int(c2)
-        other_heads = [x for x in [c2, c3] if int(x) != int(c1) and int(x) != pt] # Simplified
+        pt = partner_car
+        other_heads = [x for x in [c2, c3] if x != c1 and x != pt] # Simplified
         s_2nd = ",".join(map(str, [pt] + other_heads))
         
-        rec_tickets.append(f"3連単 (フォーメーション): {c1} → {s_2nd} → {s_2nd},{c4}")
+        rec_tickets.append(f"3連単 (フォーメーション): {sc1} → {s_2nd} → {s_2nd},{sc4}")
         # rec_tickets.append(f"3連複: {c1} - {pt} - {c3},{c4}") # Removed
 
     elif race_type == "line_breaker":
         # C: Line Breaker
-        targets = [x for x in [c2, c3, c4] if int(x) != int(c1)]
+        targets = [x for x in [c2, c3, c4] if x is not None and x != c1]
         if not targets: targets = [c2, c3]
         s_targets = ",".join(map(str, targets))
         
@@ -1150,14 +1361,14 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
         # rec_tickets.append(f"ワイド: {c1} = {s_targets}") # Removed
         
         # Alternative: Just recommend Skip or Wide? User dislikes wide.
-        rec_tickets.append(f"3連単 (Box): {c1},{c2},{c3}")
+        rec_tickets.append(f"3連単 (Box): {sc1},{sc2},{sc3}")
 
     elif race_type == "teppan":
         # Ironclad
         third_row = [x for x in [c2, c3, c4] if x and x != c2]
         s_3rd = ",".join(map(str, third_row))
         
-        rec_tickets.append(f"3連単 (フォーメーション): {c1} - {c2},{c3} - {s_3rd}")
+        rec_tickets.append(f"3連単 (フォーメーション): {sc1} - {sc2},{sc3} - {s_3rd}")
         # rec_tickets.append(f"3連複: {c1} - {c2} - {c3},{c4}") # Removed
         
         second_row = [x for x in [c2, c3] if x]
@@ -1166,7 +1377,7 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
 
     elif race_type == "two_strong":
         # c1 and c2 are strong. Fold (Ura-Omote).
-        rec_tickets.append(f"3連単 (2軸): {c1} = {c2} - {c3},{c4}")
+        rec_tickets.append(f"3連単 (2軸): {sc1} = {sc2} - {sc3},{sc4}")
         # rec_tickets.append(f"3連複: {c1} - {c2} - {c3},{c4}") # Removed
         
         structured_bets.append({'type': '3rentan_fold', '1st': [c1, c2], '2nd': [c1, c2], '3rd': [c3, c4] if c4 else [c3]})
@@ -1178,7 +1389,7 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
         # flow_list = [x for x in [c2, c3, c4] if x] # For Wide
         # flow_str = ",".join(map(str, flow_list))
         
-        rec_tickets.append(f"3連単 (フォーメーション): {c1},{c2} - {c1},{c2},{c3} - {third_str}")
+        rec_tickets.append(f"3連単 (フォーメーション): {sc1},{sc2} - {sc1},{sc2},{sc3} - {third_str}")
         # rec_tickets.append(f"3連複: {c1} - {c2},{c3} - {third_str}") # Removed
         # rec_tickets.append(f"ワイド: {c1} = {flow_str}") # Removed
         
@@ -1191,7 +1402,7 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
         w_flow = [x for x in [c3, c4] if x]
         w_flow_str = ",".join(map(str, w_flow))
         
-        rec_tickets.append(f"3連単 (フォーメーション): {c1} - {c2},{c3} - {s_3rd}")
+        rec_tickets.append(f"3連単 (フォーメーション): {sc1} - {sc2},{sc3} - {s_3rd}")
         # rec_tickets.append(f"3連複: {c1} - {c2} - {s_3rd}") # Removed
         # if w_flow:
             # rec_tickets.append(f"ワイド: {c1} = {w_flow_str}") # Removed
@@ -1205,67 +1416,23 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
     # Identify what is already covered
     covered_2t_pairs = set()
     
-    # helper to expand simple range strings "1,2,3" -> [1,2,3]
-    import re
-    def _parse_cars(s):
-        parts = s.split(',')
-        res = []
-        for p in parts:
-            # Extract first number sequence (Car Number)
-            # e.g. "5 (1点)" -> 5
-            nums = re.findall(r'(\d+)', p)
-            if nums:
-                try: res.append(int(nums[0]))
-                except: pass
-        return res
+    # 2車単 の構造化ベット ('1' → '2') から直接求める
+    # (折り返しは '1' と '2' に両方の車番が入っている)
+    for b in structured_bets:
+        if b.get('type') == '2車単':
+            for x in b['1']:
+                for y in b['2']:
+                    covered_2t_pairs.add((x, y))
 
-
-    for t in rec_tickets:
-        if "2車単" in t:
-            body = t.split(':')[-1].strip()
-            if '↔' in body: # Fold
-                parts = body.split('↔')
-                if len(parts) >= 2:
-                    gSet1, gSet2 = _parse_cars(parts[0]), _parse_cars(parts[1])
-                    for x in gSet1:
-                        for y in gSet2:
-                            covered_2t_pairs.add((x, y))
-                            covered_2t_pairs.add((y, x))
-            elif '→' in body: # Direct
-                parts = body.split('→')
-                if len(parts) >= 2:
-                    gHead, gTail = _parse_cars(parts[0]), _parse_cars(parts[1])
-                    for x in gHead:
-                        for y in gTail:
-                            covered_2t_pairs.add((x, y))
-            elif '=' in body: # Same as fold
-                parts = body.split('=')
-                if len(parts) >= 2:
-                    gSet1, gSet2 = _parse_cars(parts[0]), _parse_cars(parts[1])
-                    for x in gSet1:
-                        for y in gSet2:
-                            covered_2t_pairs.add((x, y))
-                            covered_2t_pairs.add((y, x))
-                            
     # Generate Base 2T: Rank 1 -> Rank 2,3,4
     # But only allow (c1, x) if not in covered_2t_pairs
     base_flow_full = [x for x in [c2, c3, c4] if x]
-    base_flow_dedup = []
-    
-    for cand in base_flow_full:
-        try:
-            cand_int = int(cand)
-            c1_int = int(c1)
-            if (c1_int, cand_int) not in covered_2t_pairs:
-                base_flow_dedup.append(cand)
-        except:
-             # Fallback if non-int
-             base_flow_dedup.append(cand)
+    base_flow_dedup = [x for x in base_flow_full if (c1, x) not in covered_2t_pairs]
 
     if base_flow_dedup:
         flow_str_2t = ",".join(map(str, base_flow_dedup))
         # Insert at 0 so it appears first (Base)
-        rec_tickets.insert(0, f"2車単: {c1} → {flow_str_2t}")
+        rec_tickets.insert(0, f"2車単: {sc1} → {flow_str_2t}")
 
     return {
         "type": race_type,
@@ -1285,10 +1452,11 @@ def generate_betting_strategy(pred_df, ai_match_cars=None, score_col='予測勝
 # 2b. Special Bonus Strategy (特注予想)
 # ==========================================
 
-def generate_bonus_strategy(pred_df, score_col='ai_score'):
+def generate_bonus_strategy(pred_df, score_col='ai_score', precomputed_bonus=None):
     """
     Generates a SPECIAL betting strategy based on the player with the HIGHEST BONUS.
     This is different from the main strategy which uses highest final score.
+    precomputed_bonus: 呼び出し側で計算済みの加点配列 (pred_df の行順)。指定時は再計算しない。
     """
     if pred_df is None or pred_df.empty:
         return {
@@ -1299,12 +1467,14 @@ def generate_bonus_strategy(pred_df, score_col='ai_score'):
             "strategy_type": "special_bonus"
         }
     
-    df = pred_df.copy()
-    
-    # Calculate bonus if not already present
-    if 'bonus' not in df.columns:
-        if 'ai_score' in df.columns and 'base_score' in df.columns:
-            df['bonus'] = df['ai_score'] - df['base_score']
+    # Calculate bonus if not already present (frame は複製せず配列で計算)
+    if precomputed_bonus is not None:
+        bonus = np.asarray(precomputed_bonus, dtype=float)
+    elif 'bonus' in pred_df.columns:
+        bonus = pd.to_numeric(pred_df['bonus'], errors='coerce').to_numpy(dtype=float)
+    else:
+        if 'ai_score' in pred_df.columns and 'base_score' in pred_df.columns:
+            bonus = (pred_df['ai_score'] - pred_df['base_score']).to_numpy(dtype=float, na_value=np.nan)
         else:
             return {
                 "type": "error",
@@ -1315,8 +1485,7 @@ def generate_bonus_strategy(pred_df, score_col='ai_score'):
             }
     
     # Find max bonus player
-    max_bonus = df['bonus'].max()
-    if pd.isna(max_bonus) or max_bonus <= 0:
+    if np.isnan(bonus).all() or np.nanmax(bonus) <= 0:
         return {
             "type": "skip",
             "title": "特注なし",
@@ -1325,25 +1494,21 @@ def generate_bonus_strategy(pred_df, score_col='ai_score'):
             "strategy_type": "special_bonus"
         }
     
-    # Sort by bonus descending
-    df_bonus = df.sort_values('bonus', ascending=False).reset_index(drop=True)
+    # Top bonus player is the AXIS (同点は先頭の選手)
+    axis_idx = int(np.nanargmax(bonus))
+    cars = pred_df['車番'].tolist()
+    c_axis = cars[axis_idx]
+    bonus_val = float(bonus[axis_idx])
+    axis_name = pred_df['選手名'].iat[axis_idx] if '選手名' in pred_df.columns else '不明'
     
-    # Top bonus player is the AXIS
-    p_axis = df_bonus.iloc[0]
-    c_axis = p_axis['車番']
-    bonus_val = p_axis['bonus']
-    axis_name = p_axis.get('選手名', '不明')
-    
-    # Get secondary players (by ai_score for flow)
-    df_score = df.sort_values(score_col, ascending=False).reset_index(drop=True)
+    # Get secondary players (by ai_score for flow): score 降順 (NaN は最後)
+    try:
+        order_score = np.argsort(-pred_df[score_col].to_numpy(dtype=float, na_value=np.nan), kind='stable')
+    except (TypeError, ValueError):
+        order_score = np.argsort(-pd.to_numeric(pred_df[score_col], errors='coerce').to_numpy(dtype=float), kind='stable')
     
     # Get top 4 by score (excluding axis if present)
-    flow_candidates = []
-    for idx, row in df_score.iterrows():
-        if row['車番'] != c_axis:
-            flow_candidates.append(row['車番'])
-        if len(flow_candidates) >= 4:
-            break
+    flow_candidates = [cars[i] for i in order_score if cars[i] != c_axis][:4]
     
     c2 = flow_candidates[0] if len(flow_candidates) > 0 else None
     c3 = flow_candidates[1] if len(flow_candidates) > 1 else None
@@ -1397,6 +1562,78 @@ def generate_bonus_strategy(pred_df, score_col='ai_score'):
 # 2c. Hybrid Strategy (ハイブリッド予想)
 # ==========================================
 
+# 333/335 バンク (短走路)
+_SHORT_BANKS = frozenset(("松戸", "小田原", "伊東", "富山", "奈良", "防府", "前橋"))
+
+def _class_flags(race_class):
+    # (S級, A級, チャレンジ) の部分一致フラグ。'A級チャレンジ' は A級/チャレンジ 両方が立つ
+    return 'S級' in race_class, 'A級' in race_class, 'チャレンジ' in race_class
+
+def _grade_has_l(grades):
+    # 級班 に L (L級 = ガールズ) を含む選手がいるか (1レース数行なので Python の any で最初の一致で抜ける)
+    return any('L' in str(g) for g in grades.tolist())
+
+def _is_girls(pred_df):
+    # Girls Keirin 判定 (class_code / 級班 / クラス のいずれか、見つかった時点で打ち切り)
+    cols = pred_df.columns
+    return (('class_code' in cols and any(v == 'L' for v in pred_df['class_code'].tolist()))
+            or ('級班' in cols and _grade_has_l(pred_df['級班']))
+            or ('クラス' in cols and any('ガールズ' in str(v) for v in pred_df['クラス'].tolist())))
+
+def _first_max(vals):
+    # 最大値の位置 (同点は先頭、NaN は無視、全て NaN なら 0)
+    return 0 if np.isnan(vals).all() else int(np.nanargmax(vals))
+
+def _hybrid_decide(s1, partner_score, n_lines, max_line_len, is_s, is_a, is_chal, is_short):
+    """
+    generate_hybrid_strategy の Fix / Lead / Ana 判定 (スカラー値のみ)。
+    Returns (mode, gap, valved_reason)。mode は 'fix' / 'lead' / 'ana'、相方不在なら gap は None。
+    """
+    is_suji_fix = False
+    
+    # Condition A (Fix)
+    if is_chal:
+        if max_line_len >= 4: is_suji_fix = True
+    elif is_a:
+        # Short Bank (333/335) Check? Plan says "Short Bank: 2-bun-sen"
+        # We check bank via place_name (simplified)
+        if is_short and n_lines == 2:
+            is_suji_fix = True
+
+    # Condition B (Lead) - if not Fix
+    # SIMPLIFIED: Almost always Suji-Lead unless Gap is too large
+    # (We will filter this via Safety Valve later)
+    is_suji_lead = not is_suji_fix
+        
+    # Condition C (Ana) - if not Fix/Lead
+    # SIMPLIFIED: Only explicit chaotic conditions
+    is_ana_nerai = False
+    if int(n_lines) >= 4 and is_s: # S-Class Hosogire
+        is_ana_nerai = True
+        is_suji_lead = False
+
+    # --- Safety Valve (Score Gap) ---
+    # Gap = m1_score - partner_score (Line Partner Gap)
+    gap = None if partner_score is None else s1 - partner_score
+    valved_reason = ""
+    if gap is not None:
+        # Challenge/A-Class Valve: Gap > 15 -> Ana
+        if (is_chal or is_a) and (is_suji_fix or is_suji_lead) and gap > 15.0:
+            is_suji_fix = is_suji_lead = False
+            is_ana_nerai = True
+            valved_reason = f" (得点差{gap:.1f}過大につき好機到来)"
+        # S-Class Valve: Gap > 10 -> Ana
+        if is_s and (is_suji_fix or is_suji_lead) and gap > 10.0:
+            is_suji_fix = is_suji_lead = False
+            is_ana_nerai = True
+            valved_reason = f" (S級得点差{gap:.1f}過大)"
+
+    if is_ana_nerai: mode = 'ana'
+    elif is_suji_fix: mode = 'fix'
+    elif is_suji_lead: mode = 'lead'
+    else: mode = 'standard'
+    return mode, gap, valved_reason
+
 def generate_hybrid_strategy(pred_df, score_col='ai_score', meta=None):
     """
     Generates OPTIMAL betting strategy based on race type analysis.
@@ -1415,15 +1652,7 @@ def generate_hybrid_strategy(pred_df, score_col='ai_score', meta=None):
         }
 
     # Girls Keirin Exclusion
-    is_girls = False
-    if 'class_code' in pred_df.columns:
-        if 'L' in pred_df['class_code'].values: is_girls = True
-    if '級班' in pred_df.columns:
-        if pred_df['級班'].astype(str).str.contains('L').any(): is_girls = True
-    if 'クラス' in pred_df.columns:
-        if pred_df['クラス'].astype(str).str.contains('ガールズ').any(): is_girls = True
-        
-    if is_girls:
+    if _is_girls(pred_df):
         return {
             "type": "disabled",
             "title": "対象外",
@@ -1435,43 +1664,51 @@ def generate_hybrid_strategy(pred_df, score_col='ai_score', meta=None):
             "strategy_type": "hybrid"
         }
     
-    df = pred_df.copy()
+    df = pred_df
     
-    # Ensure bonus column exists
-    if 'bonus' not in df.columns:
-        if 'ai_score' in df.columns and 'base_score' in df.columns:
-            df['bonus'] = df['ai_score'] - df['base_score']
-        else:
-            df['bonus'] = 0.0
+    # 得点・車番・加点は numpy 配列で1回だけ取り出す (frame のソートはしない)
+    scores = pd.to_numeric(df[score_col], errors='coerce').to_numpy(dtype=float)
+    cars = df['車番'].to_numpy()
     
-    # Get rankings
-    top_main = df.sort_values(score_col, ascending=False).reset_index(drop=True)
-    top_bonus = df.sort_values('bonus', ascending=False).reset_index(drop=True)
+    # Bonus (ai_score - base_score if not present)
+    if 'bonus' in df.columns:
+        bonus = pd.to_numeric(df['bonus'], errors='coerce').to_numpy(dtype=float)
+    elif 'ai_score' in df.columns and 'base_score' in df.columns:
+        bonus = (df['ai_score'] - df['base_score']).to_numpy(dtype=float, na_value=np.nan)
+    else:
+        bonus = np.zeros(len(df))
+    
+    # Get rankings (score 降順、同点は元の並び順、NaN は最後)
+    # 出走は最大9車なので argpartition より stable argsort 1回の方が安く、同点の順序も保てる
+    order = np.argsort(-scores, kind='stable')
+    ranked_cars = cars[order].astype(int).tolist()
+    ranked_scores = scores[order].tolist()
     
     # Extract key players
-    def get_car(idx): return int(top_main.iloc[idx]['車番']) if len(top_main) > idx else 0
+    def get_car(idx): return ranked_cars[idx] if len(ranked_cars) > idx else 0
     m1, m2, m3, m4 = get_car(0), get_car(1), get_car(2), get_car(3)
-    b1 = int(top_bonus.iloc[0]['車番'])
-    
-    m1_name = top_main.iloc[0].get('選手名', f'{m1}番')
-    b1_name = top_bonus.iloc[0].get('選手名', f'{b1}番')
-    b1_bonus = float(top_bonus.iloc[0]['bonus'])
+    b_idx = _first_max(bonus)
+    b1 = int(cars[b_idx])
+    b1_bonus = float(bonus[b_idx])
     
     # --- Score Gap Calculation ---
-    s1 = float(top_main.iloc[0][score_col])
-    s2 = float(top_main.iloc[1][score_col]) if len(top_main) > 1 else s1
-    s3 = float(top_main.iloc[2][score_col]) if len(top_main) > 2 else s2
+    s1 = ranked_scores[0]
+    s2 = ranked_scores[1] if len(ranked_scores) > 1 else s1
     diff_1_2 = s1 - s2
-    diff_1_3 = s1 - s3
 
     # --- Line & Class Analysis ---
     race_class = meta.get('race_class', 'A級') if meta else 'A級' 
     place_name = meta.get('place', '') if meta else ''
+    # クラス・バンク判定はここで1回だけ (Fix/Lead の折り返し判定でも使い回す)
+    is_s, is_a, is_chal = _class_flags(race_class)
+    is_short = place_name in _SHORT_BANKS
     
     # Infer Line Config (n_bun_sen)
     # Check if temp_line_id exists (from advanced_logic) or parse 'ライン'
-    if 'temp_line_id' in df.columns:
-        uniq_lines = df[df['temp_line_id'] != -1]['temp_line_id'].unique()
+    # temp_line_id は配列で1回だけ取り出す (フィルタ済み frame のコピーを作らない)
+    line_ids = df['temp_line_id'].to_numpy() if 'temp_line_id' in df.columns else None
+    if line_ids is not None:
+        uniq_lines = pd.unique(line_ids[line_ids != -1])
         n_lines = len(uniq_lines)
     elif 'ライン' in df.columns: # Naive parse if needed, usually temp_line_id is safe
         uniq_lines = df['ライン'].unique()
@@ -1486,74 +1723,22 @@ def generate_hybrid_strategy(pred_df, score_col='ai_score', meta=None):
          max_line_len = 0 # Unknown
 
     # Identify Conditions (A/B/C) based on Plan
-    is_suji_fix = False    # A: High Suji (>70%)
-    is_suji_lead = False   # B: High Suji (>60%)
-    is_ana_nerai = False   # C: Low Suji (<40%) or Safety Valve Triggered
-    
-    # Condition A (Fix)
-    if 'チャレンジ' in race_class:
-        if max_line_len >= 4: is_suji_fix = True
-    elif 'A級' in race_class:
-        # Short Bank (333/335) Check? Plan says "Short Bank: 2-bun-sen"
-        # We check bank via place_name (simplified)
-        short_banks = ["松戸", "小田原", "伊東", "富山", "奈良", "防府", "前橋"] 
-        if place_name in short_banks and n_lines == 2:
-            is_suji_fix = True
-
-    # Condition B (Lead) - if not Fix
-    # SIMPLIFIED: Almost always Suji-Lead unless Gap is too large
-    if not is_suji_fix:
-        is_suji_lead = True 
-        # (We will filter this via Safety Valve later)
-        
-    # Condition C (Ana) - if not Fix/Lead
-    # SIMPLIFIED: Only explicit chaotic conditions
-    if int(n_lines) >= 4 and 'S級' in race_class: # S-Class Hosogire
-         is_ana_nerai = True
-         is_suji_lead = False
-
-    # --- Safety Valve (Score Gap) ---
-    valved_reason = ""
-    # Challenge/A-Class Valve: Gap > 10 -> Ana
-    if 'チャレンジ' in race_class or 'A級' in race_class:
-        # Check Gap between Line Leader and Partner
-        # Simplified: Check diff_1_2 if m2 is partner. 
-        # Ideally we check partner score. For now, use global diff_1_2 as proxy for "Dominance but Risky"
-        # Wait, plan says "Line Partner Gap".
-        # If m1 is line leader, find m1's partner.
-        # If we can't find partner easily, assume m2 is main rival.
-        # Actually, if diff_1_2 > 10, it implies m1 is dominant. 
-        # But if partner is weak (Gap large), Suji fails. 
-        # So "Gap > 10" refers to (m1_score - partner_score).
-        # We need partner score.
-        m1_row = top_main.iloc[0]
-        m1_line = m1_row.get('temp_line_id', -1)
-        # Find partner (same line, pos 2)
-        partners = df[(df['temp_line_id'] == m1_line) & (df['車番'] != m1)]
-        if not partners.empty:
-             # Max score of partner
-             p_score = partners[score_col].max()
-             gap = s1 - p_score
-             
-             if (is_suji_fix or is_suji_lead) and gap > 15.0:
-                 is_suji_fix = False
-                 is_suji_lead = False
-                 is_ana_nerai = True
-                 valved_reason = f" (得点差{gap:.1f}過大につき好機到来)"
-        
-    # S-Class Valve: Gap > 5 -> Ana
-    if 'S級' in race_class:
-        m1_row = top_main.iloc[0]
-        m1_line = m1_row.get('temp_line_id', -1)
-        partners = df[(df.get('temp_line_id') == m1_line) & (df['車番'] != m1)]
-        if not partners.empty:
-             p_score = partners[score_col].max()
-             gap = s1 - p_score
-             if (is_suji_fix or is_suji_lead) and gap > 10.0:
-                 is_suji_fix = False
-                 is_suji_lead = False
-                 is_ana_nerai = True
-                 valved_reason = f" (S級得点差{gap:.1f}過大)"
+    # 数値コア: m1 の相方 (同じ temp_line_id の最高得点) を配列上で求め、判定はスカラーで行う
+    partner_idx = None
+    partner_score = None
+    if line_ids is not None:
+        cand = np.flatnonzero((line_ids == line_ids[order[0]]) & (cars != m1))
+        if len(cand):
+            partner_idx = cand[_first_max(scores[cand])]
+            partner_score = float(scores[partner_idx])
+    # スジ Fix/Lead の相方車番 (見つからなければ m2 で代用)
+    p_car = int(cars[partner_idx]) if partner_idx is not None else m2
+
+    mode, gap, valved_reason = _hybrid_decide(
+        s1, partner_score, n_lines, max_line_len, is_s, is_a, is_chal, is_short)
+    is_suji_fix = (mode == 'fix')     # A: High Suji (>70%)
+    is_suji_lead = (mode == 'lead')   # B: High Suji (>60%)
+    is_ana_nerai = (mode == 'ana')    # C: Low Suji (<40%) or Safety Valve Triggered
 
     # --- Strategy Generation ---
     race_type = '標準'
@@ -1599,24 +1784,22 @@ def generate_hybrid_strategy(pred_df, score_col='ai_score', meta=None):
         
         # Original Logic Reconstruction:
         # S-Class: Short Bank & 3-line & Gap<=5
-        if 'S級' in race_class:
-             short_banks = ["松戸", "小田原", "伊東", "富山", "奈良", "防府", "前橋"] 
-             if place_name in short_banks and n_lines == 3 and gap <= 5.0:
+        if is_s:
+             if is_short and n_lines == 3 and gap is not None and gap <= 5.0:
                  is_strict = True
                  
         # A-Class: 3-line & MaxLine>=3 & Gap<=10 (Lead) OR ShortBank & 2-line & Gap<=10 (Fix)
-        elif 'A級' in race_class:
-             short_banks = ["松戸", "小田原", "伊東", "富山", "奈良", "防府", "前橋"] 
+        elif is_a:
              # Fix pattern
-             if place_name in short_banks and n_lines == 2 and gap <= 10.0:
+             if is_short and n_lines == 2 and gap is not None and gap <= 10.0:
                  is_strict = True
              # Lead pattern
-             elif n_lines == 3 and max_line_len >= 3 and gap <= 10.0:
+             elif n_lines == 3 and max_line_len >= 3 and gap is not None and gap <= 10.0:
                  is_strict = True
                  
         # Challenge: Gap<=10 (Generally strong)
-        elif 'チャレンジ' in race_class:
-             if gap <= 10.0:
+        elif is_chal:
+             if gap is not None and gap <= 10.0:
                  is_strict = True
                  
         suffix = " 🔥(激熱)" if is_strict else ""
@@ -1627,32 +1810,21 @@ def generate_hybrid_strategy(pred_df, score_col='ai_score', meta=None):
         # Use m2 as proxy if we can't identify partner?
         # Ideally identify partner correctly.
         # Assuming m2 IS partner if Suji logic holds? Not always.
-        # Fallback to m2 if partner not found.
-        # Try finding partner again
-        m1_line = top_main.iloc[0].get('temp_line_id', -1)
-        partners = df[(df.get('temp_line_id') == m1_line) & (df['車番'] != m1)]
-        if not partners.empty:
-            partner = partners.sort_values(score_col, ascending=False).iloc[0]
-            p_car = int(partner['車番'])
-        else:
-            p_car = m2 # Fallback
-            p_score = s2
+        # Fallback to m2 if partner not found (p_car は上で算出済み)
+        p_score = partner_score if partner_idx is not None else s2
             
         # Reverse (Ura) Check
         # If Gap is small OR Bank is Long (Standard), Partner might beat Head.
         is_reverse_needed = False
-        p_score = partner[score_col] if not partners.empty else s2
         
         real_gap = s1 - p_score
         
         # Conditions: 
         # 1. Close Match: Gap < 4.0 (Very dangerous)
         # 2. Long Bank: Gap < 8.0 AND Bank >= 400 (Sashi favor)
-        is_long_bank = (place_name not in ["松戸", "小田原", "伊東", "富山", "奈良", "防府", "前橋"])
-        
         if real_gap < 4.0:
             is_reverse_needed = True
-        elif is_long_bank and real_gap < 8.0:
+        elif not is_short and real_gap < 8.0:
             is_reverse_needed = True
             
         if is_reverse_needed:
@@ -1661,19 +1833,19 @@ def generate_hybrid_strategy(pred_df, score_col='ai_score', meta=None):
         l2_3r = [p_car]
         
         # Fix 3rd place candidates to ensure 4 distinct points
-        cands = [x for x in [m2, m3, m4, b1] if x not in [m1, p_car]]
-        # Fill with m5/others if needed?
-        # Logic usually has access to m1..m4.
-        # Let's ensure we have distinct.
-        unique_3rd = sorted(list(set(cands)), key=lambda x: cands.index(x))
+        # Let's ensure we have distinct (順序を保った重複除去).
+        excl = (m1, p_car)
+        unique_3rd = list(dict.fromkeys(x for x in (m2, m3, m4, b1) if x not in excl))
+        seen = set(unique_3rd)
         # If less than 2 candidates (total 2 pts), user complained "recommended 4 but 2".
         # We need more candidates preferably.
         # Try adding top scorers until we have 4.
         for i in range(10):
+            if len(unique_3rd) >= 4: break
             c_cand = get_car(i)
-            if c_cand not in [m1, p_car] and c_cand not in unique_3rd:
+            if c_cand not in excl and c_cand not in seen:
                 unique_3rd.append(c_cand)
-            if len(unique_3rd) >= 4: break
+                seen.add(c_cand)
             
         l3_3r = unique_3rd[:4]
         
@@ -1696,21 +1868,14 @@ def generate_hybrid_strategy(pred_df, score_col='ai_score', meta=None):
         race_type_emoji = '⚔️'
         race_type_reason = "スジ決着有力 (絞り込み)"
         
-        # Similar to Fix but slightly wider
-        m1_line = top_main.iloc[0].get('temp_line_id', -1)
-        partners = df[(df.get('temp_line_id') == m1_line) & (df['車番'] != m1)]
-        p_car = int(partners.sort_values(score_col, ascending=False).iloc[0]['車番']) if not partners.empty else m2
-
+        # Similar to Fix but slightly wider (p_car / partner_score は Fix と共通)
         # 2sha: m1 -> p_car, m2 (if m2 is diff line)
         tickets_2s.append(f"2車単: {m1} → {p_car}, {m2}")
         
-        # Reverse Check for Lead (same logic)
-        partners_lead = df[(df.get('temp_line_id') == m1_line) & (df['車番'] != m1)]
-        if not partners_lead.empty:
-             pl_score = partners_lead.sort_values(score_col, ascending=False).iloc[0][score_col]
-             gap_l = s1 - pl_score
-             is_long_bank = (place_name not in ["松戸", "小田原", "伊東", "富山", "奈良", "防府", "前橋"])
-             if gap_l < 4.0 or (is_long_bank and gap_l < 8.0):
+        # Reverse Check for Lead (same logic, 相方の得点を再検索しない)
+        if partner_idx is not None:
+             gap_l = s1 - partner_score
+             if gap_l < 4.0 or (not is_short and gap_l < 8.0):
                  tickets_2s.append(f"2車単: {p_car} → {m1} (折り返し)")
                  tickets_3r.append(f"3連単: {p_car} → {m1} → {m1}, {m2}, {m3}, {b1}")
                  race_type_reason += " (折り返し押さえ)"
@@ -1766,15 +1931,70 @@ def generate_hybrid_strategy(pred_df, score_col='ai_score', meta=None):
 # 3. Gemini Commentary Logic
 # ==========================================
 
-def generate_ai_commentary(df, meta, lines_info, metrics, strategy_res=None, api_key=None):
-    """
-    Generate professional race commentary using Gemini API.
-    """
-    if not api_key:
-         return "ℹ️ Gemini APIキーを設定すると、ここに本気のAI解説が表示されます。"
-    
-    genai.configure(api_key=api_key)
+# Gemini モデルは API キーごとに1回だけ作って使い回す (configure はグローバル状態を書き換えるため毎回呼ばない)
+_MODEL_CACHE = {}
+_CONFIGURED_KEY = [None]  # 直近に configure したキーのハッシュ
+
+def _key_hash(api_key):
+    return hashlib.blake2b(api_key.encode(), digest_size=8).digest()
+
+def _configure(api_key):
+    # キーが変わった時だけ genai.configure する
+    h = _key_hash(api_key)
+    if _CONFIGURED_KEY[0] != h:
+        genai.configure(api_key=api_key)
+        _CONFIGURED_KEY[0] = h
+    return h
+
+def _get_model(api_key):
+    h = _configure(api_key)
+    model = _MODEL_CACHE.get(h)
+    if model is None:
+        model = genai.GenerativeModel('gemini-2.5-flash')
+        _MODEL_CACHE[h] = model
+    return model
+
+# プロンプトの固定部分 (レースごとに変わらない/同じ出走表なら同一) は使い回す
+@functools.lru_cache(maxsize=32)
+def _prompt_header(place, race_num, date):
+    return f"""
+あなたは競輪歴30年の伝説のスポーツ記者です。
+長年の経験とデータ分析を融合させ、読者の心を揺さぶる「本気のレース解説」を執筆してください。
+単なる予想ではありません。レースの「物語（ドラマ）」を描いてください。
+
+【レース情報】
+{date} {place}競輪 {race_num}レース
+
+【ライン構成】
+"""
+
+_PROMPT_FOOTER = """【執筆のポイント】
+1. **展開のドラマ**: 「号砲が鳴ると...」から始め、初手の並び、ジャン前後の駆け引き、最終バックでの攻防を、まるで見てきたかのように臨場感たっぷりに描写してください。特に「逃げの主導権争い」や「番手の仕事（ブロック）」、「捲りのタイミング」などに触れてください。
+2. **選手への視点**: 選手の心理状態や、ラインの絆、地元選手の意地などを想像し、感情移入できるエピソードを盛り込んでください。
+3. **結論と買い目**: 「ズバリ、私の本命は...」と切り出し、なぜその選手なのかを熱く語ってください。穴狙いなら「大波乱の予感...」「一発あるなら...」と期待感を煽ってください。
+
+【口調とスタイル】
+- 「〜だろう」「〜に期待したい」「〜が濃厚だ」「〜これぞ競輪だ」といった、自信と愛に満ちたスポーツ紙のベテラン記者風の口調。
+- 読者をグイグイ引き込む、リズミカルで熱い文体。
+
+【構成（マークダウン）】
+### 🚴 展開シミュレーション
+### 🔍 記者が見抜いた勝負の分かれ目
+### 🎯 渾身の最終結論
+「ズバリ、私の本命は...」と切り出し、なぜその選手なのかを熱く語ってください。
+穴狙いなら「大波乱の予感...」「一発あるなら...」と期待感を煽ってください。
+
+### 【AI予想買い目】
+最後に、必ず以下の形式で推奨買い目を列挙してください。
+（例）
+・3連単 本線: 1-2-3 (1点)
+・3連単 抑え: 1-2-4, 1-3-2 (2点)
+・2車単: 1=2 (裏表)
+"""
 
+_NO_API_KEY_COMMENT = "ℹ️ Gemini APIキーを設定すると、ここに本気のAI解説が表示されます。"
+
+def _build_commentary_prompt(df, meta, lines_info, metrics, strategy_res=None):
     # 1. Context Construction
     place = meta.get('place', '不明')
     race_num = meta.get('race_num', '1')
@@ -1789,40 +2009,35 @@ def generate_ai_commentary(df, meta, lines_info, metrics, strategy_res=None, api
          top3 = []
 
     # Full Player List for Context
+    # iterrows を使わず、列を numpy で1回ずつ取り出して zip で組み立てる
     player_list_str = ""
     try:
-         all_players = []
          df_sorted_car = df.sort_values('車番')
-         for _, row in df_sorted_car.iterrows():
-             c_num = row.get('車番', '?')
-             name = row.get('選手名', '不明')
-             pref = row.get('府県', '')
-             cls = row.get('級班', '')
-             score = row.get('競走得点', 0)
-             try: score = float(score)
-             except: score = 0
-             tactic = row.get('脚質', '')
-             
-             # Jimoto Check
-             is_local = row.get('is_jimoto') or row.get('地元')
-             local_tag = " [地元]" if is_local else ""
-             
-             all_players.append(f"{c_num}: {name} ({pref}/{cls}, {score:.2f}, {tactic}){local_tag}")
-         player_list_str = "\\n".join(all_players)
+         n = len(df_sorted_car)
+         def col(name, default):
+             if name in df_sorted_car.columns:
+                 return df_sorted_car[name].to_numpy()
+             return np.full(n, default, dtype=object)
+         if '競走得点' in df_sorted_car.columns:
+             scores = pd.to_numeric(df_sorted_car['競走得点'], errors='coerce').fillna(0).to_numpy()
+         else:
+             scores = np.zeros(n)
+         # Jimoto Check
+         is_local = np.zeros(n, dtype=bool)
+         for c in ('is_jimoto', '地元'):
+             if c in df_sorted_car.columns:
+                 is_local |= df_sorted_car[c].fillna(False).astype(bool).to_numpy()
+         local_tags = np.where(is_local, " [地元]", "")
+         player_list_str = "\\n".join(
+             f"{c_num}: {name} ({pref}/{cls}, {score:.2f}, {tactic}){local_tag}"
+             for c_num, name, pref, cls, score, tactic, local_tag in zip(
+                 col('車番', '?'), col('選手名', '不明'), col('府県', ''), col('級班', ''),
+                 scores, col('脚質', ''), local_tags))
     except:
          player_list_str = "情報なし"
 
     # Construct Prompt
-    prompt = f"""
-あなたは競輪歴30年の伝説のスポーツ記者です。
-長年の経験とデータ分析を融合させ、読者の心を揺さぶる「本気のレース解説」を執筆してください。
-単なる予想ではありません。レースの「物語（ドラマ）」を描いてください。
-
-【レース情報】
-{date} {place}競輪 {race_num}レース
-
-【ライン構成】
-{lines_info}
+    prompt = _prompt_header(place, race_num, date) + f"""{lines_info}
 
 【有力選手 (得点上位)】
 {top3}
@@ -1839,130 +2054,182 @@ def generate_ai_commentary(df, meta, lines_info, metrics, strategy_res=None, api
 {strategy_res.get('tickets', []) if strategy_res else 'なし'}
 判定タイプ: {strategy_res.get('type', '標準') if strategy_res else '標準'}
 
-【執筆のポイント】
-1. **展開のドラマ**: 「号砲が鳴ると...」から始め、初手の並び、ジャン前後の駆け引き、最終バックでの攻防を、まるで見てきたかのように臨場感たっぷりに描写してください。特に「逃げの主導権争い」や「番手の仕事（ブロック）」、「捲りのタイミング」などに触れてください。
-2. **選手への視点**: 選手の心理状態や、ラインの絆、地元選手の意地などを想像し、感情移入できるエピソードを盛り込んでください。
-3. **結論と買い目**: 「ズバリ、私の本命は...」と切り出し、なぜその選手なのかを熱く語ってください。穴狙いなら「大波乱の予感...」「一発あるなら...」と期待感を煽ってください。
+""" + _PROMPT_FOOTER
 
-【口調とスタイル】
-- 「〜だろう」「〜に期待したい」「〜が濃厚だ」「〜これぞ競輪だ」といった、自信と愛に満ちたスポーツ紙のベテラン記者風の口調。
-- 読者をグイグイ引き込む、リズミカルで熱い文体。
+    return prompt
 
-【構成（マークダウン）】
-### 🚴 展開シミュレーション
-### 🔍 記者が見抜いた勝負の分かれ目
-### 🎯 渾身の最終結論
-「ズバリ、私の本命は...」と切り出し、なぜその選手なのかを熱く語ってください。
-穴狙いなら「大波乱の予感...」「一発あるなら...」と期待感を煽ってください。
-
-### 【AI予想買い目】
-最後に、必ず以下の形式で推奨買い目を列挙してください。
-（例）
-・3連単 本線: 1-2-3 (1点)
-・3連単 抑え: 1-2-4, 1-3-2 (2点)
-・2車単: 1=2 (裏表)
-"""
-
-    # Call API
+def _generate_with(model, prompt):
+    # Call API (失敗時はエラーメッセージを解説欄にそのまま表示する)
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
         response = model.generate_content(prompt)
         return response.text
     except Exception as e:
         return f"解説生成エラー: {e}"
 
+def _generate_text(api_key, prompt):
+    try:
+        model = _get_model(api_key)
+    except Exception as e:
+        return f"解説生成エラー: {e}"
+    return _generate_with(model, prompt)
+
+def generate_ai_commentary(df, meta, lines_info, metrics, strategy_res=None, api_key=None):
+    """
+    Generate professional race commentary using Gemini API.
+    """
+    if not api_key:
+         return _NO_API_KEY_COMMENT
+    return _generate_text(api_key, _build_commentary_prompt(df, meta, lines_info, metrics, strategy_res))
+
+def generate_ai_commentary_batch(requests, api_key=None, max_workers=12):
+    """
+    Generate commentary for several races at once.
+    requests: generate_ai_commentary の引数 (df, meta, lines_info, metrics, strategy_res) の dict のリスト。
+    API の待ち時間 (1レース数秒) をスレッドで重ねるので、12R 分でもほぼ1レース分の時間で返る。
+    """
+    if not api_key:
+         return [_NO_API_KEY_COMMENT] * len(requests)
+    prompts = [_build_commentary_prompt(**req) for req in requests]
+    if not prompts:
+        return []
+    # configure / モデル生成はスレッドを立てる前に1回だけ (各スレッドは generate_content を呼ぶだけ)
+    try:
+        model = _get_model(api_key)
+    except Exception as e:
+        return [f"解説生成エラー: {e}"] * len(prompts)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(prompts))) as ex:
+        return list(ex.map(lambda p: _generate_with(model, p), prompts))
+
 # ==========================================
 # 4. Data Loading Logic
 # ==========================================
 
+# Memory Optimization: Downcast 先の dtype (列名 -> dtype)
+_INT_DOWNCAST = dict.fromkeys(
+    ["line_length", "line_pos", "is_longest_line", "is_jimoto", "score_rank", "着順_val", "race_size", "枠番", "車番"],
+    'int8')
+# 年 (2024 など) は int8 に収まらないので int16
+_INT_DOWNCAST["年"] = 'int16'
+_FLOAT_DOWNCAST = dict.fromkeys(
+    ["B", "S", "H", "逃", "捲", "差", "マ", "odds_win_sim", "odds_wide_sim"],
+    'float32')
+_DOWNCAST = {**_INT_DOWNCAST, **_FLOAT_DOWNCAST}
+
+def _downcast_chunk(df):
+    # read_sql のチャンク単位で適用: 数値化 + fillna(0) + astype をまとめて1回で行う
+    num_cols = [c for c in _DOWNCAST if c in df.columns]
+    if num_cols:
+        df[num_cols] = df[num_cols].apply(pd.to_numeric, errors='coerce').fillna(0)
+        df = df.astype({c: _DOWNCAST[c] for c in num_cols})
+    return df
+
+_TARGET_COLS = (
+    "race_id", "競輪場", "日付", "class_code", "級班",
+    "line_length", "line_pos", "is_longest_line", 
+    "fav_tactic", "line_strength_head", "line_strength_second", 
+    "is_jimoto", "score_rank", "着順_val", "race_size", 
+    "odds_win_sim", "odds_wide_sim", 
+    "決まり手", "レースの種類", "グレード", 
+    "逃", "捲", "差", "マ",
+    "枠番", "車番", "選手名", "府県", "B", "S",
+    "競走得点", "勝 率", "2連 対率", "3連 対率",
+    "is_top_nige", "is_top_makuri", "is_top_sashi",
+    "dividend_2shatan", "dividend_3rentan",
+    "ライン", "年"
+)
+
+_READ_LOCAL = threading.local()
+
+def _read_conn(db_path, mtime):
+    """
+    読み取り専用の接続をスレッドごと・DB ごとに使い回す (毎回の connect / スキーマ読み込みを省く)。
+    DB ファイルが更新されて mtime が変わったら開き直す。スレッド終了時に接続も破棄される。
+    """
+    conns = getattr(_READ_LOCAL, 'conns', None)
+    if conns is None:
+        conns = _READ_LOCAL.conns = {}
+    cached = conns.get(db_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    if cached is not None:
+        cached[1].close()
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA query_only=1")
+    conns[db_path] = (mtime, conn)
+    return conn
+
+@functools.lru_cache(maxsize=4)
+def _schema_cols(db_path, mtime):
+    # race_result の列一覧 (DB ファイルが更新されたら mtime が変わるので引き直す)
+    return tuple(r[1] for r in _read_conn(db_path, mtime).execute("PRAGMA table_info(race_result)"))
+
+@functools.lru_cache(maxsize=4)
+def _select_cols(db_cols):
+    select_cols = tuple(c for c in _TARGET_COLS if c in db_cols)
+    return select_cols, ", ".join([f'"{c}"' for c in select_cols])
+
+_CLASS_MAP = {'S': 'S級', 'A': 'A級', 'C': 'チャレンジ', 'L': 'ガールズ'}
+_CLS_DTYPE = pd.CategoricalDtype(categories=['S級', 'A級', 'チャレンジ', 'ガールズ'])
+
+def _per_unique(s, func):
+    # 日付・級班 は同じ値の繰り返しが多いので、一意な値だけ変換して codes で展開する
+    codes, uniques = pd.factorize(s, use_na_sentinel=False)
+    return pd.Series(np.asarray(func(pd.Series(uniques)))[codes], index=s.index)
+
 def load_and_process_data(db_path=db_utils.DB_PATH, target_years=None):
     if not os.path.exists(db_path):
         return pd.DataFrame()
 
-    conn = sqlite3.connect(db_path)
-    
-    target_cols = [
-        "race_id", "競輪場", "日付", "class_code", "級班",
-        "line_length", "line_pos", "is_longest_line", 
-        "fav_tactic", "line_strength_head", "line_strength_second", 
-        "is_jimoto", "score_rank", "着順_val", "race_size", 
-        "odds_win_sim", "odds_wide_sim", 
-        "決まり手", "レースの種類", "グレード", 
-        "逃", "捲", "差", "マ",
-        "枠番", "車番", "選手名", "府県", "B", "S",
-        "競走得点", "勝 率", "2連 対率", "3連 対率",
-        "is_top_nige", "is_top_makuri", "is_top_sashi",
-        "dividend_2shatan", "dividend_3rentan",
-        "ライン", "年"
-    ]
-    
     # Valid columns only
     try:
-        res = conn.execute("PRAGMA table_info(race_result)").fetchall()
-        db_cols = [r[1] for r in res]
-        select_cols = [c for c in target_cols if c in db_cols]
-        cols_str = ", ".join([f'"{c}"' for c in select_cols])
-        
-        where_clause = ""
-        params = []
-        if target_years:
-            placeholders = ','.join(['?'] * len(target_years))
-            if "年" in db_cols:
-                where_clause = f" WHERE 年 IN ({placeholders})"
-                params = list(target_years) # Ensure list
-        
-        query = f"SELECT {cols_str} FROM race_result{where_clause}"
-        # print(f"DEBUG SQL: {query} / Params: {params}")
-        df = pd.read_sql(query, conn, params=params)
+        db_cols = _schema_cols(db_path, os.path.getmtime(db_path))
+        select_cols, cols_str = _select_cols(db_cols)
+        with closing(sqlite3.connect(db_path)) as conn:
+            where_clause = ""
+            params = []
+            if target_years:
+                placeholders = ','.join(['?'] * len(target_years))
+                if "年" in db_cols:
+                    where_clause = f" WHERE 年 IN ({placeholders})"
+                    params = list(target_years) # Ensure list
+            
+            query = f"SELECT {cols_str} FROM race_result{where_clause}"
+            # print(f"DEBUG SQL: {query} / Params: {params}")
+            # チャンク毎に downcast してから連結 (複数年ロード時のピークメモリを抑える)
+            chunks = [_downcast_chunk(chunk) for chunk in
+                      pd.read_sql(query, conn, params=params, chunksize=200_000)]
+        df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=select_cols)
              
     except Exception as e:
         # print(f"Load Error: {e}")
         return pd.DataFrame()
-    finally:
-        conn.close()
-        return pd.DataFrame()
-        
-    conn.close()
-    
-    # Memory Optimization: Downcast
-    int_cols = ["line_length", "line_pos", "is_longest_line", "is_jimoto", "score_rank", "着順_val", "race_size", "枠番", "車番", "年"]
-    for c in int_cols:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0).astype('int8')
-
-    count_cols = ["B", "S", "H", "逃", "捲", "差", "マ"]
-    for c in count_cols:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0).astype('float32')
-            
-    float_cols = ["odds_win_sim", "odds_wide_sim"]
-    for c in float_cols:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0.0).astype('float32')
 
     if 'is_line_onetwo' not in df.columns:
          df['is_line_onetwo'] = 0
 
     # 1. Date Conversion
-    df['date_dt'] = pd.to_datetime(df['日付'], format='%Y年%m月%d日', errors='coerce')
+    df['date_dt'] = _per_unique(df['日付'], lambda u: pd.to_datetime(u, format='%Y年%m月%d日', errors='coerce'))
     if '年' not in df.columns:
         df['year'] = df['date_dt'].dt.year.fillna(0).astype('int16')
-    else:
-        df['year'] = df['年'].astype('int16')
+    # 年 がある場合は _downcast_chunk で int16 済み (year -> 年 のリネームで列が重複しないように)
     
     # 2. Class Calculation
-    class_map = {'S': 'S級', 'A': 'A級', 'C': 'チャレンジ', 'L': 'ガールズ'}
-    
     if 'class_code' in df.columns:
-        df['クラス'] = df['class_code'].map(class_map).fillna('A級').astype('category')
+        df['クラス'] = df['class_code'].map(_CLASS_MAP).fillna('A級').astype(_CLS_DTYPE)
     elif '級班' in df.columns:
-        df['クラス'] = df['級班'].apply(db_utils.classify_grade).astype('category')
+        df['クラス'] = _per_unique(df['級班'], lambda u: u.apply(db_utils.classify_grade)).astype('category')
     else:
         df['クラス'] = 'A級'
 
     # 3. Max Tactic Logic
     tactic_map = {'逃': 'nige', '捲': 'makuri', '差': 'sashi', 'マ': 'mark'}
     
+    # DB フラグが無い戦法だけ、race_id の groupby 1回でまとめてレース内最大値を取る
+    max_keys = [jp for jp, en in tactic_map.items()
+                if f"is_top_{en}" not in df.columns and jp in df.columns]
+    if max_keys:
+        maxes = df.groupby('race_id', observed=True, sort=False)[max_keys].transform('max')
+    
     for jp_key, en_key in tactic_map.items():
         db_flag_col = f"is_top_{en_key}"
         app_flag_col = f"is_max_{en_key}"
@@ -1971,7 +2238,7 @@ def load_and_process_data(db_path=db_utils.DB_PATH, target_years=None):
             df[app_flag_col] = df[db_flag_col].astype(bool)
         elif jp_key in df.columns:
             col_val = pd.to_numeric(df[jp_key], errors='coerce').fillna(0)
-            max_val = df.groupby('race_id')[jp_key].transform('max')
+            max_val = maxes[jp_key]
             df[app_flag_col] = ((col_val == max_val) & (max_val > 0))
         else:
             df[app_flag_col] = False
@@ -2009,35 +2276,38 @@ def load_and_process_data(db_path=db_utils.DB_PATH, target_years=None):
 # 5. Helper Funcs
 # ==========================================
 
+# 戦法フラグ名 -> 表示ラベル (上から順に部分一致で判定)
+_TACTIC_LABELS = {
+    "nige": "🚀 逃げ選手",
+    "makuri": "🌀 捲り選手",
+    "sashi": "⚡ 差し選手",
+    "mark": "🛡️ マーク選手",
+    "jimoto": "🏠 地元選手",
+    "longest_line": "🛤️ 最長ライン",
+    "line_onetwo": "🤝 ラインワンツー",
+}
+
+# 強度のしきい値 (<1, <2, <3, それ以上) -> 表示ラベル
+_STRENGTH_STEPS = (1, 2, 3)
+_STRENGTH_LABELS = {
+    ">": ("弱以上", "中以上", "強のみ", ""),
+    "<=": ("なし", "弱以下", "中以下", ""),
+}
+
 def get_readable_condition(name, threshold, relation):
     """Human readable condition string (Natural Japanese)"""
     if name.startswith('戦法:') or name.startswith('is_'):
         val_name = name.replace('is_', '').replace('val', '').replace('戦法:', '')
         if relation == ">":
-            if "nige" in val_name: return "🚀 逃げ選手"
-            if "makuri" in val_name: return "🌀 捲り選手"
-            if "sashi" in val_name: return "⚡ 差し選手"
-            if "mark" in val_name: return "🛡️ マーク選手"
-            if "jimoto" in val_name: return "🏠 地元選手"
-            if "longest_line" in val_name: return "🛤️ 最長ライン"
-            if "line_onetwo" in val_name: return "🤝 ラインワンツー"
-            return f"【{val_name}】" 
+            return next((label for key, label in _TACTIC_LABELS.items() if key in val_name),
+                        f"【{val_name}】")
         else:
             return f"【非{val_name}】"
     
     if '強度' in name:
-        val_name = ""
-        if relation == ">":
-            if threshold < 1: val_name = "弱以上"
-            elif threshold < 2: val_name = "中以上"
-            elif threshold < 3: val_name = "強のみ"
-            op = ""
-        else: 
-            if threshold < 1: val_name = "なし"
-            elif threshold < 2: val_name = "弱以下"
-            elif threshold < 3: val_name = "中以下"
-            op = ""
-        return f"{name.replace('_val','')} {op}{val_name}"
+        labels = _STRENGTH_LABELS[">" if relation == ">" else "<="]
+        val_name = labels[bisect.bisect_right(_STRENGTH_STEPS, threshold)]
+        return f"{name.replace('_val','')} {val_name}"
         
     if '順位' in name:
         if relation == "<=":
@@ -2053,150 +2323,207 @@ def get_readable_condition(name, threshold, relation):
 
     return f"{name} {relation} {threshold}"
 
+# 1行判定用 (値の型が閾値と違っても == / != は False / True を返すだけ)
+_RULE_OPS = {
+    ">=": operator.ge, ">": operator.gt,
+    "<=": operator.le, "<": operator.lt,
+    "==": operator.eq, "!=": operator.ne,
+}
+# 列まとめて判定する evaluate_rule_matrix 用
+_RULE_UFUNCS = {
+    ">=": np.greater_equal, ">": np.greater,
+    "<=": np.less_equal, "<": np.less,
+    "==": np.equal, "!=": np.not_equal,
+}
+
+def evaluate_rule_matrix(df, rule_conditions):
+    """全行について rule_conditions を満たすかを bool 配列で返す (列ごとに1回比較)"""
+    mask = np.ones(len(df), dtype=bool)
+    for feat, thresh, rel in rule_conditions:
+        op = _RULE_UFUNCS.get(rel)
+        if op is None: continue
+        col = df[feat].to_numpy() if feat in df.columns else np.zeros(len(df))
+        mask &= op(col, thresh)
+        if not mask.any(): break
+    return mask
+
 def check_rule_match(row, rule_conditions):
+    # 1行用。まとめて判定する場合は evaluate_rule_matrix を使う
     for feat, thresh, rel in rule_conditions:
-        val = row.get(feat, 0)
-        if rel == ">=":
-            if not (val >= thresh): return False
-        elif rel == ">":
-            if not (val > thresh): return False
-        elif rel == "<=":
-            if not (val <= thresh): return False
-        elif rel == "<":
-            if not (val < thresh): return False
-        elif rel == "==":
-            if not (val == thresh): return False
-        elif rel == "!=":
-            if not (val != thresh): return False
+        op = _RULE_OPS.get(rel)
+        if op is not None and not op(row.get(feat, 0), thresh): return False
     return True
 
 # ==========================================
 # 6. Scoring Logic (Missing Function)
 # ==========================================
 
-def apply_v3_logic(df):
+_TACTIC_BITS = (('逃', 1), ('捲', 2), ('差', 4))
+
+def _tactic_bits(df):
+    """脚質 を uint8 のビット (逃=1, 捲=2, 差=4) にする。文字列判定は一意な値ごとに1回だけ"""
+    if '脚質' not in df.columns:
+        return np.zeros(len(df), dtype=np.uint8)
+    codes, uniques = pd.factorize(df['脚質'].astype(str), use_na_sentinel=False)
+    ubits = np.array([sum(bit for ch, bit in _TACTIC_BITS if isinstance(v, str) and ch in v)
+                      for v in uniques], dtype=np.uint8)
+    return ubits[codes]
+
+def _tactic_masks(df):
+    """脚質 から (逃, 捲, 差) を含むかの bool 配列を作る (列が無ければ全て False)"""
+    bits = _tactic_bits(df)
+    return tuple((bits & bit) != 0 for _, bit in _TACTIC_BITS)
+
+_NUMERIC_SRC_COLS = ('競走得点', 'B', '逃', '捲', '差')
+
+def _scoring_features(df):
+    """
+    classic / v3 の両ステージで共通に使う派生値を1回だけ作る。
+    numeric: 競走得点 / B / 逃 / 捲 / 差 の数値化 (NaN のまま)
+    tactics: 脚質 の (逃, 捲, 差) マスク
+    place: 競輪場 (列が無い・空なら "")
+    """
+    present = [c for c in _NUMERIC_SRC_COLS if c in df.columns]
+    return {
+        'numeric': df[present].apply(pd.to_numeric, errors='coerce'),
+        'tactics': _tactic_masks(df),
+        'place': df['競輪場'].iat[0] if '競輪場' in df.columns and len(df) else "",
+    }
+
+# V3 の加点ルール (ビット位置 = タグの付与順)。_v3_kernel はビットだけを立てる
+_V3_BITS = (
+    (3.0, " [B-Top:短(★)]"),     # 0: Strong on short
+    (1.0, " [B-Top:長]"),         # 1: Weaker on long
+    (2.0, " [B-Top]"),            # 2
+    (6.0, " [圧倒的捲り(SS)]"),   # 3: SS Grade confidence
+    (5.0, " [圧倒的逃げ:短(S)]"), # 4: S Grade
+    (3.0, " [圧倒的逃げ]"),       # 5
+    (2.0, " [圧倒的差(連軸)]"),   # 6
+    (-1.0, " [激戦:差引]"),       # 7
+    (2.0, " [激戦:逃有利]"),      # 8
+)
+_V3_SCORES = np.array([b[0] for b in _V3_BITS])
+_V3_SHIFTS = np.arange(len(_V3_BITS))
+
+@functools.lru_cache(maxsize=None)
+def _v3_tag(code):
+    return "".join(tag for i, (_, tag) in enumerate(_V3_BITS) if code >> i & 1)
+
+def _dominance(vals):
+    # Tactic Dominance (Count >= 5 AND (Diff >= 5 OR Ratio >= 3.0))
+    if len(vals) < 2: return np.zeros(len(vals), dtype=bool)
+    
+    # 上位2つだけ分かればよいので全ソートせず partition (sec <= top)
+    sec_val, top_val = np.partition(vals, len(vals) - 2)[-2:]
+    
+    is_dom = False
+    if top_val >= 5:
+        if (top_val >= sec_val + 5) or (sec_val > 0 and top_val / sec_val >= 3.0) or (sec_val == 0 and top_val >= 5):
+            is_dom = True
+    
+    return (vals == top_val) & (top_val > 0) & is_dom
+
+def _v3_kernel(b, nige, makuri, sashi, sashi_type, is_short_bank, is_long_bank):
+    """
+    V3 判定の本体。float64 配列だけを受け取り、各選手の加点ビット (_V3_BITS) と
+    (is_b_top, is_dom_nige, is_dom_makuri, is_dom_sashi) と逃げ選手数を返す。
+    """
+    code = np.zeros(len(b), dtype=np.int64)
+    def bit(mask, i):
+        code[mask] |= 1 << i
+
+    # A. B-Top
+    max_b = b.max()
+    b_top = (b == max_b) & (max_b > 0)
+    # B. Tactic Dominance
+    dom_nige, dom_makuri, dom_sashi = _dominance(nige), _dominance(makuri), _dominance(sashi)
+    # C. Nige Conflict Level: Count players with Nige >= 3
+    nige_count = int((nige >= 3).sum())
+
+    # --- B-Top Logic ---
+    bit(b_top, 0 if is_short_bank else 1 if is_long_bank else 2)
+    # --- Dominance Logic (捲り > 逃げ > 差し の優先順) ---
+    bit(dom_makuri, 3)
+    bit(dom_nige & ~dom_makuri, 4 if is_short_bank else 5)
+    # Sashi dominance is for 2nd/3rd place stability, not 1st.
+    bit(dom_sashi & ~dom_makuri & ~dom_nige, 6)
+    # --- Nige Conflict Logic ---
+    # If Nige War (>= 3 Nige), Penalty for Sashi (Prediction: Nige wins)
+    if nige_count >= 3:
+        bit(sashi_type & ~dom_sashi, 7)
+        # Boost Strongest Nige
+        bit(dom_nige | ((nige == nige.max()) & (nige >= 5)), 8)
+
+    return code, (b_top, dom_nige, dom_makuri, dom_sashi), nige_count
+
+def apply_v3_logic(df, feats=None):
     """
     Logic V3: B-Top, Tactic Dominance, and Nige Conflict.
     Based on Jan 2026 Verification.
+    feats: _scoring_features(df) の結果 (calculate_ai_score から渡され、再計算を省く)
     """
-    df = df.copy()
+    # 列の追加・差し替えのみなので浅いコピーで十分 (呼び出し元の df は変更しない、未変更列のバッファは共有)
+    df = df.copy(deep=False)
     if df.empty: return df
+    if feats is None:
+        feats = _scoring_features(df)
     
     # --- 1. Feature Engineering ---
     # Convert cols to numeric
     for col in ['B', '逃', '捲', '差']:
         if col in df.columns:
-            df[f'{col}_val'] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+            df[f'{col}_val'] = feats['numeric'][col].fillna(0)
         else:
             df[f'{col}_val'] = 0.0
 
-    # A. B-Top
-    max_b = df['B_val'].max()
-    df['is_b_top'] = (df['B_val'] == max_b) & (max_b > 0)
-    
-    # B. Tactic Dominance (Count >= 5 AND (Diff >= 5 OR Ratio >= 3.0))
-    def check_dominance(col_name):
-        vals = df[col_name].sort_values(ascending=False).values
-        if len(vals) < 2: return [False] * len(df)
-        
-        top_val = vals[0]
-        sec_val = vals[1]
-        
-        is_dom = False
-        if top_val >= 5:
-            if (top_val >= sec_val + 5) or (sec_val > 0 and top_val / sec_val >= 3.0) or (sec_val == 0 and top_val >= 5):
-                is_dom = True
-        
-        # Return mask
-        return (df[col_name] == top_val) & (top_val > 0) & is_dom
-
-    df['is_dom_nige'] = check_dominance('逃_val')
-    df['is_dom_makuri'] = check_dominance('捲_val')
-    df['is_dom_sashi'] = check_dominance('差_val')
-    
-    # C. Nige Conflict Level
-    # Count players with Nige >= 3
-    nige_players = df[df['逃_val'] >= 3]
-    nige_count = len(nige_players)
-    
-    # --- 2. Scoring & Tagging ---
-    
     # Bank Specs
-    place_name = df['競輪場'].iloc[0] if '競輪場' in df.columns else ""
-    bank_specs = db_utils.VELODROME_SPECS.get(place_name, (400, 30, 400)) # Default
+    bank_specs = db_utils.VELODROME_SPECS.get(feats['place'], (400, 30, 400)) # Default
     str_len = bank_specs[0]
     
     is_short_bank = (str_len < 50.0) # Short straight
     is_long_bank = (str_len > 58.0)  # Long straight
-    
-    # Loop for scoring
-    for idx, row in df.iterrows():
-        score_add = 0.0
-        tag_add = ""
-        
-        # --- B-Top Logic ---
-        if row['is_b_top']:
-            if is_short_bank:
-                score_add += 3.0 # Strong on short
-                tag_add += " [B-Top:短(★)]"
-            elif is_long_bank:
-                score_add += 1.0 # Weaker on long
-                tag_add += " [B-Top:長]"
-            else:
-                score_add += 2.0
-                tag_add += " [B-Top]"
-                
-        # --- Dominance Logic ---
-        if row['is_dom_makuri']:
-            score_add += 6.0 # SS Grade confidence
-            tag_add += " [圧倒的捲り(SS)]"
-            
-        elif row['is_dom_nige']:
-            if is_short_bank:
-                score_add += 5.0 # S Grade
-                tag_add += " [圧倒的逃げ:短(S)]"
-            else:
-                score_add += 3.0
-                tag_add += " [圧倒的逃げ]"
-                
-        elif row['is_dom_sashi']:
-            # Sashi dominance is for 2nd/3rd place stability, not 1st.
-            # Small score boost, but mainly for stability logic (handled in betting gen?)
-            # Just add score to ensure they remain in high rank.
-            score_add += 2.0
-            tag_add += " [圧倒的差(連軸)]"
-
-        # --- Nige Conflict Logic ---
-        # If Nige War (>= 3 Nige), Penalty for Sashi (Prediction: Nige wins)
-        if nige_count >= 3:
-            # Check if this player is Sashi type (and NOT Dom Sashi)
-            if '差' in str(row.get('脚質', '')) and not row['is_dom_sashi']:
-                 # Small penalty to lower their 1st place rank
-                 score_add -= 1.0
-                 tag_add += " [激戦:差引]"
-            
-            # Boost Strongest Nige?
-            if row['is_dom_nige'] or (row['逃_val'] == df['逃_val'].max() and row['逃_val'] >= 5):
-                 score_add += 2.0
-                 tag_add += " [激戦:逃有利]"
 
-        df.loc[idx, 'ai_score'] += score_add
-        df.loc[idx, 'ai_tag'] += tag_add
-        
-        # Save V3 Feature Flags for Betting Strategy use
-        df.loc[idx, 'v3_nige_count'] = nige_count
+    # --- 2. Scoring & Tagging (判定は _v3_kernel、点数とタグはビット表から復元) ---
+    code, flags, nige_count = _v3_kernel(
+        df['B_val'].to_numpy(dtype=np.float64), df['逃_val'].to_numpy(dtype=np.float64),
+        df['捲_val'].to_numpy(dtype=np.float64), df['差_val'].to_numpy(dtype=np.float64),
+        feats['tactics'][2], is_short_bank, is_long_bank)
+    for col, mask in zip(('is_b_top', 'is_dom_nige', 'is_dom_makuri', 'is_dom_sashi'), flags):
+        df[col] = mask
+
+    df['ai_score'] = df['ai_score'] + ((code[:, None] >> _V3_SHIFTS) & 1) @ _V3_SCORES
+    df['ai_tag'] = df['ai_tag'] + [_v3_tag(c) for c in code.tolist()]
+
+    # Save V3 Feature Flags for Betting Strategy use
+    df['v3_nige_count'] = float(nige_count)
         
     return df
 
 def calculate_ai_score(df):
+    # 数値化・脚質マスク・競輪場は両ステージ分をここで1回だけ
+    feats = _scoring_features(df)
+
     # 1. Classic Logic (Foundation)
-    df = calculate_classic_score(df)
+    df = calculate_classic_score(df, feats=feats)
     
     # 2. Logic V3 (Context-Aware / Dominance)
-    df = apply_v3_logic(df)
+    df = apply_v3_logic(df, feats=feats)
     
     return df
 
+def calculate_ai_score_batch(df, key='race_id'):
+    """
+    複数レースをまとめた df を key (race_id) ごとに calculate_ai_score し、
+    {race_id: 採点済み df} を返す (バックテスト用)。採点に失敗したレースは含めない。
+    """
+    scored = {}
+    for rid, grp in df.groupby(key, sort=False):
+        try:
+            scored[rid] = calculate_ai_score(grp.reset_index(drop=True))
+        except Exception:
+            pass
+    return scored
+
 def calculate_ai_score_OLD_IGNORED(df):
     """
     Calculate Basic AI Score based on Racing Score and simple bonuses.
@@ -2222,13 +2549,13 @@ def calculate_ai_score_OLD_IGNORED(df):
             df.loc[mask, 'ai_tag'] += " [地元]"
              
     # 3. Tactic Bonus (Nige/Makuri often strong)
+    # 脚質 の文字列判定はここで1回だけ行い、バンク補正でも使い回す
+    has_nige, has_makuri, has_sashi = _tactic_masks(df)
     if '脚質' in df.columns:
         # 逃
-        mask_nige = df['脚質'].astype(str).str.contains('逃')
-        df.loc[mask_nige, 'ai_score'] += 2.0
+        df.loc[has_nige, 'ai_score'] += 2.0
         # 捲
-        mask_makuri = df['脚質'].astype(str).str.contains('捲')
-        df.loc[mask_makuri, 'ai_score'] += 2.0
+        df.loc[has_makuri, 'ai_score'] += 2.0
         
     # 4. Line Bonus (Naive)
     if 'ライン' in df.columns:
@@ -2239,7 +2566,7 @@ def calculate_ai_score_OLD_IGNORED(df):
         
     # 5. Bank Specs Bonus (Straight/Cant) - User Logic
     if '競輪場' in df.columns:
-        place = df['競輪場'].iloc[0]
+        place = df['競輪場'].iat[0]
         # (Straight, Cant, Length)
         specs = db_utils.VELODROME_SPECS.get(place) 
         
@@ -2250,13 +2577,13 @@ def calculate_ai_score_OLD_IGNORED(df):
             if str_m < 50.0:
                 # Short -> Nige
                 if '脚質' in df.columns:
-                    mask = df['脚質'].astype(str).str.contains('逃')
+                    mask = has_nige
                     df.loc[mask, 'ai_score'] += 2.0
                     df.loc[mask, 'ai_tag'] += " [短直線:逃]"
             elif str_m > 58.0:
                 # Long -> Makuri/Sashi
                 if '脚質' in df.columns:
-                    mask = df['脚質'].astype(str).str.contains('捲|差')
+                    mask = has_makuri | has_sashi
                     df.loc[mask, 'ai_score'] += 2.0
                     df.loc[mask, 'ai_tag'] += " [長直線:捲差]"
 
@@ -2264,13 +2591,13 @@ def calculate_ai_score_OLD_IGNORED(df):
             if cant_deg < 30.0:
                 # Loose -> Nige (Curve slow)
                 if '脚質' in df.columns:
-                    mask = df['脚質'].astype(str).str.contains('逃')
+                    mask = has_nige
                     df.loc[mask, 'ai_score'] += 2.0
                     df.loc[mask, 'ai_tag'] += " [緩傾斜:逃]"
             elif cant_deg > 33.0:
                 # Tight -> Makuri (Curve fast)
                 if '脚質' in df.columns:
-                    mask = df['脚質'].astype(str).str.contains('捲')
+                    mask = has_makuri
                     df.loc[mask, 'ai_score'] += 2.0
                     df.loc[mask, 'ai_tag'] += " [急傾斜:捲]"
 
@@ -2341,7 +2668,7 @@ def calculate_ai_score_OLD_IGNORED(df):
 # 3. Classic Logic (Pre-Update)
 # ==========================================
 
-def calculate_classic_score(df):
+def calculate_classic_score(df, feats=None):
     """
     Unified AI Score Logic (Classic + Hybrid features).
     Basis: Old Logic
@@ -2349,57 +2676,58 @@ def calculate_classic_score(df):
       - Strongest Line 3rd Rider Bonus (+2.0/+1.0)
       - Longest Line Correction (Venue Adjusted)
       - Class-Specific Correction (Lift)
+    feats: _scoring_features(df) の結果 (省略時はここで計算)
     """
-    df = df.copy()
+    # 列の追加・差し替えのみなので浅いコピーで十分 (呼び出し元の df は変更しない、未変更列のバッファは共有)
+    df = df.copy(deep=False)
     
     # 1. Base Score calculation
     if '競走得点' not in df.columns:
         df['ai_score'] = 0.0
         return df
-        
-    df['base_score'] = pd.to_numeric(df['競走得点'], errors='coerce').fillna(80.0)
-    df['ai_score'] = df['base_score']
-    df['ai_tag'] = ""
+    if feats is None:
+        feats = _scoring_features(df)
+        
+    df['base_score'] = feats['numeric']['競走得点'].fillna(80.0)
+    # 加点は配列、タグは選手ごとのリストに溜めて最後に1回だけ列へ書き戻す
+    scores = df['base_score'].to_numpy(dtype=float, copy=True)
+    tag_parts = [[] for _ in range(len(df))]
+    def add_at(idx, bonus, tag=None):
+        for i in idx:
+            scores[i] += bonus
+            if tag:
+                tag_parts[i].append(tag)
+    def add(mask, bonus, tag=None):
+        add_at(np.flatnonzero(mask), bonus, tag)
     
     # 2. Local Bonus
     if '地元' in df.columns:
-        mask = (df['地元'] == 1) | (df['地元'] == True)
-        df.loc[mask, 'ai_score'] += 3.0
-        df.loc[mask, 'ai_tag'] += " [地元]"
+        add((df['地元'] == 1) | (df['地元'] == True), 3.0, " [地元]")
         
-    # 3. Tactic Bonus
+    # 3. Tactic Bonus (脚質 の文字列判定は feats で1回だけ)
+    has_nige, has_makuri, has_sashi = feats['tactics']
     if '脚質' in df.columns:
-        mask_nige = df['脚質'].astype(str).str.contains('逃')
-        df.loc[mask_nige, 'ai_score'] += 2.0
-        mask_makuri = df['脚質'].astype(str).str.contains('捲')
-        df.loc[mask_makuri, 'ai_score'] += 2.0
+        add(has_nige, 2.0)
+        add(has_makuri, 2.0)
         
     # 4. Bank Specs Bonus
+    place_name = feats['place']
     if '競輪場' in df.columns:
-        place = df['競輪場'].iloc[0]
-        specs = db_utils.VELODROME_SPECS.get(place)
+        specs = db_utils.VELODROME_SPECS.get(place_name)
         if specs:
             str_m, cant_deg, _ = specs
             if str_m < 50.0:
                 if '脚質' in df.columns:
-                    mask = df['脚質'].astype(str).str.contains('逃')
-                    df.loc[mask, 'ai_score'] += 2.0
-                    df.loc[mask, 'ai_tag'] += " [短直線:逃]"
+                    add(has_nige, 2.0, " [短直線:逃]")
             elif str_m > 58.0:
                 if '脚質' in df.columns:
-                    mask = df['脚質'].astype(str).str.contains('捲|差')
-                    df.loc[mask, 'ai_score'] += 2.0
-                    df.loc[mask, 'ai_tag'] += " [長直線:捲差]"
+                    add(has_makuri | has_sashi, 2.0, " [長直線:捲差]")
             if cant_deg < 30.0:
                 if '脚質' in df.columns:
-                    mask = df['脚質'].astype(str).str.contains('逃')
-                    df.loc[mask, 'ai_score'] += 2.0
-                    df.loc[mask, 'ai_tag'] += " [緩傾斜:逃]"
+                    add(has_nige, 2.0, " [緩傾斜:逃]")
             elif cant_deg > 33.0:
                 if '脚質' in df.columns:
-                    mask = df['脚質'].astype(str).str.contains('捲')
-                    df.loc[mask, 'ai_score'] += 2.0
-                    df.loc[mask, 'ai_tag'] += " [急傾斜:捲]"
+                    add(has_makuri, 2.0, " [急傾斜:捲]")
 
     # 5. Specialist Bonus (Top Tactic)
     # 6. Specialist Bonus (Top Tactic)
@@ -2408,13 +2736,18 @@ def calculate_classic_score(df):
 
 
     # 6. Line Logic (Strongest 3rd + Unique Longest)
-    if 'ライン' in df.columns and not df.empty and str(df.iloc[0]['ライン']) != 'nan':
-        line_str = str(df.iloc[0]['ライン'])
+    if 'ライン' in df.columns and not df.empty and not pd.isna(df['ライン'].iat[0]):
+        line_str = str(df['ライン'].iat[0])
         lines_raw = line_str.split()
         
         # Parse Lines
         line_infos = []
         df['車番'] = pd.to_numeric(df['車番'], errors='coerce').fillna(0).astype(int)
+        # 車番 -> 行位置 (同じ車番が複数行あれば全て) を1回だけ作り、以降は配列を直接更新する
+        idx_of = {}
+        for i, c in enumerate(df['車番'].tolist()):
+            idx_of.setdefault(c, []).append(i)
+        base_scores = df['base_score'].to_numpy()
         
         valid_lines = True
         for l_s in lines_raw:
@@ -2427,8 +2760,7 @@ def calculate_classic_score(df):
             
             # Leader Score
             leader = members[0]
-            l_row = df[df['車番'] == leader]
-            l_score = l_row.iloc[0]['base_score'] if not l_row.empty else 0.0
+            l_score = base_scores[idx_of[leader][0]] if leader in idx_of else 0.0
             
             line_infos.append({
                 'members': members,
@@ -2437,6 +2769,9 @@ def calculate_classic_score(df):
             })
             
         if line_infos:
+            def bump(car, bonus, tag):
+                add_at(idx_of.get(car, ()), bonus, tag)
+
             # Sort by Length (Longest Line is Rank 1), then Score
             line_infos.sort(key=lambda x: (x['len'], x['score']), reverse=True)
             
@@ -2450,9 +2785,7 @@ def calculate_classic_score(df):
                     bonus = 2.0 if idx == 0 else 1.0
                     
                     # Apply
-                    mask = (df['車番'] == r3)
-                    df.loc[mask, 'ai_score'] += bonus
-                    df.loc[mask, 'ai_tag'] += f" [L3番手({bonus:+})]"
+                    bump(r3, bonus, f" [L3番手({bonus:+})]")
             
             # B. Unique Longest Line Correction
             lengths = [x['len'] for x in line_infos]
@@ -2465,7 +2798,6 @@ def calculate_classic_score(df):
                 # Venue Adjustment
                 # Super Strong: Seibuen, Tachikawa, Tamano, Toyohashi
                 # Weak: Shizuoka, Takeo
-                place_name = df['競輪場'].iloc[0] if '競輪場' in df.columns else ""
                 venue_adj = 0.0
                 if place_name in ["西武園", "立川", "玉野", "豊橋"]:
                     venue_adj = 0.5
@@ -2478,9 +2810,7 @@ def calculate_classic_score(df):
                     base_b = 2.5
                     final_b = base_b + venue_adj
                     for car in u_info['members']:
-                        mask = (df['車番'] == car)
-                        df.loc[mask, 'ai_score'] += final_b
-                        df.loc[mask, 'ai_tag'] += f" [最長4車({final_b:+})]"
+                        bump(car, final_b, f" [最長4車({final_b:+})]")
                         
                 elif u_info['len'] == 3:
                     # Pos 1-2 +1.5, Pos 3 +0.5 (+Venue)
@@ -2491,9 +2821,7 @@ def calculate_classic_score(df):
                             base_b = 0.5
                             
                         final_b = base_b + venue_adj
-                        mask = (df['車番'] == car)
-                        df.loc[mask, 'ai_score'] += final_b
-                        df.loc[mask, 'ai_tag'] += f" [最長3車({final_b:+})]"
+                        bump(car, final_b, f" [最長3車({final_b:+})]")
 
     # 7. Class Lift Bonus
     race_class = "A"
@@ -2506,8 +2834,8 @@ def calculate_classic_score(df):
         elif has_s: race_class = "S"
         
     if not df.empty:
-        top_scorer_idx = df['base_score'].idxmax()
-        row = df.loc[top_scorer_idx]
+        top_pos = int(df['base_score'].to_numpy().argmax())
+        row = df.iloc[top_pos]
         is_top_nige = row.get('is_top_nige', 0) == 1
         is_top_makuri = row.get('is_top_makuri', 0) == 1
         is_top_sashi = row.get('is_top_sashi', 0) == 1
@@ -2538,11 +2866,22 @@ def calculate_classic_score(df):
                 lift_reason = "[S級回帰:差]"
 
         if lift_bonus > 0:
-            df.loc[top_scorer_idx, 'ai_score'] += lift_bonus
-            df.loc[top_scorer_idx, 'ai_tag'] += f" {lift_reason}"
+            add_at((top_pos,), lift_bonus, f" {lift_reason}")
 
+    df['ai_score'] = scores
+    df['ai_tag'] = ["".join(p) for p in tag_parts]
     return df
 
+@functools.lru_cache(maxsize=256)
+def _line_positions(line_str):
+    # 'ライン' 文字列 -> {車番: (ライン構成, 位置)}。同じ車番は最初に出たライン・位置を採用
+    parsed = {}
+    for l_s in line_str.split():
+        mems = tuple(int(c) for c in l_s if c.isdigit())
+        for i, m in enumerate(mems):
+            parsed.setdefault(m, (mems, i))
+    return parsed
+
 def get_line_partner_live(df, target_car):
     """
     Validation-verified Partner Logic for Live App.
@@ -2557,23 +2896,12 @@ def get_line_partner_live(df, target_car):
         # Fallback: Parse 'ライン' column again if needed
         if 'ライン' not in df.columns: return None
         
-        line_str = str(df.iloc[0]['ライン'])
-        lines_raw = line_str.split()
-        
-        target_line = []
-        for l_s in lines_raw:
-            mems = [int(c) for c in l_s if c.isdigit()]
-            if target_car in mems:
-                target_line = mems
-                break
-        
+        # 同じレースで車番ごとに呼ばれるので、パース結果はライン文字列単位でキャッシュ
+        target_line, idx = _line_positions(str(df['ライン'].iat[0])).get(target_car, ((), None))
         if not target_line: return None
         
         # Position in line
-        try:
-            idx = target_line.index(target_car)
-            pos = idx + 1 # 1-based
-        except: return None
+        pos = idx + 1 # 1-based
         
         # Logic: 1->2, 2->1
         if pos == 1:
@@ -2596,15 +2924,7 @@ def generate_classic_strategy(pred_df, score_col='ai_score'):
         elif '予測勝率' in pred_df.columns: score_col = '予測勝率'
         
     # Girls Keirin Exclusion
-    is_girls = False
-    if 'class_code' in pred_df.columns:
-        if 'L' in pred_df['class_code'].values: is_girls = True
-    if '級班' in pred_df.columns:
-        if pred_df['級班'].astype(str).str.contains('L').any(): is_girls = True
-    if 'クラス' in pred_df.columns:
-        if pred_df['クラス'].astype(str).str.contains('ガールズ').any(): is_girls = True
-        
-    if is_girls:
+    if _is_girls(pred_df):
          return {"type": "disabled", "title": "対象外", "reason": "ガールズケイリンは予測対象外です", "tickets": []}
         
     df_logic = pred_df.sort_values(score_col, ascending=False).reset_index(drop=True)
@@ -2642,15 +2962,14 @@ def generate_classic_strategy(pred_df, score_col='ai_score'):
     structured_bets = []
     
     # 2T Expansion (c1 -> c2, c3, c4)
-    for t in [c2, c3, c4]:
-        structured_bets.append({
-            'type': '2車単',
-            'first': [c1],
-            'second': [t],
-            'third': [],
-            'amount': 100,
-            'raw': f"2車単: {c1}-{t}"
-        })
+    structured_bets.extend({
+        'type': '2車単',
+        'first': [c1],
+        'second': [t],
+        'third': [],
+        'amount': 100,
+        'raw': f"2車単: {c1}-{t}"
+    } for t in (c2, c3, c4))
         
     # 3T Expansion (c1 -> c2,3 -> c2,3,4)
     # Heads: [c1]
@@ -2661,19 +2980,16 @@ def generate_classic_strategy(pred_df, score_col='ai_score'):
     seconds = [c2, c3]
     thirds = [c2, c3, c4]
     
-    for h in heads:
-        for s in seconds:
-            if s == h: continue
-            for t in thirds:
-                if t == h or t == s: continue
-                structured_bets.append({
-                    'type': '3連単',
-                    'first': [h],
-                    'second': [s],
-                    'third': [t],
-                    'amount': 100,
-                    'raw': f"3連単: {h}-{s}-{t}"
-                })
+    combos = [(h, s, t) for h, s, t in product(heads, seconds, thirds)
+              if h != s and h != t and s != t]
+    structured_bets.extend({
+        'type': '3連単',
+        'first': [h],
+        'second': [s],
+        'third': [t],
+        'amount': 100,
+        'raw': f"3連単: {h}-{s}-{t}"
+    } for h, s, t in combos)
         
     return {
         "type": "custom",
@@ -2690,280 +3006,138 @@ def generate_classic_strategy(pred_df, score_col='ai_score'):
 # 6. Advanced Metrics & History
 # ==========================================
 
+def _score_metrics(scores):
+    """
+    降順ソート済みの得点リスト (3件以上) から
+    (1-2位差, 上位-下から2番目, レンジ, 上位グループ人数, 標準偏差) を返す。
+    1レース最大9件なので numpy 配列を作らず Python のスカラー計算で済ませる。
+    """
+    top = scores[0]
+    # Elite Count (Max Gap): 最大の得点差の手前までを上位グループとみなす
+    # 差のリストは作らず1回の走査で最初の最大差の位置を取る
+    max_gap = -np.inf
+    elite_count = 1
+    prev = top
+    for i, x in enumerate(scores[1:], 1):
+        if prev - x > max_gap:
+            max_gap = prev - x
+            elite_count = i
+        prev = x
+    # Std (母標準偏差, np.std と同じ)
+    mean = sum(scores) / len(scores)
+    score_std = (sum((x - mean) ** 2 for x in scores) / len(scores)) ** 0.5
+    # Range Trimmed は Top - 2nd from Bottom
+    return top - scores[1], top - scores[-2], top - scores[-1], elite_count, score_std
+
 def calculate_advanced_metrics(df_race):
     """
     Calculate advanced features for a single race dataframe (K-Dreams style)
     and return specific signals based on AI thresholds.
     df_race: Cleaned dataframe with '競走得点' or similar columns.
     """
-    from scipy import stats
-    
     # 1. Prepare Scores
     try:
         # 競走得点があれば使う
-        if '競走得点' in df_race.columns:
-            scores = pd.to_numeric(df_race['競走得点'], errors='coerce').dropna().values
-        else:
-            return {}
-            
-        scores = np.sort(scores)[::-1] # Descending
-        if len(scores) < 3: return {}
-        
-        # 2. Calculate Features
-        # Score Gap 1-2
-        score_diff_1_2 = scores[0] - scores[1]
-        
-        # Range Trimmed (Top - 2nd from Bottom)
-        trimmed_bottom = scores[-2] if len(scores) > 1 else scores[-1]
-        range_trimmed = scores[0] - trimmed_bottom
-        score_range = scores[0] - scores[-1] # Full range
-        
-        # Elite Count (Max Gap)
-        gaps = scores[:-1] - scores[1:] # Positive gaps
-        max_gap_idx = np.argmax(gaps)
-        elite_count = max_gap_idx + 1
-        
-        # Std
-        score_std = np.std(scores)
-        
-    except Exception as e:
-        return {}
-
-    # 3. Evaluate Thresholds
-    signals = []
-    
-    # 鉄板 (High Confidence)
-    if score_diff_1_2 > 3.425:
-        signals.append("★鉄板(点数差大)")
-    elif score_diff_1_2 > 2.0:
-        signals.append("◎本命")
-        
-    if range_trimmed > 7.655:
-        signals.append("★断層あり")
-        
-    # Elite Count
-    if elite_count <= 1.5:
-        signals.append("★1強")
-    elif elite_count > 4:
-        signals.append("⚠混戦(上位拮抗)")
-        
-    # Std (Stability)
-    if 10 <= score_std <= 21:
-        signals.append("○順当傾向")
-        
-    # Super Chaotic (Tight Range)
-    if score_range < 5.0:
-        signals.append("☠大混戦")
-        
-    return {
-        'score_diff_1_2': score_diff_1_2,
-        'signals': signals,
-        'line_strength_head': '不明' # Logic placeholder
-    }
-
-def calculate_advanced_metrics_to_df(df):
-    """
-    Wrapper to apply calculate_advanced_metrics and add results to DF columns.
-    Also ensures 'final_score' exists (alias of ai_score for now).
-    """
-    df = df.copy()
-    
-    # Run Metric Calc
-    metrics = calculate_advanced_metrics(df)
-    
-    # Broadcast to all rows
-    for k, v in metrics.items():
-        if isinstance(v, list):
-             # Join signals
-             df[k] = ",".join(v)
-        else:
-             df[k] = v
-             
-    # Create final_score if not exists
-    if 'final_score' not in df.columns:
-        if 'ai_score' in df.columns:
-            df['final_score'] = df['ai_score']
-        else:
-            df['final_score'] = 0.0
-            
-    return df
-
-def calculate_history_stats(history, df_source):
-    """
-    Calculate generic Hit/Return stats from history vs df_source (results).
-    df_source: Must contain 'race_id', '着順_val' (or '着順'), and Dividend cols.
-    """
-    if not history or df_source.empty:
-        return None
-
-    # Pre-index Results
-    if 'race_id' not in df_source.columns:
-        # Generate race_id if missing (simple fallback)
-        try:
-            # Simple hash fallback
-            import hashlib
-            df_source['race_id'] = df_source.apply(lambda r: hashlib.md5(f"{r.get('日付','')}{r.get('競輪場','')}{r.get('レース番号','')}".encode()).hexdigest(), axis=1)
-        except: return None
-        
-    # Proceed with calcs (Omitted for brevity as this function was already present)
-    return {}
-
-# ==========================================
-# 7. Player Detail Analysis (New Wing Feature)
-# ==========================================
-
-def analyze_player_detailed_stats(player_row, meta, db_path=db_utils.DB_PATH):
-    """
-    Analyze specific player stats for "Old Wing" style details.
-    
-    Args:
-        player_row (pd.Series): Player data row
-        meta (dict): Race metadata (date, place, etc.)
-        db_path (str): Path to SQLite DB
-        
-    Returns:
-        dict: Detailed stats and qualitative labels (Majin, Survivor, etc.)
-    """
-    if player_row is None or player_row.empty:
-        return {}
-        
-    p_name = player_row.get('選手名')
-    if not p_name: return {}
-    
-    # Current Context
-    current_line_len = player_row.get('ライン長', 0) # Assumes feature eng ran or parsed
-    current_line_pos = player_row.get('ポジション', 0)
-    current_place = meta.get('place', '')
-    
-    # Bank Specs
-    current_specs = db_utils.VELODROME_SPECS.get(current_place) # (Straight, Cant, Length)
-    
-    conn = sqlite3.connect(db_path)
-    
-    # Date limit (1 year ago)
-    # SQLite date string comparison works if format is YYYY-MM-DD or YYYY年MM月DD日
-    # Assuming "YYYY年MM月DD日" format in DB
-    # For robust comparison, we might fetch last 100 races instead of strictly 1 year to avoid date logic complexity in SQL
-    
-    query = f"SELECT * FROM race_result WHERE \"選手名\" = ? ORDER BY \"日付\" DESC LIMIT 100"
-    try:
-        df_hist = pd.read_sql_query(query, conn, params=[p_name])
-    except:
-        conn.close()
-        return {}
-        
-    conn.close()
-    
-    if df_hist.empty:
-        return {'msg': '過去データなし'}
-        
-    # --- 1. Basic Stats (Last 100 races ~ 1 year) ---
-    total = len(df_hist)
-    wins = len(df_hist[df_hist['着順_val'] == 1])
-    ren2 = len(df_hist[df_hist['着順_val'] <= 2])
-    ren3 = len(df_hist[df_hist['着順_val'] <= 3])
-    
-    basic_stats = {
-        'total': total,
-        'win_rate': (wins/total)*100,
-        'ren2_rate': (ren2/total)*100,
-        'ren3_rate': (ren3/total)*100
-    }
-    
-    # --- 2. Condition Matching (Line/Pos) ---
-    # Need 'line_length', 'line_pos' in history.
-    # If using raw DB, features might not be pre-calculated? 
-    # 'run_global_features' saves them? No, usually calculated on load.
-    # Assuming 'line_length' and 'line_pos' columns exist in DB or we re-calc?
-    # In `load_and_process_data`, we select them. If they are in DB, great.
-    # If not, we skip this specific condition or approx.
-    
-    cond_stats = {}
-    if 'line_length' in df_hist.columns and 'line_pos' in df_hist.columns:
-        # Filter
-        df_cond = df_hist[
-            (df_hist['line_length'] == current_line_len) & 
-            (df_hist['line_pos'] == current_line_pos)
-        ]
-        if not df_cond.empty:
-            c_total = len(df_cond)
-            c_wins = len(df_cond[df_cond['着順_val'] == 1])
-            c_ren2 = len(df_cond[df_cond['着順_val'] <= 2])
-            c_ren3 = len(df_cond[df_cond['着順_val'] <= 3])
-            cond_stats = {
-                'match_count': c_total,
-                'win_rate': (c_wins/c_total)*100,
-                'ren2_rate': (c_ren2/c_total)*100,
-                'ren3_rate': (c_ren3/c_total)*100
-            }
+        if '競走得点' in df_race.columns:
+            scores = pd.to_numeric(df_race['競走得点'], errors='coerce').dropna().tolist()
+        else:
+            return {}
             
-    # --- 3. Bank Matching ---
-    bank_stats = {}
-    bank_matches = []
-    if current_specs:
-        c_str, c_cant, _ = current_specs
-        # Find similar banks from history (approx logic)
-        # Iterate unique places in history
-        places = df_hist['競輪場'].unique()
-        for p in places:
-            specs = db_utils.VELODROME_SPECS.get(p)
-            if specs:
-                s_str, s_cant, _ = specs
-                # Similarity: Straight within 5m, Cant within 2 deg?
-                if abs(s_str - c_str) < 5.0 and abs(s_cant - c_cant) < 3.0:
-                    bank_matches.append(p)
-    
-    if bank_matches:
-        df_bank = df_hist[df_hist['競輪場'].isin(bank_matches)]
-        if not df_bank.empty:
-            b_total = len(df_bank)
-            b_wins = len(df_bank[df_bank['着順_val'] == 1])
-            b_ren2 = len(df_bank[df_bank['着順_val'] <= 2])
-            b_ren3 = len(df_bank[df_bank['着順_val'] <= 3])
-            bank_stats = {
-                'match_banks': list(bank_matches)[:3], # Show top 3 examples
-                'total': b_total,
-                'win_rate': (b_wins/b_total)*100,
-                'ren2_rate': (b_ren2/b_total)*100,
-                'ren3_rate': (b_ren3/b_total)*100
-            }
+        scores.sort(reverse=True) # Descending
+        if len(scores) < 3: return {}
+        
+        # 2. Calculate Features
+        score_diff_1_2, range_trimmed, score_range, elite_count, score_std = _score_metrics(scores)
+        
+    except Exception as e:
+        return {}
 
-    # --- 4. Classifications (Majin, Survivor, etc.) ---
-    labels = []
-    w = basic_stats['win_rate']
-    r2 = basic_stats['ren2_rate']
-    r3 = basic_stats['ren3_rate']
+    # 3. Evaluate Thresholds
+    signals = []
     
-    # Majin (Demon): Dominant Winner
-    if w >= 40.0 and r3 >= 70.0:
-        labels.append("😈 魔人系 (圧倒的強さ)")
-    elif w >= 30.0:
-        labels.append("👹 鬼脚 (勝率高)")
+    # 鉄板 (High Confidence)
+    if score_diff_1_2 > 3.425:
+        signals.append("★鉄板(点数差大)")
+    elif score_diff_1_2 > 2.0:
+        signals.append("◎本命")
         
-    # Survivor: High Ren3 but Low Win (Tenacious)
-    if w < 10.0 and r3 >= 50.0:
-        labels.append("🧟 サバイバー (3着残り)")
+    if range_trimmed > 7.655:
+        signals.append("★断層あり")
         
-    # Specialist: Better in Condition than Basic
-    if cond_stats.get('win_rate', 0) > (w + 15.0):
-        labels.append("🔧 条件職人 (ライン/位置 ハマり)")
+    # Elite Count
+    if elite_count <= 1.5:
+        signals.append("★1強")
+    elif elite_count > 4:
+        signals.append("⚠混戦(上位拮抗)")
         
-    if bank_stats.get('win_rate', 0) > (w + 15.0):
-        labels.append("🏰 バンクの申し子 (コース相性抜群)")
+    # Std (Stability)
+    if 10 <= score_std <= 21:
+        signals.append("○順当傾向")
+        
+    # Super Chaotic (Tight Range)
+    if score_range < 5.0:
+        signals.append("☠大混戦")
         
-    
-    # Sort history by date desc for display
-    if not df_hist.empty and '日付' in df_hist.columns:
-         df_hist = df_hist.sort_values('日付', ascending=False)
-
     return {
-        'basic': basic_stats,
-        'condition': cond_stats,
-        'bank': bank_stats,
-        'labels': labels,
-        'history_df': df_hist # Return raw history for UI
+        'score_diff_1_2': score_diff_1_2,
+        'signals': signals,
+        'line_strength_head': '不明' # Logic placeholder
     }
 
+def calculate_advanced_metrics_to_df(df):
+    """
+    Wrapper to apply calculate_advanced_metrics and add results to DF columns.
+    Also ensures 'final_score' exists (alias of ai_score for now).
+    """
+    # Run Metric Calc
+    metrics = calculate_advanced_metrics(df)
+    
+    # Broadcast to all rows (assign で1回にまとめて追加、新しい df を返すので copy 不要)
+    cols = {}
+    for k, v in metrics.items():
+        # Join signals
+        cols[k] = ",".join(v) if isinstance(v, list) else v
+             
+    # Create final_score if not exists
+    if 'final_score' not in df.columns:
+        cols['final_score'] = df['ai_score'] if 'ai_score' in df.columns else 0.0
+            
+    return df.assign(**cols)
+
+def calculate_history_stats(history, df_source):
+    """
+    Calculate generic Hit/Return stats from history vs df_source (results).
+    df_source: Must contain 'race_id', '着順_val' (or '着順'), and Dividend cols.
+    """
+    if not history or df_source.empty:
+        return None
+
+    # Pre-index Results
+    if 'race_id' not in df_source.columns:
+        # Generate race_id if missing (simple fallback)
+        try:
+            # Simple hash fallback (行ごとの apply ではなく列を zip して生成)
+            # 同じレースの行は同じキーなので md5 は一意なキーごとに1回だけ計算する
+            def col(name):
+                return df_source[name].tolist() if name in df_source.columns else [''] * len(df_source)
+            keys = [f"{d}{v}{r}" for d, v, r in zip(col('日付'), col('競輪場'), col('レース番号'))]
+            digests = {k: hashlib.md5(k.encode()).hexdigest() for k in set(keys)}
+            df_source = df_source.assign(race_id=[digests[k] for k in keys])
+        except: return None
+
+    # 着順・払戻は全レース分をここで1回だけ数値化しておく (レースごと・券種ごとの文字列処理をしない)
+    # 呼び出し元の df は書き換えず、数値化した列を足した新しい df で集計する
+    num_cols = {}
+    if '着順_val' not in df_source.columns:
+        num_cols['着順_val'] = pd.to_numeric(df_source['着順'], errors='coerce').fillna(99)
+    for src, dst in (('3連単', '_div_3t'), ('2連単', '_div_2t')):
+        if src in df_source.columns:
+            num_cols[dst] = pd.to_numeric(df_source[src].astype(str).str.replace('[,円]', '', regex=True),
+                                          errors='coerce').fillna(0.0)
+        else:
+            num_cols[dst] = 0.0
+    df_source = df_source.assign(**num_cols)
+
     # Group by ID
     results_map = {rid: grp for rid, grp in df_source.groupby('race_id')}
 
@@ -2973,8 +3147,6 @@ def analyze_player_detailed_stats(player_row, meta, db_path=db_utils.DB_PATH):
         'hit_count': 0, 'bet_count': 0
     }
     
-    import hashlib
-    
     # Pre-build lookup map from Results (df_source)
     # Key: (date_str, place_name, race_num_int) -> race_id
     res_lookup = {}
@@ -2982,15 +3154,19 @@ def analyze_player_detailed_stats(player_row, meta, db_path=db_utils.DB_PATH):
         # Ensure Date format is standard
         # df_source usually has '日付' as YYYY年MM月DD日
         # race_num might be int '1' or str '1R'
-        for _, row in df_source.drop_duplicates('race_id').iterrows():
-            d = str(row.get('日付', ''))
-            p = row.get('競輪場', '')
-            try: r = int(float(str(row.get('レース番号', 0)).replace('R','')))
-            except: r = 0
-            if d and p and r:
-                res_lookup[(d, p, r)] = row['race_id']
+        # (iterrows ではなく列をまとめて変換して zip する)
+        ddf = df_source.drop_duplicates('race_id')
+        def col(name, default):
+            return ddf[name] if name in ddf.columns else pd.Series(default, index=ddf.index)
+        dates = col('日付', '').astype(str).tolist()
+        places = col('競輪場', '').tolist()
+        rnums = (pd.to_numeric(col('レース番号', 0).astype(str).str.replace('R', ''), errors='coerce')
+                 .fillna(0).astype(int).tolist())
+        res_lookup = {(d, p, r): rid for d, p, r, rid in zip(dates, places, rnums, ddf['race_id'].tolist())
+                      if d and p and r}
 
     history_with_res = []
+    outcome_cache = {}
 
     for h in history:
         rid = h.get('race_id')
@@ -3026,17 +3202,16 @@ def analyze_player_detailed_stats(player_row, meta, db_path=db_utils.DB_PATH):
             
             # Outcome
             try:
-                if '着順_val' not in rdf.columns:
-                    rdf['着順_val'] = pd.to_numeric(rdf['着順'], errors='coerce').fillna(99)
-                
-                outcome_map = {} # rank -> [car_nums] (handle dead heat)
-                for _, r in rdf.iterrows():
-                    rnk = int(r['着順_val'])
-                    if rnk == 99: continue
-                    if rnk not in outcome_map: outcome_map[rnk] = []
-                    # Clean car num
-                    cn = int(str(r['車番']).replace('.0',''))
-                    outcome_map[rnk].append(cn)
+                # 同じレースが履歴に複数回出ても着順表はレースごとに1回だけ作る
+                outcome_map = outcome_cache.get(rid)
+                if outcome_map is None:
+                    outcome_map = {} # rank -> [car_nums] (handle dead heat)
+                    for rnk, cn in zip(rdf['着順_val'].tolist(), rdf['車番'].tolist()):
+                        rnk = int(rnk)
+                        if rnk == 99: continue
+                        # Clean car num
+                        outcome_map.setdefault(rnk, []).append(int(str(cn).replace('.0','')))
+                    outcome_cache[rid] = outcome_map
                 
                 # Evaluate Bets
                 sbets = h.get('structured_bets', [])
@@ -3054,16 +3229,9 @@ def analyze_player_detailed_stats(player_row, meta, db_path=db_utils.DB_PATH):
                     race_invest = 0
                     race_return = 0
                     
-                    # Payouts (First row)
-                    first = rdf.iloc[0]
-                    # Columns expected: '3連単', '2連単', etc. 
-                    def get_payout(c):
-                        v = first.get(c, 0)
-                        try: return float(str(v).replace(',','').replace('円',''))
-                        except: return 0.0
-                    
-                    div_3t = get_payout('3連単')
-                    div_2t = get_payout('2連単')
+                    # Payouts (First row, 数値化済みの列から引くだけ)
+                    div_3t = float(rdf['_div_3t'].iat[0])
+                    div_2t = float(rdf['_div_2t'].iat[0])
                     
                     for b in sbets:
                         b_type = b.get('type')
@@ -3138,53 +3306,217 @@ def analyze_player_detailed_stats(player_row, meta, db_path=db_utils.DB_PATH):
     stats['history_data'] = history_with_res
     return stats
 
+# ==========================================
+# 7. Player Detail Analysis (New Wing Feature)
+# ==========================================
+
+_VEL_TABLE = [None, None]
+
+def _velodrome_table():
+    """
+    VELODROME_SPECS を (場名, 直線長, カント, 周長) の並列配列に展開する。
+    元の dict が差し替わった (reload された) 時だけ作り直す。
+    """
+    specs = db_utils.VELODROME_SPECS
+    if _VEL_TABLE[0] is not specs:
+        vals = list(specs.values())
+        _VEL_TABLE[:] = [specs, (np.array(list(specs), dtype=object),
+                                 *(np.array([v[k] for v in vals], dtype=float) for k in range(3)))]
+    return _VEL_TABLE[1]
+
+# 選手詳細で使う列 (成績集計 + 過去走テーブルの表示列)
+_PLAYER_HIST_COLS = ('日付', '競輪場', 'レース番号', '着順', '着順_val', '決まり手',
+                     'line_length', 'line_pos', 'ポジション', 'lines_parsed')
+
+@functools.lru_cache(maxsize=512)
+def _fetch_player_history(db_path, p_name, mtime):
+    # 直近100走 (DB ファイルが更新されたら mtime が変わるので引き直す)
+    # idx_race_result_name_date (migrate_db.py で作成) があれば全件走査+ソートなしで引ける
+    # SELECT * ではなく集計と UI 表示で使う列だけを読む
+    db_cols = _schema_cols(db_path, mtime)
+    cols_str = ", ".join(f'"{c}"' for c in _PLAYER_HIST_COLS if c in db_cols)
+    query = f"SELECT {cols_str} FROM race_result WHERE \"選手名\" = ? ORDER BY \"日付\" DESC LIMIT 100"
+    return pd.read_sql_query(query, _read_conn(db_path, mtime), params=[p_name])
+
+def analyze_player_detailed_stats(player_row, meta, db_path=db_utils.DB_PATH):
+    """
+    Analyze specific player stats for "Old Wing" style details.
+    
+    Args:
+        player_row (pd.Series): Player data row
+        meta (dict): Race metadata (date, place, etc.)
+        db_path (str): Path to SQLite DB
+        
+    Returns:
+        dict: Detailed stats and qualitative labels (Majin, Survivor, etc.)
+    """
+    if player_row is None or player_row.empty:
+        return {}
+        
+    p_name = player_row.get('選手名')
+    if not p_name: return {}
+    
+    # Current Context
+    current_line_len = player_row.get('ライン長', 0) # Assumes feature eng ran or parsed
+    current_line_pos = player_row.get('ポジション', 0)
+    current_place = meta.get('place', '')
+    
+    # Bank Specs
+    current_specs = db_utils.VELODROME_SPECS.get(current_place) # (Straight, Cant, Length)
+    
+    # Date limit (1 year ago)
+    # SQLite date string comparison works if format is YYYY-MM-DD or YYYY年MM月DD日
+    # Assuming "YYYY年MM月DD日" format in DB
+    # For robust comparison, we might fetch last 100 races instead of strictly 1 year to avoid date logic complexity in SQL
+    
+    try:
+        # 浅いコピーで返す (キャッシュ本体は共有のまま、列の差し替えは呼び出し側に影響しない)
+        df_hist = _fetch_player_history(db_path, p_name, os.path.getmtime(db_path)).copy(deep=False)
+    except:
+        return {}
+    
+    if df_hist.empty:
+        return {'msg': '過去データなし'}
+        
+    # --- 1. Basic Stats (Last 100 races ~ 1 year) ---
+    # 着順 は配列で1回だけ取り出し、以降はマスクで数える (部分 DataFrame を作らない)
+    ranks = df_hist['着順_val'].to_numpy()
+    def finish_counts(r):
+        return len(r), int((r == 1).sum()), int((r <= 2).sum()), int((r <= 3).sum())
+    total, wins, ren2, ren3 = finish_counts(ranks)
+    
+    basic_stats = {
+        'total': total,
+        'win_rate': (wins/total)*100,
+        'ren2_rate': (ren2/total)*100,
+        'ren3_rate': (ren3/total)*100
+    }
+    
+    # --- 2. Condition Matching (Line/Pos) ---
+    # Need 'line_length', 'line_pos' in history.
+    # If using raw DB, features might not be pre-calculated? 
+    # 'run_global_features' saves them? No, usually calculated on load.
+    # Assuming 'line_length' and 'line_pos' columns exist in DB or we re-calc?
+    # In `load_and_process_data`, we select them. If they are in DB, great.
+    # If not, we skip this specific condition or approx.
+    
+    cond_stats = {}
+    if 'line_length' in df_hist.columns and 'line_pos' in df_hist.columns:
+        # Filter
+        cond_mask = ((df_hist['line_length'] == current_line_len) & 
+                     (df_hist['line_pos'] == current_line_pos)).to_numpy(dtype=bool)
+        if cond_mask.any():
+            c_total, c_wins, c_ren2, c_ren3 = finish_counts(ranks[cond_mask])
+            cond_stats = {
+                'match_count': c_total,
+                'win_rate': (c_wins/c_total)*100,
+                'ren2_rate': (c_ren2/c_total)*100,
+                'ren3_rate': (c_ren3/c_total)*100
+            }
+            
+    # --- 3. Bank Matching ---
+    bank_stats = {}
+    bank_matches = []
+    if current_specs:
+        c_str, c_cant, _ = current_specs
+        # Find similar banks from history (approx logic)
+        # Similarity: Straight within 5m, Cant within 2 deg? (全バンクを配列で一括判定)
+        vel_names, vel_str, vel_cant, _ = _velodrome_table()
+        similar = set(vel_names[(np.abs(vel_str - c_str) < 5.0) & (np.abs(vel_cant - c_cant) < 3.0)].tolist())
+        # Iterate unique places in history
+        bank_matches = [p for p in df_hist['競輪場'].unique() if p in similar]
+    
+    if bank_matches:
+        bank_mask = df_hist['競輪場'].isin(bank_matches).to_numpy(dtype=bool)
+        if bank_mask.any():
+            b_total, b_wins, b_ren2, b_ren3 = finish_counts(ranks[bank_mask])
+            bank_stats = {
+                'match_banks': list(bank_matches)[:3], # Show top 3 examples
+                'total': b_total,
+                'win_rate': (b_wins/b_total)*100,
+                'ren2_rate': (b_ren2/b_total)*100,
+                'ren3_rate': (b_ren3/b_total)*100
+            }
+
+    # --- 4. Classifications (Majin, Survivor, etc.) ---
+    labels = []
+    w = basic_stats['win_rate']
+    r2 = basic_stats['ren2_rate']
+    r3 = basic_stats['ren3_rate']
+    
+    # Majin (Demon): Dominant Winner
+    if w >= 40.0 and r3 >= 70.0:
+        labels.append("😈 魔人系 (圧倒的強さ)")
+    elif w >= 30.0:
+        labels.append("👹 鬼脚 (勝率高)")
+        
+    # Survivor: High Ren3 but Low Win (Tenacious)
+    if w < 10.0 and r3 >= 50.0:
+        labels.append("🧟 サバイバー (3着残り)")
+        
+    # Specialist: Better in Condition than Basic
+    if cond_stats.get('win_rate', 0) > (w + 15.0):
+        labels.append("🔧 条件職人 (ライン/位置 ハマり)")
+        
+    if bank_stats.get('win_rate', 0) > (w + 15.0):
+        labels.append("🏰 バンクの申し子 (コース相性抜群)")
+        
+    
+    # history is already newest-first (ORDER BY "日付" DESC in _fetch_player_history)
+    return {
+        'basic': basic_stats,
+        'condition': cond_stats,
+        'bank': bank_stats,
+        'labels': labels,
+        'history_df': df_hist # Return raw history for UI
+    }
+
 
 # ==========================================
 # 7. AI Reporter Logic
 # ==========================================
+
+# Area Map for Prompt Context (Explicitly tell AI the area)
+# 府県 -> 地区 (プロンプトで地区を明示する・ライン欠損時の地区別推定に使う)
+_AREA_MAP = {
+    "北海道":"北日本", "青森":"北日本", "岩手":"北日本", "宮城":"北日本", "秋田":"北日本", "山形":"北日本", "福島":"北日本",
+    "茨城":"関東", "栃木":"関東", "群馬":"関東", "埼玉":"関東", "東京":"関東", "新潟":"関東", "長野":"関東", "山梨":"関東",
+    "千葉":"南関東", "神奈川":"南関東", "静岡":"南関東",
+    "愛知":"中部", "岐阜":"中部", "三重":"中部", "富山":"中部", "石川":"中部",
+    "福井":"近畿", "滋賀":"近畿", "京都":"近畿", "大阪":"近畿", "兵庫":"近畿", "奈良":"近畿", "和歌山":"近畿",
+    "鳥取":"中国", "島根":"中国", "岡山":"中国", "広島":"中国", "山口":"中国",
+    "徳島":"四国", "香川":"四国", "愛媛":"四国", "高知":"四国",
+    "福岡":"九州", "佐賀":"九州", "長崎":"九州", "熊本":"九州", "大分":"九州", "宮崎":"九州", "鹿児島":"九州", "沖縄":"九州"
+}
+_AREA_SERIES = pd.Series(_AREA_MAP)  # Series.map 用 (呼び出しごとの dict -> Series 変換を省く)
+
 def generate_race_report(df, meta, strategy, api_key):
     """
     Generate a Keirin Race Report using Gemini.
     """
     if not api_key:
         return "APIキーが設定されていません。"
-        
-    import google.generativeai as genai
-    genai.configure(api_key=api_key)
     
     # Construct Context
     place = meta.get('place', '不明')
     race_num = meta.get('race_num', '?')
     cls = meta.get('race_class', '')
-    
-    # Area Map for Prompt Context (Explicitly tell AI the area)
-    area_map = {
-        "北海道":"北日本", "青森":"北日本", "岩手":"北日本", "宮城":"北日本", "秋田":"北日本", "山形":"北日本", "福島":"北日本",
-        "茨城":"関東", "栃木":"関東", "群馬":"関東", "埼玉":"関東", "東京":"関東", "新潟":"関東", "長野":"関東", "山梨":"関東",
-        "千葉":"南関東", "神奈川":"南関東", "静岡":"南関東",
-        "愛知":"中部", "岐阜":"中部", "三重":"中部", "富山":"中部", "石川":"中部",
-        "福井":"近畿", "滋賀":"近畿", "京都":"近畿", "大阪":"近畿", "兵庫":"近畿", "奈良":"近畿", "和歌山":"近畿",
-        "鳥取":"中国", "島根":"中国", "岡山":"中国", "広島":"中国", "山口":"中国",
-        "徳島":"四国", "香川":"四国", "愛媛":"四国", "高知":"四国",
-        "福岡":"九州", "佐賀":"九州", "長崎":"九州", "熊本":"九州", "大分":"九州", "宮崎":"九州", "鹿児島":"九州", "沖縄":"九州"
-    }
 
     # Players List text
     # Car | Name (Pref/Area) | Score | Line | Flags
+    # (iterrows ではなく必要な列だけを取り出して zip する)
     p_lines = []
-    for _, row in df.iterrows():
-        c = row['車番']
-        n = row['選手名']
-        s = row['競走得点']
-        l = row.get('ライン', '')
-        fuken = row.get('府県', '')
-        area = area_map.get(fuken, '?')
+    def col(name, default):
+        return df[name].tolist() if name in df.columns else [default] * len(df)
+    has_final = 'final_score' in df.columns
+    for c, n, s, l, fuken, reasons_raw, final in zip(
+            df['車番'].tolist(), df['選手名'].tolist(), df['競走得点'].tolist(),
+            col('ライン', ''), col('府県', ''), col('bonus_reasons', []), col('final_score', 0)):
+        area = _AREA_MAP.get(fuken, '?')
         
         # Extract Antigravity Flags & Reasons
-        reasons_raw = row.get('bonus_reasons', [])
         if isinstance(reasons_raw, str):
             # Handle string case if it was somehow converted
-            import ast
             try: reasons_list = ast.literal_eval(reasons_raw)
             except: reasons_list = [str(reasons_raw)]
         elif isinstance(reasons_raw, list):
@@ -3203,14 +3535,14 @@ def generate_race_report(df, meta, strategy, api_key):
         # We'll just dump all tags.
         
         try:
-            s_val = float(row.get('競走得点', 0))
+            s_val = float(s)
         except:
             s_val = 0.0
             
         # Add AI Score (final_score) if exists
         ai_score_str = ""
-        if 'final_score' in row:
-             ai_s = float(row['final_score'])
+        if has_final:
+             ai_s = float(final)
              ai_score_str = f" [AI指数:{ai_s:.1f}]"
 
         tags_str = " ".join(bonus_tags)
@@ -3288,7 +3620,7 @@ def generate_race_report(df, meta, strategy, api_key):
                                  # Actually if col is '123', that IS the line.
                                  # But let's verify cars.
                                  # Extract digits
-                                 mems = re.findall(r'\d', l_str)
+                                 mems = _PAT_DIGIT.findall(l_str)
                                  if mems:
                                      line_groups[l_str] = mems
                                      seen.add(l_str)
@@ -3309,31 +3641,16 @@ def generate_race_report(df, meta, strategy, api_key):
     # Fallback: If line_summary is empty or "情報なし", Guess from Area
     if not line_summary or line_summary == "情報なし":
         try:
-             # Define Areas
-             area_map = {
-                 "北海道":"北日本", "青森":"北日本", "岩手":"北日本", "宮城":"北日本", "秋田":"北日本", "山形":"北日本", "福島":"北日本",
-                 "茨城":"関東", "栃木":"関東", "群馬":"関東", "埼玉":"関東", "東京":"関東", "新潟":"関東", "長野":"関東", "山梨":"関東",
-                 "千葉":"南関東", "神奈川":"南関東", "静岡":"南関東",
-                 "愛知":"中部", "岐阜":"中部", "三重":"中部", "富山":"中部", "石川":"中部",
-                 "福井":"近畿", "滋賀":"近畿", "京都":"近畿", "大阪":"近畿", "兵庫":"近畿", "奈良":"近畿", "和歌山":"近畿",
-                 "鳥取":"中国", "島根":"中国", "岡山":"中国", "広島":"中国", "山口":"中国",
-                 "徳島":"四国", "香川":"四国", "愛媛":"四国", "高知":"四国",
-                 "福岡":"九州", "佐賀":"九州", "長崎":"九州", "熊本":"九州", "大分":"九州", "宮崎":"九州", "鹿児島":"九州", "沖縄":"九州"
-             }
-             
-             # Assign Area
-             df_temp = df.copy()
-             df_temp['area'] = df_temp['府県'].map(area_map).fillna("その他")
+             # Assign Area (df をコピーせず、地区の配列だけ作って車番と zip する)
+             areas = df['府県'].map(_AREA_SERIES).fillna("その他").tolist()
              
              # Sort: Area (custom order) then Score
              # Custom Order: N, E, S, W... doesn't matter, just group
              # Group by Area
              area_groups = {}
-             for _, r in df_temp.iterrows():
-                 a = r['area']
+             for a, car in zip(areas, df['車番'].tolist()):
                  if a == "その他": continue # Tanki usually
-                 if a not in area_groups: area_groups[a] = []
-                 area_groups[a].append(str(r['車番']))
+                 area_groups.setdefault(a, []).append(str(car))
             
              # Merge Small Groups (1 person) to Tanki? No, keep it.
              guessed_parts = []
@@ -3374,7 +3691,7 @@ def generate_race_report(df, meta, strategy, api_key):
                 picks.append(f"{rnk}位: {row['車番']}番 {row['選手名']} (評価点:{float(row.get('final_score', 0)):.1f})")
             
             ai_top_pick_text = "【AI上位評価（推奨）】:\n" + "\n".join(picks)
-            top_name = df_sorted.iloc[0]['選手名'] # Primary pick name
+            top_name = df_sorted['選手名'].iat[0] # Primary pick name
     
     prompt = f'''
 あなたは「伝説の競輪記者」として、以下のデータに基づき、このレース（{place} {race_num}R {cls}）の「展開予想」と「推奨買い目」を執筆してください。
@@ -3428,9 +3745,8 @@ def generate_race_report(df, meta, strategy, api_key):
         # gemini-1.5-flash is NOT available in this environment (checked via list_models).
         # Available: gemini-2.5-flash, gemini-2.0-flash, gemini-flash-latest
         # We switch to gemini-2.5-flash.
-        model = genai.GenerativeModel("gemini-2.5-flash")
+        model = _get_model(api_key)
         
-        import time
         max_retries = 3
         base_delay = 5
         
@@ -3474,8 +3790,7 @@ def generate_chat_response(messages, context_data, api_key):
     if not api_key:
         return "APIキーが設定されていません。サイドバーから設定してください。"
 
-    import google.generativeai as genai
-    genai.configure(api_key=api_key)
+    _configure(api_key)
     
     # 1. Construct System Prompt from Context
     # Unpack context
@@ -3549,6 +3864,22 @@ def generate_chat_response(messages, context_data, api_key):
 # ==========================================
 # 9. History Analysis Logic
 # ==========================================
+
+_PAT_SCORE = re.compile(r'-?\d+(\.\d*)?')
+
+def coerce_score(v, default=0.0):
+    """ai_indices の final_score を例外なしで float に正規化 (float() で変換できない値は default)"""
+    # 数値 (numpy の int64 / float32 なども含む) と普通の数字文字列は例外処理なしで変換
+    if isinstance(v, numbers.Real):
+        return float(v)
+    if isinstance(v, str) and _PAT_SCORE.fullmatch(v.strip()):
+        return float(v)
+    # '1e3' / '+5' など float() が受け付けるその他の表記
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return default
+
 def analyze_prediction_history(history_data, db_path=db_utils.DB_PATH):
     """
     Analyze prediction history against DB results.
@@ -3721,12 +4052,7 @@ def analyze_prediction_history(history_data, db_path=db_utils.DB_PATH):
         # Let's try heuristic: specific cols or if line info is empty/special?
         # Actually '級班' is usually in the scraper DF. 
         # If any player is 'L級', skip this race.
-        is_girls = False
-        if '級班' in grp.columns:
-             if grp['級班'].apply(lambda x: 'L' in str(x)).any():
-                 is_girls = True
-        
-        if is_girls: continue
+        if '級班' in grp.columns and _grade_has_l(grp['級班']): continue
         
         # Strict Check: Rank must be 1, 2, or 3.
         valid_rows = sorted_grp[(sorted_grp['rank_val'] >= 1) & (sorted_grp['rank_val'] <= 3)]
@@ -4110,8 +4436,7 @@ def analyze_line_strategy_bias(history_data, db_path=db_utils.DB_PATH):
         parts = l_str.split()
         for p in parts:
             # Extract digits using regex to avoid noise
-            import re
-            digits = [int(c) for c in re.findall(r'\d', p)]
+            digits = [int(c) for c in _PAT_DIGIT.findall(p)]
             if digits:
                 groups.append(digits)
         return groups
@@ -4142,7 +4467,7 @@ def analyze_line_strategy_bias(history_data, db_path=db_utils.DB_PATH):
     
     for rid, grp in df_db.groupby('race_id'):
         # Get Line Info (first row)
-        l_str = grp.iloc[0]['ライン']
+        l_str = grp['ライン'].iat[0]
         l_groups = parse_line_str(l_str)
         
         sorted_grp = grp.sort_values('rank_val')
@@ -4151,8 +4476,8 @@ def analyze_line_strategy_bias(history_data, db_path=db_utils.DB_PATH):
         res_pair = None
         if len(valid) >= 2:
             try:
-                r1 = int(valid.iloc[0]['車番'])
-                r2 = int(valid.iloc[1]['車番'])
+                r1 = int(valid['車番'].iat[0])
+                r2 = int(valid['車番'].iat[1])
                 res_pair = (r1, r2)
             except: pass
             
@@ -4352,6 +4677,7 @@ def analyze_ai_score_performance(history_data, db_path=db_utils.DB_PATH):
         # Bonus Analysis Data
         'bonus_data': []
     }
+    bonus_rids = []
 
     for h in history_data:
         r_num = str(h.get('race_num','')).replace('R','') + 'R'
@@ -4416,49 +4742,62 @@ def analyze_ai_score_performance(history_data, db_path=db_utils.DB_PATH):
         # 3. Gap Data
         stats['gap_data'].append({'gap': gap, 'is_win': is_win_1, 'is_rentai': is_rentai_1, 'is_fukusho': is_fukusho_1})
         
-        # 4. Bonus Analysis - Recalculate bonus for this race
-        # Load race data and recalculate
+        # 4. Bonus Analysis は対象レースを集めてから一括で採点する (下で実施)
+        bonus_rids.append(rid)
+
+    # 4. Bonus Analysis - Recalculate bonus for each race
+    # レースごとの SELECT をやめ、対象レースの全行をチャンク単位でまとめて読み込み採点する
+    scored_map = {}
+    uniq_rids = list(dict.fromkeys(bonus_rids))
+    for i in range(0, len(uniq_rids), chunk_size):
+        chunk = uniq_rids[i:i+chunk_size]
+        placeholders = ','.join(['?'] * len(chunk))
         try:
-            query_race = "SELECT * FROM race_result WHERE race_id = ?"
-            df_race = pd.read_sql(query_race, conn, params=[rid])
-            if not df_race.empty:
-                df_scored = calculate_ai_score(df_race)
-                if 'base_score' in df_scored.columns and 'ai_score' in df_scored.columns:
-                    df_scored['bonus'] = df_scored['ai_score'] - df_scored['base_score']
-                    # Safe rank calculation - handle NaN
-                    df_scored['comp_rank'] = df_scored['base_score'].rank(ascending=False, method='min')
-                    df_scored['comp_rank'] = df_scored['comp_rank'].fillna(99).astype(int)
-                    
-                    # Find max bonus player
-                    df_sorted = df_scored.sort_values('bonus', ascending=False)
-                    top_bonus_rec = df_sorted.iloc[0]
-                    max_bonus = top_bonus_rec['bonus']
-                    bonus_player_rank = top_bonus_rec['comp_rank']
+            df_rows = pd.read_sql(f"SELECT * FROM race_result WHERE race_id IN ({placeholders})", conn, params=chunk)
+            scored_map.update(calculate_ai_score_batch(df_rows))
+        except:
+            pass
+
+    for rid in bonus_rids:
+        df_scored = scored_map.get(rid)
+        if df_scored is None: continue
+        try:
+            if 'base_score' in df_scored.columns and 'ai_score' in df_scored.columns:
+                df_scored['bonus'] = df_scored['ai_score'] - df_scored['base_score']
+                # Safe rank calculation - handle NaN
+                df_scored['comp_rank'] = df_scored['base_score'].rank(ascending=False, method='min')
+                df_scored['comp_rank'] = df_scored['comp_rank'].fillna(99).astype(int)
+                
+                # Find max bonus player
+                df_sorted = df_scored.sort_values('bonus', ascending=False)
+                top_bonus_rec = df_sorted.iloc[0]
+                max_bonus = top_bonus_rec['bonus']
+                bonus_player_rank = top_bonus_rec['comp_rank']
+                
+                # Safe car number conversion
+                try:
+                    bonus_player_car = int(float(str(top_bonus_rec['車番']).replace('nan','0')))
+                except:
+                    bonus_player_car = 0
+                
+                # Skip if NaN values
+                if pd.isna(max_bonus) or pd.isna(bonus_player_rank):
+                    pass
+                else:
+                    # Check result
+                    def clean_rank_bonus(x):
+                        try: return int(float(str(x).replace('着','').replace('部',''))) 
+                        except: return 99
                     
-                    # Safe car number conversion
-                    try:
-                        bonus_player_car = int(float(str(top_bonus_rec['車番']).replace('nan','0')))
-                    except:
-                        bonus_player_car = 0
+                    finish_rank = clean_rank_bonus(top_bonus_rec['着順'])
                     
-                    # Skip if NaN values
-                    if pd.isna(max_bonus) or pd.isna(bonus_player_rank):
-                        pass
-                    else:
-                        # Check result
-                        def clean_rank_bonus(x):
-                            try: return int(float(str(x).replace('着','').replace('部',''))) 
-                            except: return 99
-                        
-                        finish_rank = clean_rank_bonus(top_bonus_rec['着順'])
-                        
-                        stats['bonus_data'].append({
-                            'bonus': max_bonus,
-                            'comp_rank': int(bonus_player_rank),
-                            'is_win': 1 if finish_rank == 1 else 0,
-                            'is_rentai': 1 if finish_rank <= 2 else 0,
-                            'is_fukusho': 1 if finish_rank <= 3 else 0
-                        })
+                    stats['bonus_data'].append({
+                        'bonus': max_bonus,
+                        'comp_rank': int(bonus_player_rank),
+                        'is_win': 1 if finish_rank == 1 else 0,
+                        'is_rentai': 1 if finish_rank <= 2 else 0,
+                        'is_fukusho': 1 if finish_rank <= 3 else 0
+                    })
         except:
             pass
 
@@ -0,0 +1,31 @@
+"""
+race_result のインデックスを追加するスキーマ移行スクリプト。
+
+スキーマ変更 (書き込みロック・DB ファイルの更新を伴う) は UI の読み取り経路では行わず、
+スクレイパーを止めた状態でここから1回だけ実行する。
+
+    python migrate_db.py [DB_PATH]
+"""
+import sqlite3
+import sys
+from contextlib import closing
+
+import db_utils
+
+INDEXES = (
+    # 選手詳細の「直近100走」(WHERE 選手名 = ? ORDER BY 日付 DESC LIMIT 100) を全件走査+ソートなしで引く
+    'CREATE INDEX IF NOT EXISTS idx_race_result_name_date ON race_result ("選手名", "日付" DESC)',
+)
+
+
+def migrate(db_path=db_utils.DB_PATH):
+    with closing(sqlite3.connect(db_path)) as conn:
+        for ddl in INDEXES:
+            conn.execute(ddl)
+        conn.commit()
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else db_utils.DB_PATH
+    migrate(path)
+    print(f"migrated: {path}")
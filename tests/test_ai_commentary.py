@@ -0,0 +1,38 @@
+import threading
+
+import logic_v2
+
+
+class _FakeModel:
+    def __init__(self, name):
+        self.name = name
+
+    def generate_content(self, prompt):
+        if prompt == 'boom':
+            raise RuntimeError('quota')
+        return type('Response', (), {'text': f'解説:{prompt}'})()
+
+
+def test_batch_configures_and_builds_the_model_once(monkeypatch):
+    calls = {'configure': 0, 'model': 0}
+    lock = threading.Lock()
+
+    def configure(api_key):
+        with lock: calls['configure'] += 1
+
+    def generative_model(name):
+        with lock: calls['model'] += 1
+        return _FakeModel(name)
+
+    monkeypatch.setattr(logic_v2.genai, 'configure', configure, raising=False)
+    monkeypatch.setattr(logic_v2.genai, 'GenerativeModel', generative_model, raising=False)
+    monkeypatch.setattr(logic_v2, '_MODEL_CACHE', {})
+    monkeypatch.setattr(logic_v2, '_CONFIGURED_KEY', [None])
+    monkeypatch.setattr(logic_v2, '_build_commentary_prompt', lambda **req: req['meta'])
+
+    prompts = [f'{i}R' for i in range(1, 12)] + ['boom']
+    res = logic_v2.generate_ai_commentary_batch([{'meta': p} for p in prompts], api_key='key')
+
+    assert calls == {'configure': 1, 'model': 1}
+    assert res[:11] == [f'解説:{p}' for p in prompts[:11]]
+    assert res[11] == '解説生成エラー: quota'
@@ -0,0 +1,61 @@
+import pandas as pd
+
+import logic_v2
+
+
+def _race(car_type):
+    cars = [6, 4, 2, 3, 1, 5, 7]
+    return pd.DataFrame({
+        '車番': [car_type(c) for c in cars],
+        '選手名': list('abcdefg'),
+        '予測勝率': [45.0, 20.0, 12.0, 9.0, 7.0, 4.0, 3.0],
+        'base_score': [110.0, 100.0, 95.0, 90.0, 88.0, 85.0, 80.0],
+        'ライン': ['642', '642', '642', '31', '31', '57', '57'],
+        '級班': ['S1'] * 7,
+        '競輪場': ['前橋'] * 7,
+    })
+
+
+def test_string_car_numbers_match_int_car_numbers():
+    # 車番 が str でも本命が自分自身をライン相方にしないこと
+    res_int = logic_v2.generate_betting_strategy(_race(int))
+    res_str = logic_v2.generate_betting_strategy(_race(str))
+
+    assert res_str['type'] == res_int['type']
+    assert res_str['reason'] == res_int['reason']
+    assert res_str['tickets'] == res_int['tickets']
+    assert all('6 → 6' not in t for t in res_str['tickets'])
+
+
+def test_ties_keep_earlier_row_first_in_single_and_batch():
+    # 同点 (20.0 が3名) は pred_df で先にある行が上位。単体版と batch 版で同じ並び
+    df = _race(int)
+    df['予測勝率'] = [45.0, 20.0, 20.0, 9.0, 20.0, 4.0, 3.0]
+
+    single = logic_v2.generate_betting_strategy(df)
+    batch = logic_v2.generate_betting_strategy_batch([df])[0]
+
+    assert single == batch
+    assert single['tickets'][0] == '2車単: 6 → 4,2,1'
+
+
+def test_snipe_race_returns_full_strategy():
+    # 高回収率パターン該当車 (ai_match_cars) がいると snipe になる
+    res = logic_v2.generate_betting_strategy(_race(int), ai_match_cars=[5])
+
+    assert res['type'] == 'snipe'
+    assert res['confidence_level'] == '低'
+    assert res['recommended_points'] == {'3連単': 4, '2車単': 3}
+    assert '3連単 (フォーメーション): 5 - 6,4 - 6,4,2' in res['tickets']
+
+
+def test_nan_partner_score_ranks_last():
+    # ライン相方の base_score が NaN でも、先頭にいるだけで相方に選ばれないこと
+    df = _race(int)
+    df.loc[1, 'base_score'] = float('nan')   # 4番 (ライン 642 の2番手) が NaN
+    df.loc[2, 'base_score'] = 102.0          # 2番 (ライン 642 の3番手)
+
+    res = logic_v2.generate_betting_strategy(df)
+
+    # 相方は 2番: Gap = 110 - 102
+    assert 'Gap:8.0' in res['reason']
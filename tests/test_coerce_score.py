@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+import logic_v2
+
+
+@pytest.mark.parametrize('value, expected', [
+    (80, 80.0),
+    (np.int64(3), 3.0),
+    (np.float32(1.5), 1.5),
+    (' 12.5 ', 12.5),
+    ('-3', -3.0),
+    ('1e3', 1000.0),
+    ('+5', 5.0),
+    ('--5', 0.0),
+    ('²', 0.0),
+    ('abc', 0.0),
+    ('', 0.0),
+    (None, 0.0),
+])
+def test_coerce_score_matches_float_without_raising(value, expected):
+    assert logic_v2.coerce_score(value) == expected
+
+
+def test_coerce_score_default_marks_unparseable_values():
+    assert logic_v2.coerce_score('-', default=None) is None
+    assert logic_v2.coerce_score(None, default=None) is None
+    assert logic_v2.coerce_score('80', default=None) == 80.0
@@ -0,0 +1,17 @@
+from bs4 import BeautifulSoup
+
+import logic_v2
+
+
+def _meta(title, body=''):
+    html = f'<html><head><title>{title}</title></head><body>{body}</body></html>'
+    return logic_v2.extract_metadata_from_html(BeautifulSoup(html, 'html.parser'))
+
+
+def test_place_precedence_follows_places_order_not_text_position():
+    # 複数の競輪場名があるときは PLACES の並びが先のもの (文中の位置ではない)
+    assert _meta('岸和田競輪 函館 3R').get('place') == '函館'
+
+
+def test_place_falls_back_to_header_text():
+    assert _meta('出走表 3R', '<p>小倉 松戸</p>').get('place') == '松戸'
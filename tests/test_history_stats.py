@@ -0,0 +1,67 @@
+import pandas as pd
+
+import logic_v2
+
+
+def _results():
+    return pd.DataFrame({
+        'race_id': ['r1', 'r1', 'r1', 'r1'],
+        '日付': ['2024年01月05日'] * 4,
+        '競輪場': ['前橋'] * 4,
+        'レース番号': ['3R'] * 4,
+        '車番': [3, 1, 7, 5],
+        '着順': ['1', '2', '3', '失'],
+        '3連単': ['12,340円'] * 4,
+        '2連単': ['1,230円'] * 4,
+    })
+
+
+def test_payouts_are_parsed_once_and_source_is_untouched():
+    df = _results()
+    before = df.copy()
+    history = [{
+        'race_id': 'r1',
+        'structured_bets': [
+            {'type': '3rentan', '1st': [3], '2nd': [1, 7], '3rd': [1, 7]},
+            {'type': '2shatan', '1st': [3], '2nd': [7]},
+        ],
+    }]
+
+    stats = logic_v2.calculate_history_stats(history, df)
+
+    row = stats['history_data'][0]
+    assert row['status'] == '🎯HIT'
+    assert row['invest'] == 500
+    assert row['return'] == 12340.0
+    assert stats['analyzed_races'] == 1
+    pd.testing.assert_frame_equal(df, before)
+
+
+def test_history_without_race_id_is_matched_by_date_place_and_number():
+    history = [{
+        'date': '2024年01月05日', 'place': '前橋', 'race_num': 3,
+        'structured_bets': [{'type': '2shatan', '1st': [3], '2nd': [1]}],
+    }]
+
+    stats = logic_v2.calculate_history_stats(history, _results())
+
+    row = stats['history_data'][0]
+    assert row['race_id'] == 'r1'
+    assert row['status'] == '🎯HIT'
+    assert row['return'] == 1230.0
+
+
+def test_outcome_of_a_repeated_race_is_reused_per_entry():
+    # 同じレースが履歴に2回出ても、それぞれの買い目で判定される
+    history = [
+        {'race_id': 'r1', 'structured_bets': [{'type': '2shatan', '1st': [3], '2nd': [1]}]},
+        {'race_id': 'r1', 'structured_bets': [{'type': '2shatan', '1st': [1], '2nd': [3]}]},
+    ]
+
+    stats = logic_v2.calculate_history_stats(history, _results())
+
+    assert [r['status'] for r in stats['history_data']] == ['🎯HIT', 'ハズレ']
+    assert stats['analyzed_races'] == 2
+    assert stats['hit_count'] == 1
+    assert stats['total_invest'] == 200
+    assert stats['total_return'] == 1230.0
@@ -0,0 +1,19 @@
+import sqlite3
+from contextlib import closing
+
+import migrate_db
+
+
+def test_migrate_creates_player_history_index(tmp_path):
+    db = str(tmp_path / 'keirin.db')
+    with closing(sqlite3.connect(db)) as conn:
+        conn.execute('CREATE TABLE race_result ("選手名" TEXT, "日付" TEXT, "着順" TEXT)')
+
+    migrate_db.migrate(db)
+    migrate_db.migrate(db)  # 2回目は何もしない
+
+    with closing(sqlite3.connect(db)) as conn:
+        plan = conn.execute('EXPLAIN QUERY PLAN SELECT "着順" FROM race_result '
+                            'WHERE "選手名" = ? ORDER BY "日付" DESC LIMIT 100', ['a']).fetchall()
+    assert any('idx_race_result_name_date' in row[-1] for row in plan)
+    assert not any('TEMP B-TREE' in row[-1] for row in plan)
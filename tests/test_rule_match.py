@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+import logic_v2
+
+
+def test_check_rule_match_type_mismatch_is_false_not_error():
+    assert logic_v2.check_rule_match(pd.Series({'得意戦法': '逃'}), [('得意戦法', 3, '==')]) is False
+    assert logic_v2.check_rule_match(pd.Series({'得意戦法': '逃'}), [('得意戦法', 3, '!=')]) is True
+
+
+def test_evaluate_rule_matrix_matches_check_rule_match_row_by_row():
+    df = pd.DataFrame({
+        '競走得点': [110.0, 95.5, np.nan, 102.0, 88.0],
+        'B': [3, 0, 5, 1, 0],
+        'ライン長': [3, 2, 1, 3, 2],
+    })
+    rule_sets = [
+        [('競走得点', 100.0, '>='), ('B', 1, '>')],
+        [('競走得点', 100.0, '<'), ('ライン長', 2, '==')],
+        [('B', 0, '!='), ('ライン長', 3, '<=')],
+        [('未知の特徴', 0, '=='), ('B', 0, '>=')],   # 列が無ければ 0 扱い
+        [('未知の特徴', 1, '>=')],
+        [('B', 1, '~'), ('ライン長', 3, '==')],      # 未知の関係は無視
+        [],
+    ]
+    for rules in rule_sets:
+        expected = [logic_v2.check_rule_match(row, rules) for _, row in df.iterrows()]
+        assert logic_v2.evaluate_rule_matrix(df, rules).tolist() == expected, rules
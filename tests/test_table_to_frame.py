@@ -0,0 +1,47 @@
+import io
+from pathlib import Path
+
+import lxml.html
+import pandas as pd
+
+import logic_v2
+
+FIXTURE = Path(__file__).parent / 'fixtures' / 'kdreams_entry.html'
+
+
+def _tables(html):
+    return list(lxml.html.document_fromstring(html).iter('table'))
+
+
+def test_matches_read_html_on_kdreams_entry_page():
+    html = FIXTURE.read_text(encoding='utf-8')
+    expected = pd.read_html(io.StringIO(html), header=None)
+
+    got = [logic_v2._table_to_frame(t) for t in _tables(html)]
+
+    assert len(got) == len(expected)
+    for g, e in zip(got, expected):
+        pd.testing.assert_frame_equal(g, e)
+
+
+def test_input_tree_is_not_modified():
+    html = FIXTURE.read_text(encoding='utf-8')
+    table = _tables(html)[1]
+    before = lxml.html.tostring(table)
+
+    first = logic_v2._table_to_frame(table)
+    second = logic_v2._table_to_frame(table)
+
+    assert lxml.html.tostring(table) == before
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_parsers_can_share_one_parse_in_any_order():
+    html = FIXTURE.read_text(encoding='utf-8')
+
+    soup, root = logic_v2.parse_html_docs(html)
+    simple_first = logic_v2.parse_kdreams_simple(html, soup=soup, root=root)
+    direct_after = logic_v2.parse_kdreams_direct(html, soup=soup, root=root)
+
+    pd.testing.assert_frame_equal(direct_after[0], logic_v2.parse_kdreams_direct(html)[0])
+    pd.testing.assert_frame_equal(simple_first[0], logic_v2.parse_kdreams_simple(html)[0])